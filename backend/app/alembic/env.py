@@ -30,6 +30,14 @@ target_metadata = Base.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # The trigram index is only created where pg_trgm is installed (e8a3f6c15d27), so the
+    # models cannot declare it. Autogenerate would otherwise drop it on every revision
+    if type_ == "index" and name == "ix_cars_search_text_trgm":
+        return False
+    return True
+
+
 def get_url():
     user = os.getenv("POSTGRES_USER", "postgres")
     password = os.getenv("POSTGRES_PASSWORD", "")
@@ -52,7 +60,8 @@ def run_migrations_offline():
     """
     url = get_url()
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True, compare_type=True
+        url=url, target_metadata=target_metadata, literal_binds=True, compare_type=True,
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -74,7 +83,8 @@ def run_migrations_online():
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata, compare_type=True
+            connection=connection, target_metadata=target_metadata, compare_type=True,
+            include_object=include_object,
         )
 
         with context.begin_transaction():
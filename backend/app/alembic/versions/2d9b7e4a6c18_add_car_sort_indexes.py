@@ -0,0 +1,33 @@
+"""Add car sort indexes
+
+Revision ID: 2d9b7e4a6c18
+Revises: e8a3f6c15d27
+Create Date: 2026-10-17 20:12:35.118406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d9b7e4a6c18'
+down_revision = 'e8a3f6c15d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The id breaks ties, so sorted pages seek on (column, id) through the index
+    op.create_index('ix_cars_company_id_branch_id_price_id', 'cars', ['company_id', 'branch_id', 'price', 'id'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_year_id', 'cars', ['company_id', 'branch_id', 'year', 'id'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_kilometers_id', 'cars', ['company_id', 'branch_id', 'kilometers', 'id'], unique=False)
+    op.drop_index('ix_cars_company_id_branch_id_price', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_year', table_name='cars')
+
+
+def downgrade():
+    op.create_index('ix_cars_company_id_branch_id_year', 'cars', ['company_id', 'branch_id', 'year'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_price', 'cars', ['company_id', 'branch_id', 'price'], unique=False)
+    op.drop_index('ix_cars_company_id_branch_id_kilometers_id', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_year_id', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_price_id', table_name='cars')
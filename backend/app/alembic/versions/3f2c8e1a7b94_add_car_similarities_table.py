@@ -0,0 +1,37 @@
+"""Add car similarities table
+
+Revision ID: 3f2c8e1a7b94
+Revises: 9fb40da3c869
+Create Date: 2026-10-17 10:12:41.418202
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2c8e1a7b94'
+down_revision = '9fb40da3c869'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('car_similarities',
+    sa.Column('car_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('similar_car_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('engine', sa.String(), nullable=False),
+    sa.Column('stale', sa.Boolean(), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['car_id'], ['cars.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['similar_car_id'], ['cars.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('car_id', 'rank')
+    )
+    op.create_index(op.f('ix_car_similarities_similar_car_id'), 'car_similarities', ['similar_car_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_car_similarities_similar_car_id'), table_name='car_similarities')
+    op.drop_table('car_similarities')
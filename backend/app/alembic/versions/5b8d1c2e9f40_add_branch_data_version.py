@@ -0,0 +1,24 @@
+"""Add branch data version
+
+Revision ID: 5b8d1c2e9f40
+Revises: 3f2c8e1a7b94
+Create Date: 2026-10-17 14:03:27.513806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8d1c2e9f40'
+down_revision = '3f2c8e1a7b94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('branches', sa.Column('data_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('branches', 'data_version')
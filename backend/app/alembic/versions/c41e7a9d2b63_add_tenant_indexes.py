@@ -0,0 +1,48 @@
+"""Add tenant indexes
+
+Revision ID: c41e7a9d2b63
+Revises: 5b8d1c2e9f40
+Create Date: 2026-10-17 16:21:08.294117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7a9d2b63'
+down_revision = '5b8d1c2e9f40'
+branch_labels = None
+depends_on = None
+
+CAR_COLUMN_INDEXES = ['color', 'fuel_type', 'id', 'kilometers', 'make', 'model', 'price', 'seats', 'transmission', 'year']
+
+
+def upgrade():
+    op.create_index('ix_cars_company_id_branch_id_id', 'cars', ['company_id', 'branch_id', 'id'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_make_model', 'cars', ['company_id', 'branch_id', 'make', 'model'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_price', 'cars', ['company_id', 'branch_id', 'price'], unique=False)
+    op.create_index('ix_cars_company_id_branch_id_year', 'cars', ['company_id', 'branch_id', 'year'], unique=False)
+    for column in CAR_COLUMN_INDEXES:
+        op.drop_index(op.f(f'ix_cars_{column}'), table_name='cars')
+
+    op.create_index('ix_user_interactions_company_id_branch_id_id', 'user_interactions', ['company_id', 'branch_id', 'id'], unique=False)
+    op.create_index(op.f('ix_user_interactions_car_id'), 'user_interactions', ['car_id'], unique=False)
+    op.create_index(op.f('ix_user_interactions_user_id'), 'user_interactions', ['user_id'], unique=False)
+    op.drop_index(op.f('ix_user_interactions_id'), table_name='user_interactions')
+    op.drop_index(op.f('ix_user_interactions_interaction_type'), table_name='user_interactions')
+
+
+def downgrade():
+    op.create_index(op.f('ix_user_interactions_interaction_type'), 'user_interactions', ['interaction_type'], unique=False)
+    op.create_index(op.f('ix_user_interactions_id'), 'user_interactions', ['id'], unique=False)
+    op.drop_index(op.f('ix_user_interactions_user_id'), table_name='user_interactions')
+    op.drop_index(op.f('ix_user_interactions_car_id'), table_name='user_interactions')
+    op.drop_index('ix_user_interactions_company_id_branch_id_id', table_name='user_interactions')
+
+    for column in CAR_COLUMN_INDEXES:
+        op.create_index(op.f(f'ix_cars_{column}'), 'cars', [column], unique=False)
+    op.drop_index('ix_cars_company_id_branch_id_year', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_price', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_make_model', table_name='cars')
+    op.drop_index('ix_cars_company_id_branch_id_id', table_name='cars')
@@ -0,0 +1,35 @@
+"""Add car search indexes
+
+Revision ID: e8a3f6c15d27
+Revises: c41e7a9d2b63
+Create Date: 2026-10-17 17:46:52.730941
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a3f6c15d27'
+down_revision = 'c41e7a9d2b63'
+branch_labels = None
+depends_on = None
+
+SEARCH_TEXT = "make || ' ' || model || ' ' || color"
+
+
+def upgrade():
+    op.create_index(
+        'ix_cars_search_document', 'cars', [sa.text(f"to_tsvector('simple', {SEARCH_TEXT})")],
+        unique=False, postgresql_using='gin'
+    )
+    # Typo tolerant matching needs pg_trgm, which is not shipped with every PostgreSQL install
+    bind = op.get_bind()
+    if bind.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute(f"CREATE INDEX ix_cars_search_text_trgm ON cars USING gin (({SEARCH_TEXT}) gin_trgm_ops)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_cars_search_text_trgm")
+    op.drop_index('ix_cars_search_document', table_name='cars')
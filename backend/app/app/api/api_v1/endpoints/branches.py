@@ -1,24 +1,28 @@
 from typing import Any, List
 
-from fastapi import APIRouter, Depends, HTTPException, Path
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response
 from sqlalchemy.orm import Session
 
 from app import crud, models, schemas
 from app.api import deps
+from app.core.pagination import set_next_cursor
 
 router = APIRouter()
 
 
 @router.get("/branches/", response_model=List[schemas.Branch])
 def read_branches(
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
 ) -> Any:
     """
     Retrieve branches.
     """
-    branches = crud.branch.get_multi(db, skip=skip, limit=limit)
+    branches = crud.branch.get_multi(db, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, branches, limit, [models.Branch.id])
     return branches
 
 
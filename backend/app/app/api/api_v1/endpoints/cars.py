@@ -1,43 +1,134 @@
-from typing import Any, List
+import hashlib
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
 
 from pydantic import ValidationError
 from app import crud, models, schemas
 from app.api import deps
+from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.filtering_utils import SIMILARITY_ENGINES, SQL_ENGINE
+from app.core.pagination import set_next_cursor, set_total_count
 from app.models.car import FuelType, Transmission
 
 router = APIRouter()
 
+
+def list_filter(values: Optional[List[str]]) -> Optional[List[str]]:
+    # Any of several values, repeated (make=Honda&make=Toyota)
+    # or comma separated (make=Honda,Toyota)
+    if not values:
+        return None
+    return [value for item in values for value in item.split(",") if value] or None
+
+
+def check_enum_filters(filters: Dict[str, Any]) -> None:
+    for name, enum, detail in (("fuel_type", FuelType, "Unknown fuel type"),
+                               ("transmission", Transmission, "Unknown transmission")):
+        for values in (filters[name], filters[name + "_not"]):
+            if any(
+                value not in [member.value for member in enum] for value in values or []
+            ):
+                raise HTTPException(status_code=400, detail=detail)
+
+
+def get_car_filters(
+    make: List[str] = Query(None, alias="make"),
+    model: str = Query(None, alias="model"),
+    year_min: int = Query(None, alias="year_min"),
+    year_max: int = Query(None, alias="year_max"),
+    price_min: float = Query(None, alias="price_min"),
+    price_max: float = Query(None, alias="price_max"),
+    fuel_type: List[str] = Query(None, alias="fuel_type"),
+    transmission: List[str] = Query(None, alias="transmission"),
+    color: List[str] = Query(None, alias="color"),
+    seats_min: int = Query(None, alias="seats_min"),
+    seats_max: int = Query(None, alias="seats_max"),
+    make_not: List[str] = Query(None, alias="make_not"),
+    color_not: List[str] = Query(None, alias="color_not"),
+    fuel_type_not: List[str] = Query(None, alias="fuel_type_not"),
+    transmission_not: List[str] = Query(None, alias="transmission_not"),
+) -> schemas.CarFilters:
+    """
+    Search filters shared by the car search, count, facets, histograms and similar cars.
+    """
+    filters = {
+        "make": list_filter(make),
+        "model": model,
+        "year_min": year_min,
+        "year_max": year_max,
+        "price_min": price_min,
+        "price_max": price_max,
+        "fuel_type": list_filter(fuel_type),
+        "transmission": list_filter(transmission),
+        "color": list_filter(color),
+        "seats_min": seats_min,
+        "seats_max": seats_max,
+        "make_not": list_filter(make_not),
+        "color_not": list_filter(color_not),
+        "fuel_type_not": list_filter(fuel_type_not),
+        "transmission_not": list_filter(transmission_not),
+    }
+    check_enum_filters(filters)
+    return schemas.CarFilters(**filters)
+
+
 @router.get("/company/{company_id}/branch/{branch_id}/cars/", response_model=List[schemas.Car])
 def read_cars(
     company_id: int,
     branch_id: int,
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
+    sort: str = Query(None, alias="sort"),
+    count: str = Query(None, alias="count"),
 ) -> Any:
     """
-    Retrieve all cars.
+    Retrieve all cars, optionally sorted by price, year or kilometers
+    (descending with a leading "-").
+
+    With count set to "exact" or "estimated" the number of cars of the branch is
+    returned in the X-Total-Count header.
     """
+    if sort and sort not in crud.car.sort_options:
+        raise HTTPException(status_code=400, detail="Unknown sort")
+    if count and count not in crud.car.count_modes:
+        raise HTTPException(status_code=400, detail="Unknown count mode")
     cars = crud.car.get_all(db, company_id=company_id, 
-        branch_id=branch_id, skip=skip, limit=limit)
+        branch_id=branch_id, skip=skip, limit=limit, cursor=cursor, sort=sort)
+    set_next_cursor(response, cars, limit, crud.car.get_sort_keys(sort)[0])
+    if count:
+        set_total_count(
+            response,
+            *crud.car.count_by_filters(
+                db,
+                company_id=company_id,
+                branch_id=branch_id,
+                estimated=count == "estimated",
+            ),
+        )
     return cars
 
 @router.get("/company/{company_id}/branch/{branch_id}/cars/feeling_lucky/", response_model=List[schemas.Car])
 def read_cars_feeling_lucky(
     company_id: int,
     branch_id: int,
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
 ) -> Any:
     """
     Retrieve all cars selected randomly.
     """
     cars = crud.car.get_random_records(db, company_id=company_id, 
-        branch_id=branch_id, skip=skip, limit=limit)
+        branch_id=branch_id, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, cars, limit, [models.Car.id])
     return cars
 
 
@@ -45,45 +136,154 @@ def read_cars_feeling_lucky(
 def search_cars(
     company_id: int,
     branch_id: int,
-    make: str = Query(None, alias="make"),
-    model: str = Query(None, alias="model"),
-    year_min: int = Query(None, alias="year_min"),
-    year_max: int = Query(None, alias="year_max"),
-    price_min: float = Query(None, alias="price_min"),
-    price_max: float = Query(None, alias="price_max"),
-    fuel_type: str = Query(None, alias="fuel_type"), # cannot be FuelType enum due to pydantic
-    transmission: str = Query(None, alias="transmission"), # cannot be Transmission enum due to pydantic
-    color: str = Query(None, alias="color"),
-    seats_min: int = Query(None, alias="seats_min"),
-    seats_max: int = Query(None, alias="seats_max"),
+    response: Response,
+    filters: schemas.CarFilters = Depends(get_car_filters),
+    q: str = Query(None, alias="q"),
+    cursor: str = Query(None, alias="cursor"),
+    sort: str = Query(None, alias="sort"),
+    count: str = Query(None, alias="count"),
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100
 ):
-    filters = {
-        "make": make,
-        "model": model,
-        "year_min": year_min,
-        "year_max": year_max,
-        "price_min": price_min,
-        "price_max": price_max,
-        "fuel_type": fuel_type,
-        "transmission": transmission,
-        "color": color,
-        "seats_min": seats_min,
-        "seats_max": seats_max,
-    }
+    if sort and sort not in crud.car.sort_options:
+        raise HTTPException(status_code=400, detail="Unknown sort")
+    if count and count not in crud.car.count_modes:
+        raise HTTPException(status_code=400, detail="Unknown count mode")
+    if q and not sort and cursor is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="Text search results are ranked, page them with skip",
+        )
 
     cars = crud.car.search_by_filters(
         db=db, 
         company_id=company_id, 
         branch_id=branch_id, 
-        **filters,
+        filters=filters,
+        q=q,
         skip=skip,
-        limit=limit
+        limit=limit,
+        cursor=cursor,
+        sort=sort
     )
+    if sort or not q:
+        set_next_cursor(response, cars, limit, crud.car.get_sort_keys(sort)[0])
+    if count:
+        set_total_count(
+            response,
+            *crud.car.count_by_filters(
+                db,
+                company_id=company_id,
+                branch_id=branch_id,
+                q=q,
+                filters=filters,
+                estimated=count == "estimated",
+            ),
+        )
     return cars
 
+
+@router.get(
+    "/company/{company_id}/branch/{branch_id}/cars/count/",
+    response_model=schemas.CarCount,
+)
+def count_cars(
+    company_id: int,
+    branch_id: int,
+    mode: str = Query("exact", alias="mode"),
+    filters: schemas.CarFilters = Depends(get_car_filters),
+    q: str = Query(None, alias="q"),
+    db: Session = Depends(deps.get_db),
+) -> Any:
+    """
+    Count the cars matching the search filters, exactly or estimated from the
+    query plan.
+    """
+    if mode not in crud.car.count_modes:
+        raise HTTPException(status_code=400, detail="Unknown count mode")
+    count, exact = crud.car.count_by_filters(
+        db,
+        company_id=company_id,
+        branch_id=branch_id,
+        q=q,
+        filters=filters,
+        estimated=mode == "estimated",
+    )
+    return {"count": count, "exact": exact}
+
+
+@router.get(
+    "/company/{company_id}/branch/{branch_id}/cars/facets/",
+    response_model=schemas.CarFacets,
+)
+def read_car_facets(
+    company_id: int,
+    branch_id: int,
+    filters: schemas.CarFilters = Depends(get_car_filters),
+    q: str = Query(None, alias="q"),
+    db: Session = Depends(deps.get_db),
+) -> Any:
+    """
+    Count the cars matching the search filters per make, color, seats, fuel type
+    and transmission.
+    """
+    facets = crud.car.get_facets(
+        db, company_id=company_id, branch_id=branch_id, q=q, filters=filters
+    )
+    return {
+        name: [{"value": value, "count": count} for value, count in counts]
+        for name, counts in facets.items()
+    }
+
+
+@router.get(
+    "/company/{company_id}/branch/{branch_id}/cars/histograms/",
+    response_model=schemas.CarHistograms,
+)
+def read_car_histograms(
+    company_id: int,
+    branch_id: int,
+    request: Request,
+    response: Response,
+    buckets: int = Query(10, alias="buckets", ge=1, le=100),
+    filters: schemas.CarFilters = Depends(get_car_filters),
+    q: str = Query(None, alias="q"),
+    db: Session = Depends(deps.get_db),
+) -> Any:
+    """
+    Count the cars matching the search filters in equal width price, year and
+    kilometers buckets.
+
+    The response carries an ETag of the branch data version and the query, so
+    clients revalidate it and get 304 Not Modified until a car of the branch changes.
+    """
+    query_hash = hashlib.sha1(
+        str(sorted(request.query_params.multi_items())).encode()
+    ).hexdigest()[:16]
+    data_version = crud.car.get_data_version(db, branch_id=branch_id)
+    etag = f'W/"{branch_id}-{data_version}-{query_hash}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    histograms = crud.car.get_histograms(
+        db,
+        company_id=company_id,
+        branch_id=branch_id,
+        buckets=buckets,
+        q=q,
+        filters=filters,
+    )
+    return {
+        name: [
+            {"lower": lower, "upper": upper, "count": count}
+            for lower, upper, count in bucket_counts
+        ]
+        for name, bucket_counts in histograms.items()
+    }
+
 @router.post("/company/{company_id}/branch/{branch_id}/cars/", response_model=schemas.Car)
 def create_car(
     company_id: int,
@@ -206,13 +406,143 @@ def get_cars_similar(
     id: int,
     company_id: int,
     branch_id: int,
-    limit: int = 100
+    limit: int = 100,
+    # "tfidf", "numeric", "ann" or "sql", defaults to the configured engine
+    engine: str = Query(None, alias="engine"),
+    exact: bool = False,  # bypass the approximate index of the "ann" engine
+    filters: schemas.CarFilters = Depends(get_car_filters),
 ) -> Any:
     """
-    Get cars similar to one provided id.
+    Get cars similar to one provided id, optionally only among the cars matching
+    the search filters.
     """
+    if engine and engine not in SIMILARITY_ENGINES and engine != SQL_ENGINE:
+        raise HTTPException(status_code=400, detail="Unknown similarity engine")
     car = crud.car.get(db=db, id=id)
     if not car:
         raise HTTPException(status_code=404, detail="Car record not found")
-    cars = crud.car.get_similar_cars(db=db, id=id, company_id=company_id, branch_id=branch_id, limit=limit)
-    return cars
\ No newline at end of file
+    cars = crud.car.get_similar_cars(
+        db=db,
+        id=id,
+        company_id=company_id,
+        branch_id=branch_id,
+        limit=limit,
+        engine=engine,
+        exact=exact,
+        filters=filters,
+    )
+    return cars
+
+
+@router.get(
+    "/company/{company_id}/branch/{branch_id}/cars/similar/",
+    response_model=Dict[int, List[schemas.Car]],
+)
+def get_cars_similar_many(
+    *,
+    db: Session = Depends(deps.get_db),
+    company_id: int,
+    branch_id: int,
+    ids: List[int] = Query(..., alias="ids"),
+    limit: int = 100,
+    # "tfidf", "numeric" or "ann", defaults to the configured engine
+    engine: str = Query(None, alias="engine"),
+) -> Any:
+    """
+    Get cars similar to each of the provided ids, keyed by car id.
+    """
+    if engine and engine not in SIMILARITY_ENGINES:
+        raise HTTPException(status_code=400, detail="Unknown similarity engine")
+    if len(ids) > settings.SIMILARITY_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail="Too many car ids requested")
+    similar_cars = crud.car.get_similar_cars_many(
+        db=db,
+        ids=ids,
+        company_id=company_id,
+        branch_id=branch_id,
+        limit=limit,
+        engine=engine,
+    )
+    if len(similar_cars) < len(set(ids)):
+        raise HTTPException(status_code=404, detail="Car record not found")
+    return similar_cars
+
+
+@router.post(
+    "/company/{company_id}/branch/{branch_id}/cars/similar/example/",
+    response_model=List[schemas.Car],
+)
+def get_cars_similar_to_example(
+    *,
+    db: Session = Depends(deps.get_db),
+    company_id: int,
+    branch_id: int,
+    car_in: schemas.CarCreate,
+    limit: int = 100,
+    # "tfidf", "numeric" or "ann", defaults to the configured engine
+    engine: str = Query(None, alias="engine"),
+) -> Any:
+    """
+    Get cars similar to the provided car specification, without storing it.
+    """
+    if engine and engine not in SIMILARITY_ENGINES:
+        raise HTTPException(status_code=400, detail="Unknown similarity engine")
+    cars = crud.car.get_similar_cars_by_example(
+        db=db,
+        obj_in=car_in,
+        company_id=company_id,
+        branch_id=branch_id,
+        limit=limit,
+        engine=engine,
+    )
+    return cars
+
+
+@router.get(
+    "/company/{company_id}/cars/{id}/similar/", response_model=List[schemas.Car]
+)
+def get_cars_similar_in_company(
+    *,
+    db: Session = Depends(deps.get_db),
+    id: int,
+    company_id: int,
+    limit: int = 100,
+    # "tfidf", "numeric" or "ann", defaults to the configured engine
+    engine: str = Query(None, alias="engine"),
+    exact: bool = False,  # bypass the approximate index of the "ann" engine
+) -> Any:
+    """
+    Get cars similar to one provided id across all branches of the company.
+    """
+    if engine and engine not in SIMILARITY_ENGINES:
+        raise HTTPException(status_code=400, detail="Unknown similarity engine")
+    car = crud.car.get(db=db, id=id)
+    if not car or car.company_id != company_id:
+        raise HTTPException(status_code=404, detail="Car record not found")
+    cars = crud.car.get_similar_cars_in_company(
+        db=db, id=id, company_id=company_id, limit=limit, engine=engine, exact=exact
+    )
+    return cars
+
+
+@router.post(
+    "/company/{company_id}/branch/{branch_id}/cars/similar/precompute/",
+    response_model=schemas.Msg,
+    status_code=201,
+)
+def precompute_cars_similar(
+    company_id: int,
+    branch_id: int,
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> Any:
+    """
+    Recompute the stored similar cars of a whole branch in the celery worker.
+    """
+    if not settings.SIMILARITY_PRECOMPUTE_ENABLED:
+        raise HTTPException(
+            status_code=400, detail="Similar cars precomputation is disabled"
+        )
+    celery_app.send_task(
+        "app.worker.compute_branch_similarities", args=[company_id, branch_id]
+    )
+    return {"msg": "Similar cars precomputation scheduled"}
@@ -1,24 +1,28 @@
 from typing import Any, List
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
 
 from app import crud, models, schemas
 from app.api import deps
+from app.core.pagination import set_next_cursor
 
 router = APIRouter()
 
 
 @router.get("/", response_model=List[schemas.Company])
 def read_companies(
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
 ) -> Any:
     """
     Retrieve companies.
     """
-    companies = crud.company.get_multi(db, skip=skip, limit=limit)
+    companies = crud.company.get_multi(db, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, companies, limit, [models.Company.id])
     return companies
 
 
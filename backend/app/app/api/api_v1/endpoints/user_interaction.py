@@ -1,4 +1,4 @@
-from typing import Any, List
+from typing import Any, List, Optional
 from app.core.validators import validate_user_interaction
 
 from fastapi import APIRouter, Depends, HTTPException
@@ -89,6 +89,44 @@ def read_user_interactions_for_car(
         raise HTTPException(status_code=404, detail="User interaction with the provided car id not found")
     return user_interaction
 
+@router.get("/car/{car_id}/also_viewed/", response_model=List[schemas.Car])
+def read_cars_also_viewed(
+    car_id: int,
+    db: Session = Depends(deps.get_db),
+    limit: int = 10
+) -> Any:
+    """
+    Retrieve cars most often viewed or liked by the users who interacted with the given car.
+    """
+    car = crud.car.get(db, id=car_id)
+    if not car:
+        raise HTTPException(status_code=404, detail="Car record not found")
+    car_ids = crud.user_interaction.get_co_occurring_car_ids(
+        db, company_id=car.company_id, branch_id=car.branch_id, car_id=car_id, limit=limit)
+    return crud.car.get_multi_by_ids(db, ids=car_ids)
+
+@router.get("/user/{user_id}/recommendations/", response_model=List[schemas.Car])
+def read_user_recommendations(
+    user_id: int,
+    db: Session = Depends(deps.get_db),
+    company_id: Optional[int] = None,
+    branch_id: Optional[int] = None,
+    limit: int = 10
+) -> Any:
+    """
+    Retrieve cars of a branch matching the preferences of a user, the user's own branch by default.
+    """
+    user = crud.user.get(db, id=user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    company_id = company_id or user.company_id
+    branch_id = branch_id or user.branch_id
+    if not company_id or not branch_id:
+        raise HTTPException(status_code=400, detail="Company and branch have to be provided")
+    car_ids = crud.user_interaction.get_recommended_car_ids(
+        db, user_id=user_id, company_id=company_id, branch_id=branch_id, limit=limit)
+    return crud.car.get_multi_by_ids(db, ids=car_ids)
+
 @router.get("/user/{user_id}/user_interactions/", response_model=List[schemas.UserInteraction])
 def read_user_interactions_for_user(
     user_id: int,
@@ -1,6 +1,6 @@
 from typing import Any, List
 
-from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Response
 from fastapi.encoders import jsonable_encoder
 from pydantic.networks import EmailStr
 from sqlalchemy.orm import Session
@@ -8,6 +8,7 @@ from sqlalchemy.orm import Session
 from app import crud, models, schemas
 from app.api import deps
 from app.core.config import settings
+from app.core.pagination import set_next_cursor
 from app.utils import send_new_account_email
 
 router = APIRouter()
@@ -15,44 +16,54 @@ router = APIRouter()
 
 @router.get("/users/", response_model=List[schemas.User])
 def read_users(
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
     current_user: models.User = Depends(deps.get_current_active_superuser),
 ) -> Any:
     """
     Retrieve users.
     """
-    users = crud.user.get_multi(db, skip=skip, limit=limit)
+    users = crud.user.get_multi(db, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, users, limit, [models.User.id])
     return users
 
 @router.get("/company/{company_id}/users/", response_model=List[schemas.User])
 def read_users_by_company(
     company_id: int,
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
     current_user: models.User = Depends(deps.get_current_active_superuser),
 ) -> Any:
     """
     Retrieve users for a specific company_id.
     """
-    users = crud.user.get_multi_by_company_id(db, company_id=company_id, skip=skip, limit=limit)
+    users = crud.user.get_multi_by_company_id(db, company_id=company_id, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, users, limit, [models.User.id])
     return users
 
 @router.get("/company/{company_id}/branch/{branch_id}/users/", response_model=List[schemas.User])
 def read_users_by_company(
     company_id: int,
     branch_id: int,
+    response: Response,
     db: Session = Depends(deps.get_db),
     skip: int = 0,
     limit: int = 100,
+    cursor: str = Query(None, alias="cursor"),
     current_user: models.User = Depends(deps.get_current_active_superuser),
 ) -> Any:
     """
     Retrieve users for a specific company_id and branch_id.
     """
-    users = crud.user.get_multi_by_company_id_and_branch_id(db, company_id=company_id, branch_id=branch_id, skip=skip, limit=limit)
+    users = crud.user.get_multi_by_company_id_and_branch_id(
+        db, company_id=company_id, branch_id=branch_id, skip=skip, limit=limit, cursor=cursor)
+    set_next_cursor(response, users, limit, [models.User.id])
     return users
 
 
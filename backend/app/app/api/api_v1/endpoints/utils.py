@@ -6,6 +6,8 @@ from pydantic.networks import EmailStr
 from app import models, schemas
 from app.api import deps
 from app.core.celery_app import celery_app
+from app.core.feature_cache import feature_cache
+from app.core.search_cache import search_cache
 from app.utils import send_test_email
 
 router = APIRouter()
@@ -33,3 +35,23 @@ def test_email(
     """
     send_test_email(email_to=email_to)
     return {"msg": "Test email sent"}
+
+
+@router.get("/similarity-cache-stats/", response_model=dict)
+def read_similarity_cache_stats(
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> Any:
+    """
+    Get hit/miss and rebuild-time statistics of the similarity feature cache.
+    """
+    return feature_cache.stats()
+
+
+@router.get("/search-cache-stats/", response_model=dict)
+def read_search_cache_stats(
+    current_user: models.User = Depends(deps.get_current_active_superuser),
+) -> Any:
+    """
+    Get hit/miss, eviction and size statistics of the car search cache.
+    """
+    return search_cache.stats() if search_cache is not None else {}
@@ -0,0 +1,188 @@
+"""
+Query plans and write throughput of the branch scoped car queries.
+
+Every query pattern of `CRUDCar` is run with `EXPLAIN ANALYZE` against a
+branch, the report lists the scans the planner picked together with the
+execution time. Write throughput is measured by inserting cars into the
+branch inside a transaction which is rolled back afterwards. Run it before
+and after a schema change to compare both.
+
+Usage:
+    python -m app.benchmark_queries --company-id 1 --branch-id 1 --output report.json
+"""
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query, Session
+
+from app.db.session import SessionLocal
+from app.models.car import Car, FuelType, Transmission
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def branch_queries(
+    db: Session, company_id: int, branch_id: int
+) -> Dict[str, Callable[[], Query]]:
+    """
+    The queries of the listing, search, facet and similarity feature endpoints
+    for a branch.
+    """
+    sample = (
+        db.query(Car)
+        .filter(Car.company_id == company_id, Car.branch_id == branch_id)
+        .order_by(Car.id)
+        .first()
+    )
+    in_branch = [Car.company_id == company_id, Car.branch_id == branch_id]
+    return {
+        "list": lambda: db.query(Car).filter(*in_branch).order_by(Car.id).limit(100),
+        "list_after_cursor": lambda: db.query(Car)
+        .filter(*in_branch, Car.id > sample.id)
+        .order_by(Car.id)
+        .limit(100),
+        "count": lambda: db.query(Car.id).filter(*in_branch),
+        "search_make": lambda: db.query(Car)
+        .filter(*in_branch, Car.make == sample.make)
+        .order_by(Car.id)
+        .limit(100),
+        "search_make_model": lambda: db.query(Car)
+        .filter(*in_branch, Car.make == sample.make, Car.model == sample.model)
+        .order_by(Car.id)
+        .limit(100),
+        "search_price_range": lambda: db.query(Car)
+        .filter(*in_branch, Car.price.between(sample.price * 0.8, sample.price * 1.2))
+        .order_by(Car.id)
+        .limit(100),
+        "search_year_range": lambda: db.query(Car)
+        .filter(*in_branch, Car.year >= sample.year - 1, Car.year <= sample.year + 1)
+        .order_by(Car.id)
+        .limit(100),
+        "distinct_makes": lambda: db.query(Car.make).filter(*in_branch).distinct(),
+        "distinct_colors": lambda: db.query(Car.color).filter(*in_branch).distinct(),
+        "feature_rows": lambda: db.query(Car).filter(*in_branch).order_by(Car.id),
+    }
+
+
+def explain(db: Session, query: Query) -> Dict[str, Any]:
+    statement = query.statement.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    plan = db.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}").scalar()[0]
+
+    scans: List[str] = []
+
+    def collect(node: Dict[str, Any]) -> None:
+        if "Scan" in node["Node Type"]:
+            scans.append(
+                " ".join(filter(None, [node["Node Type"], node.get("Index Name")]))
+            )
+        for child in node.get("Plans", []):
+            collect(child)
+
+    collect(plan["Plan"])
+    return {
+        "scans": scans,
+        "execution_ms": plan["Execution Time"],
+        "planning_ms": plan["Planning Time"],
+    }
+
+
+def write_throughput(
+    db: Session, company_id: int, branch_id: int, inserts: int
+) -> float:
+    """
+    Cars inserted per second, the inserts are rolled back.
+
+    Rows are inserted a thousand per statement, so the time is spent on
+    writing the table and its indexes rather than on round trips.
+    """
+    rows = [
+        dict(
+            company_id=company_id,
+            branch_id=branch_id,
+            make=f"Benchmark {index % 50}",
+            model=f"Model {index}",
+            year=2000 + index % 24,
+            price=100000.0 + index,
+            kilometers=index * 10,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        )
+        for index in range(inserts)
+    ]
+    started = time.perf_counter()
+    for start in range(0, inserts, 1000):
+        end = start + 1000
+        db.execute(Car.__table__.insert().values(rows[start:end]))
+    elapsed = time.perf_counter() - started
+    db.rollback()
+    return inserts / elapsed
+
+
+def run(
+    db: Session, *, company_id: int, branch_id: int, inserts: int, repeat: int
+) -> Dict[str, Any]:
+    report: Dict[str, Any] = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "company_id": company_id,
+        "branch_id": branch_id,
+        "queries": {},
+    }
+    for name, build in branch_queries(db, company_id, branch_id).items():
+        runs = [explain(db, build()) for _ in range(repeat)]
+        report["queries"][name] = {
+            "scans": runs[-1]["scans"],
+            "execution_ms": min(run["execution_ms"] for run in runs),
+        }
+        logger.info("%s: %s", name, report["queries"][name])
+    report["inserts_per_second"] = write_throughput(db, company_id, branch_id, inserts)
+    logger.info("inserts per second: %.0f", report["inserts_per_second"])
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--company-id", type=int, required=True)
+    parser.add_argument("--branch-id", type=int, required=True)
+    parser.add_argument("--inserts", type=int, default=5000)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Runs of every query, the fastest one is reported",
+    )
+    parser.add_argument("--output", help="Report file, printed when omitted")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        report = run(
+            db,
+            company_id=args.company_id,
+            branch_id=args.branch_id,
+            inserts=args.inserts,
+            repeat=args.repeat,
+        )
+    finally:
+        db.close()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+from typing import Any, Dict, Hashable, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+
+class Overlay(Mapping):
+    """
+    Read-only mapping made of a shared base dict and a small dict of changes on top.
+
+    Changes mapping a key to None delete it. Updates return a new overlay and
+    only copy the changes, the base is merged with them into a new dict once
+    they outgrow the square root of its size. A write costs O(sqrt(n))
+    amortized instead of a copy of the whole mapping.
+    """
+
+    def __init__(
+        self,
+        base: Dict[Hashable, Any],
+        changes: Optional[Dict[Hashable, Any]] = None,
+        size: int = -1,
+    ):
+        self.base = base
+        self.changes = changes or {}
+        self.size = len(base) if size < 0 else size
+
+    def __getitem__(self, key: Hashable) -> Any:
+        if key in self.changes:
+            value = self.changes[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.base[key]
+
+    def __contains__(self, key: object) -> bool:
+        if key in self.changes:
+            return self.changes[key] is not None
+        return key in self.base
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for key, value in self.changes.items():
+            if value is not None:
+                yield key
+        for key in self.base:
+            if key not in self.changes:
+                yield key
+
+    def __len__(self) -> int:
+        return self.size
+
+    def updated(self, changes: Dict[Hashable, Any]) -> "Overlay":
+        size = self.size + sum(
+            (value is not None) - (key in self) for key, value in changes.items()
+        )
+        merged = {**self.changes, **changes}
+        if len(merged) ** 2 <= len(self.base):
+            return Overlay(self.base, merged, size)
+        base = dict(self.base)
+        for key, value in merged.items():
+            if value is None:
+                base.pop(key, None)
+            else:
+                base[key] = value
+        return Overlay(base)
+
+
+class LSHIndex:
+    """
+    Random-projection LSH index for cosine similarity.
+
+    Every table hashes a vector to the sign pattern of `n_bits` random hyperplanes.
+    More tables raise recall, more bits make buckets smaller and queries faster,
+    and a probe radius of 1 also visits the buckets one bit flip away.
+
+    Updates return a new index that shares the untouched buckets, so readers
+    holding the previous index are never affected by a concurrent write. The
+    buckets and codes are `Overlay`s, so a write does not copy them either.
+    """
+
+    def __init__(
+        self,
+        planes: np.ndarray,
+        tables: List[Overlay],
+        codes: Overlay,
+        probe_radius: int,
+    ):
+        self.planes = planes
+        self.tables = tables
+        self.codes = codes
+        self.probe_radius = probe_radius
+        self._weights = 1 << np.arange(planes.shape[1], dtype=np.int64)
+
+    @classmethod
+    def build(
+        cls,
+        car_ids: np.ndarray,
+        vectors: np.ndarray,
+        *,
+        n_tables: int,
+        n_bits: int,
+        probe_radius: int = 1,
+        seed: int = 0,
+    ) -> "LSHIndex":
+        planes = (
+            np.random.RandomState(seed)
+            .normal(size=(n_tables, n_bits, vectors.shape[1]))
+            .astype(np.float32)
+        )
+        codes = cls(planes, [], Overlay({}), probe_radius).hash(vectors)
+        return cls.from_arrays(
+            {"planes": planes, "car_ids": car_ids, "codes": codes},
+            {"probe_radius": probe_radius},
+        )
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """
+        Flatten the index into arrays, the inverse of `from_arrays`.
+        """
+        car_ids = np.array(list(self.codes), dtype=np.int64)
+        codes = np.array(list(self.codes.values()), dtype=np.int64).reshape(
+            len(car_ids), self.planes.shape[0]
+        )
+        return {"planes": self.planes, "car_ids": car_ids, "codes": codes}, {
+            "probe_radius": self.probe_radius
+        }
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]
+    ) -> "LSHIndex":
+        car_ids, codes = arrays["car_ids"], arrays["codes"]
+        tables = []
+        for table_codes in codes.T:
+            order = np.argsort(table_codes, kind="stable")
+            unique_codes, starts = np.unique(table_codes[order], return_index=True)
+            tables.append(
+                Overlay(
+                    dict(
+                        zip(unique_codes.tolist(), np.split(car_ids[order], starts[1:]))
+                    )
+                )
+            )
+        return cls(
+            arrays["planes"],
+            tables,
+            Overlay(
+                {
+                    car_id: tuple(row)
+                    for car_id, row in zip(car_ids.tolist(), codes.tolist())
+                }
+            ),
+            meta["probe_radius"],
+        )
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def hash(self, vectors: np.ndarray) -> np.ndarray:
+        # (n_vectors, n_tables) matrix of bucket codes
+        bits = np.einsum("tbd,nd->ntb", self.planes, vectors) > 0
+        return bits.astype(np.int64) @ self._weights
+
+    def query(self, vector: np.ndarray) -> np.ndarray:
+        """
+        Return ids of the cars sharing a probed bucket with `vector`.
+        """
+        found: List[np.ndarray] = []
+        for table, code in zip(
+            self.tables, self.hash(vector.reshape(1, -1))[0].tolist()
+        ):
+            probes = [code]
+            if self.probe_radius > 0:
+                probes.extend(code ^ int(weight) for weight in self._weights)
+            found.extend(table[probe] for probe in probes if probe in table)
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def inserted(self, car_id: int, vector: np.ndarray) -> "LSHIndex":
+        return self._updated(
+            car_id, tuple(self.hash(vector.reshape(1, -1))[0].tolist())
+        )
+
+    def removed(self, car_id: int) -> "LSHIndex":
+        if car_id not in self.codes:
+            return self
+        return self._updated(car_id, None)
+
+    def _updated(self, car_id: int, new_codes: Optional[Tuple[int, ...]]) -> "LSHIndex":
+        # Only the buckets holding the old and the new codes of the car change
+        old_codes = self.codes.get(car_id)
+        tables = []
+        for position, table in enumerate(self.tables):
+            changes: Dict[Hashable, Any] = {}
+            if old_codes is not None:
+                bucket = table[old_codes[position]]
+                remaining = bucket[bucket != car_id]
+                changes[old_codes[position]] = remaining if len(remaining) else None
+            if new_codes is not None:
+                code = new_codes[position]
+                bucket = changes[code] if code in changes else table.get(code)
+                changes[code] = np.append(
+                    bucket if bucket is not None else np.zeros(0, dtype=np.int64),
+                    car_id,
+                )
+            tables.append(table.updated(changes))
+        return LSHIndex(
+            self.planes,
+            tables,
+            self.codes.updated({car_id: new_codes}),
+            self.probe_radius,
+        )
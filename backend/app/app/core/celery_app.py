@@ -2,4 +2,8 @@ from celery import Celery
 
 celery_app = Celery("worker", broker="amqp://guest@queue//")
 
-celery_app.conf.task_routes = {"app.worker.test_celery": "main-queue"}
+celery_app.conf.task_routes = {
+    "app.worker.test_celery": "main-queue",
+    "app.worker.compute_branch_similarities": "main-queue",
+    "app.worker.refresh_car_similarities": "main-queue",
+}
@@ -0,0 +1,254 @@
+import abc
+import heapq
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
+
+from app.core.config import settings
+from app.models.user_interaction import InteractionType
+
+# A like says more about a user's taste than a view
+INTERACTION_WEIGHTS = {
+    InteractionType.VIEW: settings.COLLABORATIVE_VIEW_WEIGHT,
+    InteractionType.LIKE: settings.COLLABORATIVE_LIKE_WEIGHT,
+}
+
+
+class InteractionModel(abc.ABC):
+    """
+    Base class of models maintained incrementally from user interactions.
+
+    Interactions are applied one at a time through `add` and `remove`.
+    Interactions written by other workers are picked up by `refresh`, which only
+    loads rows above the last seen id (minus a small window for transactions
+    that committed out of order). The first `refresh` loads the whole history,
+    events recorded before it are ignored as the full load reads them from the
+    database.
+
+    When `rebuild_seconds` is set, the model is also rebuilt from scratch once
+    that old, to drop removals and updates of other workers this process never
+    saw. Rebuilds build a new state outside the model lock and swap it in, so
+    requests keep reading the previous state meanwhile. Adds recorded during a
+    rebuild are picked up again by the next `refresh`, other changes wait for
+    the following rebuild. 0 disables these rebuilds.
+    """
+
+    def __init__(self, *, rebuild_seconds: int, lookback: int = 100):
+        self.rebuild_seconds = rebuild_seconds
+        self.lookback = lookback
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._seen_ids: Set[int] = set()
+            self._watermark = 0
+            self._loaded = False
+            self._built_at = time.monotonic()
+            self._state = self._new_state()
+
+    def refresh(self, load_since: Callable[[int], Iterable[Any]]) -> None:
+        """
+        Apply interactions returned by `load_since(id)`, ordered by id.
+        """
+        if self._needs_rebuild() and self._rebuild_lock.acquire(
+            blocking=not self._loaded
+        ):
+            # Only the first load makes requests wait,
+            # later rebuilds run while the old state is served
+            try:
+                if self._needs_rebuild():
+                    self._rebuild(load_since)
+            finally:
+                self._rebuild_lock.release()
+            return
+
+        with self._lock:
+            for interaction in load_since(max(0, self._watermark - self.lookback)):
+                self.add(interaction)
+            self._seen_ids = {
+                id for id in self._seen_ids if id > self._watermark - self.lookback
+            }
+
+    def _needs_rebuild(self) -> bool:
+        with self._lock:
+            if not self._loaded:
+                return True
+            return (
+                bool(self.rebuild_seconds)
+                and time.monotonic() - self._built_at > self.rebuild_seconds
+            )
+
+    def _rebuild(self, load_since: Callable[[int], Iterable[Any]]) -> None:
+        built_at = time.monotonic()
+        state = self._new_state()
+        seen_ids: Set[int] = set()
+        watermark = 0
+        for interaction in load_since(0):
+            if interaction.id in seen_ids:
+                continue
+            seen_ids.add(interaction.id)
+            watermark = max(watermark, interaction.id)
+            self._apply(state, interaction, 1)
+        with self._lock:
+            self._state = state
+            self._seen_ids = {id for id in seen_ids if id > watermark - self.lookback}
+            self._watermark = watermark
+            self._built_at = built_at
+            self._loaded = True
+
+    def add(self, interaction: Any) -> None:
+        with self._lock:
+            if not self._loaded:
+                return
+            if (
+                interaction.id in self._seen_ids
+                or interaction.id <= self._watermark - self.lookback
+            ):
+                return
+            self._seen_ids.add(interaction.id)
+            self._watermark = max(self._watermark, interaction.id)
+            self._apply(self._state, interaction, 1)
+
+    def remove(self, interaction: Any) -> None:
+        with self._lock:
+            if not self._loaded:
+                return
+            if (
+                interaction.id not in self._seen_ids
+                and interaction.id > self._watermark - self.lookback
+            ):
+                # Never applied, nothing to undo
+                return
+            self._seen_ids.discard(interaction.id)
+            self._apply(self._state, interaction, -1)
+
+    def replace(self, previous: Any, interaction: Any) -> None:
+        """
+        Swap the previous state of an updated interaction for its new one.
+
+        Unlike `remove` followed by `add`, this also works for interactions
+        older than the lookback window, which `add` no longer accepts.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            if (
+                interaction.id not in self._seen_ids
+                and interaction.id > self._watermark - self.lookback
+            ):
+                # Never applied, the next refresh loads the new state
+                return
+            self._apply(self._state, previous, -1)
+            self._apply(self._state, interaction, 1)
+
+    @abc.abstractmethod
+    def _new_state(self) -> Any:
+        """
+        Empty state of the model.
+        """
+
+    @abc.abstractmethod
+    def _apply(self, state: Any, interaction: Any, delta: int) -> None:
+        """
+        Add (`delta` 1) or subtract (`delta` -1) an interaction from `state`.
+        """
+
+
+class CoOccurrences:
+    """
+    Co-occurrence counts of the cars of one branch and the cars each user
+    interacted with there.
+    """
+
+    def __init__(self) -> None:
+        self.matrix: Dict[int, Dict[int, float]] = {}
+        self.user_cars: Dict[int, Dict[int, Counter]] = {}
+
+
+class CoOccurrenceModel(InteractionModel):
+    """
+    Sparse item-item co-occurrence matrices built from user interactions,
+    one per branch.
+
+    A user's weight for a car is the weight of the strongest interaction type
+    recorded for it, and two cars co-occur with the product of their weights
+    summed over all users who interacted with both in the same branch.
+    Recording an event only touches the cars of that user.
+    """
+
+    def __init__(
+        self,
+        *,
+        weights: Dict[InteractionType, float],
+        rebuild_seconds: int,
+        lookback: int = 100
+    ):
+        self.weights = weights
+        super().__init__(rebuild_seconds=rebuild_seconds, lookback=lookback)
+
+    def _new_state(self) -> Dict[Tuple[int, int], CoOccurrences]:
+        return {}
+
+    def top_k(
+        self, company_id: int, branch_id: int, car_id: int, k: int
+    ) -> List[Tuple[int, float]]:
+        with self._lock:
+            branch = self._state.get((company_id, branch_id))
+            row = branch.matrix.get(car_id, {}) if branch is not None else {}
+            return heapq.nlargest(k, row.items(), key=lambda item: item[1])
+
+    def _weight(self, counts: Counter) -> float:
+        return max(
+            (self.weights[interaction_type] for interaction_type in counts), default=0.0
+        )
+
+    def _apply(
+        self, state: Dict[Tuple[int, int], CoOccurrences], interaction: Any, delta: int
+    ) -> None:
+        branch_key = (interaction.company_id, interaction.branch_id)
+        branch = state.setdefault(branch_key, CoOccurrences())
+        user_id, car_id = interaction.user_id, interaction.car_id
+        interaction_type = InteractionType(interaction.interaction_type)
+        cars = branch.user_cars.setdefault(user_id, {})
+        counts = cars.setdefault(car_id, Counter())
+        old_weight = self._weight(counts)
+        counts[interaction_type] += delta
+        if counts[interaction_type] <= 0:
+            del counts[interaction_type]
+        new_weight = self._weight(counts)
+        if not counts:
+            del cars[car_id]
+            if not cars:
+                del branch.user_cars[user_id]
+
+        change = new_weight - old_weight
+        if change:
+            for other_car_id, other_counts in cars.items():
+                if other_car_id == car_id:
+                    continue
+                contribution = change * self._weight(other_counts)
+                self._add(branch, car_id, other_car_id, contribution)
+                self._add(branch, other_car_id, car_id, contribution)
+        if not branch.user_cars and not branch.matrix:
+            del state[branch_key]
+
+    def _add(
+        self, branch: CoOccurrences, car_id: int, other_car_id: int, value: float
+    ) -> None:
+        row = branch.matrix.setdefault(car_id, {})
+        total = row.get(other_car_id, 0.0) + value
+        if total > 1e-9:
+            row[other_car_id] = total
+        else:
+            row.pop(other_car_id, None)
+            if not row:
+                del branch.matrix[car_id]
+
+
+co_occurrence = CoOccurrenceModel(
+    weights=INTERACTION_WEIGHTS,
+    rebuild_seconds=settings.COLLABORATIVE_REBUILD_SECONDS,
+)
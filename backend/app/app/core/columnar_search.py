@@ -0,0 +1,350 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.car import FuelType, Transmission
+from app.schemas.car import CarFilters
+
+# Columns held per branch, in the order of the rows passed to `BranchColumns.build`
+COLUMNS = (
+    "id",
+    "make",
+    "model",
+    "price",
+    "year",
+    "kilometers",
+    "fuel_type",
+    "transmission",
+    "color",
+    "seats",
+)
+# Type of every column, declared so an empty branch gets the same columns as a full one.
+# Enum and string columns are held as object arrays of their Python values
+COLUMN_DTYPES: Dict[str, Any] = {
+    "id": np.int64,
+    "make": object,
+    "model": object,
+    "price": np.float64,
+    "year": np.int64,
+    "kilometers": np.int64,
+    "fuel_type": object,
+    "transmission": object,
+    "color": object,
+    "seats": np.int64,
+}
+# Columns with a bitmap per distinct value
+BITMAP_COLUMNS = ("make", "color", "fuel_type", "transmission", "seats")
+
+
+class BranchColumns:
+    """
+    Cars of a branch held as NumPy column arrays, ordered by id.
+
+    Every distinct value of the bitmap columns has a packed bitmap of the
+    rows holding it. Equality filters pick bitmaps, range filters compare
+    whole columns, and the results are combined with bitwise AND. Instances
+    are never modified, writes return a new instance so running searches
+    keep a consistent view.
+    """
+
+    def __init__(self, data_version: Optional[int], columns: Dict[str, np.ndarray]):
+        self.data_version = data_version
+        self.columns = columns
+        self.size = len(columns["id"])
+        self.bitmaps: Dict[str, Dict[Any, np.ndarray]] = {}
+        for name in BITMAP_COLUMNS:
+            values, inverse = np.unique(columns[name], return_inverse=True)
+            self.bitmaps[name] = {
+                value: np.packbits(inverse == code)
+                for code, value in enumerate(values.tolist())
+            }
+
+    @classmethod
+    def build(
+        cls, data_version: Optional[int], rows: Sequence[Sequence[Any]]
+    ) -> "BranchColumns":
+        return cls(
+            data_version,
+            {
+                name: np.array([row[index] for row in rows], dtype=COLUMN_DTYPES[name])
+                for index, name in enumerate(COLUMNS)
+            },
+        )
+
+    def upserted(self, car: Any, data_version: Optional[int]) -> "BranchColumns":
+        ids = self.columns["id"]
+        position = int(np.searchsorted(ids, car.id))
+        exists = position < self.size and ids[position] == car.id
+        columns = {}
+        for name, column in self.columns.items():
+            value = getattr(car, name)
+            if exists:
+                column = column.copy()
+                column[position] = value
+            else:
+                column = np.insert(column, position, value)
+            columns[name] = column
+        return BranchColumns(data_version, columns)
+
+    def removed(self, car_id: int, data_version: Optional[int]) -> "BranchColumns":
+        position = int(np.searchsorted(self.columns["id"], car_id))
+        if position == self.size or self.columns["id"][position] != car_id:
+            return BranchColumns(data_version, self.columns)
+        return BranchColumns(
+            data_version,
+            {
+                name: np.delete(column, position)
+                for name, column in self.columns.items()
+            },
+        )
+
+    def search(
+        self,
+        filters: CarFilters,
+        *,
+        sort: Optional[str] = None,
+        after: Optional[List[Any]] = None,
+        skip: int = 0,
+        limit: Optional[int] = 100
+    ) -> List[Dict[str, Any]]:
+        """
+        Rows matching the filters as dicts, in the order and pages of
+        `CRUDCar.search_by_filters`.
+
+        Rows are ordered by the sort column and id, `after` holds the key
+        values of the row the page continues after.
+        """
+        columns = self.columns
+        rows = self.match(filters)
+        ids = columns["id"][rows]
+        descending = bool(sort and sort.startswith("-"))
+        keys = columns[sort.lstrip("-")][rows] if sort else ids
+        if after is not None:
+            key, car_id = (after[0], after[-1])
+            if descending:
+                keep = (keys < key) | ((keys == key) & (ids < car_id))
+            else:
+                keep = (keys > key) | ((keys == key) & (ids > car_id))
+            rows, ids, keys = rows[keep], ids[keep], keys[keep]
+        order = np.lexsort((ids, keys))
+        if descending:
+            order = order[::-1]
+        end = None if limit is None else skip + limit
+        page = rows[order[skip:end]]
+        return [
+            {name: value for name, value in zip(COLUMNS, values)}
+            for values in zip(*[columns[name][page].tolist() for name in COLUMNS])
+        ]
+
+    def match(self, filters: CarFilters) -> np.ndarray:
+        """
+        Positions of the rows matching the filters, ignoring falsy filters like in SQL.
+        """
+        columns = self.columns
+        bitmaps = []
+        for name, values, excluded in (
+            ("make", filters.make, filters.make_not),
+            ("color", filters.color, filters.color_not),
+            ("fuel_type", filters.fuel_type, filters.fuel_type_not),
+            ("transmission", filters.transmission, filters.transmission_not),
+        ):
+            if values:
+                bitmaps.append(self.any_of(name, values))
+            if excluded:
+                # Padding bits past the last row are flipped as well,
+                # they are never unpacked
+                bitmaps.append(~self.any_of(name, excluded))
+        seats_min, seats_max = filters.seats_min, filters.seats_max
+        if seats_min or seats_max:
+            seats = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+            for value, bitmap in self.bitmaps["seats"].items():
+                if (not seats_min or value >= seats_min) and (
+                    not seats_max or value <= seats_max
+                ):
+                    seats |= bitmap
+            bitmaps.append(seats)
+
+        masks = []
+        if filters.model:
+            masks.append(columns["model"] == filters.model)
+        for name, lower, upper in (
+            ("year", filters.year_min, filters.year_max),
+            ("price", filters.price_min, filters.price_max),
+        ):
+            if lower:
+                masks.append(columns[name] >= lower)
+            if upper:
+                masks.append(columns[name] <= upper)
+        if masks:
+            bitmaps.append(np.packbits(np.logical_and.reduce(masks)))
+
+        if not bitmaps:
+            return np.arange(self.size)
+        return np.flatnonzero(
+            np.unpackbits(np.bitwise_and.reduce(bitmaps), count=self.size)
+        )
+
+    def any_of(self, name: str, values: Union[Any, List[Any]]) -> np.ndarray:
+        """
+        Bitmap of the rows holding any of the values of a bitmap column.
+        """
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        # Enum values may be passed as their string values
+        enum = {"fuel_type": FuelType, "transmission": Transmission}.get(name)
+        bitmap = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        for value in values:
+            value_bitmap = self.bitmaps[name].get(enum(value) if enum else value)
+            if value_bitmap is not None:
+                bitmap |= value_bitmap
+        return bitmap
+
+    def count(self, filters: CarFilters) -> int:
+        return len(self.match(filters))
+
+
+class ColumnarSearch:
+    """
+    Process-local `BranchColumns` of the most recently searched branches.
+
+    Columns are labelled with the data version of their branch and only
+    used while it matches the version in the database, so writes handled by
+    other workers are never missed. A missing or stale branch is built in a
+    background thread while its searches keep going to PostgreSQL. Writes of
+    this process are applied in place when the columns hold the version
+    right before the write.
+    """
+
+    def __init__(self, *, max_branches: int):
+        self.max_branches = max_branches
+        self._entries: "OrderedDict[Tuple[int, int], BranchColumns]" = OrderedDict()
+        self._pending: Dict[Tuple[int, int], Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "builds": 0,
+            "updates": 0,
+            "invalidations": 0,
+        }
+
+    def get(
+        self, company_id: int, branch_id: int, data_version: Optional[int]
+    ) -> Optional[BranchColumns]:
+        key = (company_id, branch_id)
+        with self._lock:
+            columns = self._entries.get(key)
+            if columns is None or columns.data_version != data_version:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return columns
+
+    def put(self, company_id: int, branch_id: int, columns: BranchColumns) -> None:
+        key = (company_id, branch_id)
+        with self._lock:
+            current = self._entries.get(key)
+            # A build may finish after writes that already moved the columns further
+            if (
+                current is not None
+                and current.data_version is not None
+                and (
+                    columns.data_version is None
+                    or current.data_version > columns.data_version
+                )
+            ):
+                return
+            self._entries[key] = columns
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_branches:
+                self._entries.popitem(last=False)
+
+    def warm(
+        self, company_id: int, branch_id: int, build: Callable[[Session], BranchColumns]
+    ) -> Future:
+        """
+        Build the columns of a branch in the background, at most once at a time.
+        """
+        key = (company_id, branch_id)
+
+        def run() -> None:
+            db = SessionLocal()
+            try:
+                self.put(company_id, branch_id, build(db))
+                with self._lock:
+                    self._stats["builds"] += 1
+            finally:
+                db.close()
+                with self._lock:
+                    del self._pending[key]
+
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(run)
+            return self._pending[key]
+
+    def upsert(
+        self, company_id: int, branch_id: int, car: Any, data_version: Optional[int]
+    ) -> None:
+        self._apply(
+            company_id,
+            branch_id,
+            data_version,
+            lambda columns: columns.upserted(car, data_version),
+        )
+
+    def remove(
+        self, company_id: int, branch_id: int, car_id: int, data_version: Optional[int]
+    ) -> None:
+        self._apply(
+            company_id,
+            branch_id,
+            data_version,
+            lambda columns: columns.removed(car_id, data_version),
+        )
+
+    def _apply(
+        self,
+        company_id: int,
+        branch_id: int,
+        data_version: Optional[int],
+        change: Callable[[BranchColumns], BranchColumns],
+    ) -> None:
+        key = (company_id, branch_id)
+        with self._lock:
+            columns = self._entries.get(key)
+            if columns is None:
+                return
+            if data_version is not None and columns.data_version == data_version - 1:
+                self._entries[key] = change(columns)
+                self._stats["updates"] += 1
+            else:
+                # Missed a write of another worker, the next search rebuilds the branch
+                del self._entries[key]
+                self._stats["invalidations"] += 1
+
+    def invalidate(self, company_id: int, branch_id: int) -> None:
+        with self._lock:
+            if self._entries.pop((company_id, branch_id), None) is not None:
+                self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["branches"] = len(self._entries)
+        return stats
+
+
+columnar_search = (
+    ColumnarSearch(max_branches=settings.SEARCH_COLUMNAR_MAX_BRANCHES)
+    if settings.SEARCH_COLUMNAR_ENABLED
+    else None
+)
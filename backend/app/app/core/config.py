@@ -82,6 +82,58 @@ class Settings(BaseSettings):
     FIRST_SUPERUSER_PASSWORD: str
     USERS_OPEN_REGISTRATION: bool = False
 
+    # Similarity engine used when a request does not choose one ("tfidf", "numeric" or "ann")
+    SIMILARITY_ENGINE: str = "tfidf"
+    # LSH parameters of the "ann" engine, more tables raise recall and more bits lower latency
+    SIMILARITY_ANN_TABLES: int = 12
+    SIMILARITY_ANN_BITS: int = 20
+    SIMILARITY_ANN_PROBE_RADIUS: int = 1
+    # Threads scoring the branch shards of company-wide similar cars
+    SIMILARITY_SHARD_WORKERS: int = 4
+    # Rank similar cars in PostgreSQL by a weighted distance instead of loading the branch,
+    # also selected per request with engine "sql"
+    SIMILARITY_IN_DATABASE: bool = False
+    SIMILARITY_SQL_WEIGHTS: Dict[str, float] = {
+        "price": 1.0, "year": 1.0, "kilometers": 1.0, "seats": 1.0,
+        "fuel_type": 1.0, "transmission": 1.0, "make": 1.0, "color": 1.0,
+    }
+    # Most cars a single batch similar cars request may ask for
+    SIMILARITY_BATCH_MAX_IDS: int = 100
+    # Top neighbours of every car are precomputed by the celery worker after each car write
+    SIMILARITY_PRECOMPUTE_ENABLED: bool = False
+    SIMILARITY_PRECOMPUTE_TOP_N: int = 100
+    # Fitted similarity features are cached per branch and engine
+    SIMILARITY_CACHE_MAX_ENTRIES: int = 64
+    SIMILARITY_CACHE_TTL_SECONDS: int = 60 * 10
+    # Directory (ideally on tmpfs such as /dev/shm) where fitted features are shared
+    # by all workers of a node as memory-mapped files, replacing the per-process cache
+    SIMILARITY_SHARED_DIR: Optional[str] = None
+    # Directory where fitted features are persisted per branch data version and
+    # loaded by restarted workers, stale branches are refitted in the background on boot
+    SIMILARITY_ARTIFACT_DIR: Optional[str] = None
+    # Worker processes scoring similar cars outside the request threads, 0 scores in-process
+    SIMILARITY_PROCESS_WORKERS: int = 0
+    SIMILARITY_PROCESS_QUEUE_SIZE: int = 32
+    SIMILARITY_PROCESS_TIMEOUT_SECONDS: float = 5.0
+
+    # Item-item co-occurrence weights of user interactions
+    COLLABORATIVE_VIEW_WEIGHT: float = 1.0
+    COLLABORATIVE_LIKE_WEIGHT: float = 3.0
+    # Interval of full rebuilds of the interaction models, which pick up removals and updates
+    # made by other workers. 0 disables them, the models then only load new interactions
+    COLLABORATIVE_REBUILD_SECONDS: int = 0
+
+    # Least pg_trgm word similarity of a misspelled car search word, where the extension is installed
+    SEARCH_TRIGRAM_THRESHOLD: float = 0.4
+    # Filter searches served in process from NumPy columns of the most recently searched branches
+    SEARCH_COLUMNAR_ENABLED: bool = False
+    SEARCH_COLUMNAR_MAX_BRANCHES: int = 32
+    # Car listing and search pages are cached per branch data version, off unless a size is set
+    SEARCH_CACHE_MAX_BYTES: int = 0
+    SEARCH_CACHE_TTL_SECONDS: int = 60
+    # Estimated search counts below this are replaced by an exact count(*)
+    SEARCH_COUNT_EXACT_BELOW: int = 1000
+
     class Config:
         case_sensitive = True
 
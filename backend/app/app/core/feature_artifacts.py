@@ -0,0 +1,154 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.filtering_utils import SIMILARITY_ENGINES, SimilarityFeatures
+from app.db.session import SessionLocal
+
+META = "meta.json"
+
+
+def write_features(path: str, features: SimilarityFeatures, **extra: Any) -> None:
+    """
+    Write fitted features into a new directory,
+    an `.npy` file per array plus `meta.json`.
+    """
+    arrays, meta = features.to_arrays()
+    os.makedirs(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(path, META), "w") as meta_file:
+        json.dump(
+            {"engine": features.engine, "arrays": list(arrays), "meta": meta, **extra},
+            meta_file,
+        )
+
+
+def read_features(path: str) -> Tuple[SimilarityFeatures, Dict[str, Any]]:
+    """
+    Map features written by `write_features` read-only into memory.
+    Raises FileNotFoundError when the directory is incomplete or gone.
+    """
+    with open(os.path.join(path, META)) as meta_file:
+        meta = json.load(meta_file)
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in meta["arrays"]
+    }
+    return SIMILARITY_ENGINES[meta["engine"]].from_arrays(arrays, meta["meta"]), meta
+
+
+class FeatureArtifacts:
+    """
+    Fitted similarity features persisted on disk, so restarted workers skip the fit.
+
+    Every artifact is labelled with the data version of its branch, which is
+    bumped by every car write. An artifact is only used while the label
+    matches the current version of the branch, older ones are deleted when a
+    newer one is saved. Until then they are served while the new features are
+    fitted in a background thread, so requests never wait for a refit of a
+    branch that was persisted before.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._pending: Dict[Tuple[int, int, str], Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+
+    def load(
+        self, company_id: int, branch_id: int, engine: str, data_version: int
+    ) -> Optional[SimilarityFeatures]:
+        try:
+            features, _ = read_features(
+                os.path.join(
+                    self._path(company_id, branch_id, engine), str(data_version)
+                )
+            )
+        except FileNotFoundError:
+            return None
+        return features
+
+    def load_latest(
+        self, company_id: int, branch_id: int, engine: str
+    ) -> Optional[SimilarityFeatures]:
+        """
+        The most recently saved features of a branch, whatever their data version.
+        """
+        path = self._path(company_id, branch_id, engine)
+        try:
+            versions = [int(name) for name in os.listdir(path) if name.isdigit()]
+            if not versions:
+                return None
+            features, _ = read_features(os.path.join(path, str(max(versions))))
+        except FileNotFoundError:
+            return None
+        return features
+
+    def refit(
+        self,
+        company_id: int,
+        branch_id: int,
+        engine: str,
+        build: Callable[[Session], None],
+    ) -> Future:
+        """
+        Run `build` in the background with its own session,
+        at most once at a time per branch and engine.
+        """
+        key = (company_id, branch_id, engine)
+
+        def run() -> None:
+            db = SessionLocal()
+            try:
+                build(db)
+            finally:
+                db.close()
+                with self._lock:
+                    del self._pending[key]
+
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(run)
+            return self._pending[key]
+
+    def save(
+        self,
+        company_id: int,
+        branch_id: int,
+        engine: str,
+        data_version: int,
+        features: SimilarityFeatures,
+    ) -> None:
+        path = self._path(company_id, branch_id, engine)
+        # Artifacts are written aside and renamed,
+        # so a crash never leaves a partial one behind
+        tmp_path = os.path.join(path, f".tmp-{os.getpid()}-{time.time_ns()}")
+        write_features(tmp_path, features, data_version=data_version)
+        try:
+            os.rename(tmp_path, os.path.join(path, str(data_version)))
+        except OSError:
+            # Another worker saved the same version first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        for name in os.listdir(path):
+            if name.isdigit() and int(name) < data_version:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    def _path(self, company_id: int, branch_id: int, engine: str) -> str:
+        return os.path.join(self.directory, f"{company_id}-{branch_id}", engine)
+
+
+feature_artifacts = (
+    FeatureArtifacts(settings.SIMILARITY_ARTIFACT_DIR)
+    if settings.SIMILARITY_ARTIFACT_DIR
+    else None
+)
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.core.config import settings
+
+CacheKey = Tuple[int, int, str]
+
+
+class FeatureCache:
+    """
+    Process-local cache of fitted similarity features, one entry per branch and engine.
+
+    Entries are labelled with the data version of their branch and only used
+    while it matches the version passed to `get`, so writes handled by other
+    workers are never missed. Writes of this process are applied in place to
+    features that support incremental updates when they hold the version right
+    before the write, other entries of the branch are dropped. Entries expire
+    after `ttl` seconds and the least recently used entry is evicted once
+    `max_entries` is reached.
+    """
+
+    def __init__(self, *, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Optional[int], Any]]" = (
+            OrderedDict()
+        )
+        self._generations: Dict[Tuple[int, int], int] = {}
+        self._epoch = 0
+        self._build_locks: Dict[CacheKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, float] = {}
+        self.reset_stats()
+
+    def get(
+        self,
+        company_id: int,
+        branch_id: int,
+        engine: str,
+        build: Callable[[], Any],
+        data_version: Optional[int] = None,
+    ) -> Any:
+        key = (company_id, branch_id, engine)
+        features = self._lookup(key, data_version)
+        if features is not None:
+            return features
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # Only one thread builds a given entry, the others wait and reuse its result
+        with build_lock:
+            features = self._lookup(key, data_version, count=False)
+            if features is not None:
+                return features
+            with self._lock:
+                self._stats["misses"] += 1
+                generation = self._generation(company_id, branch_id)
+
+            started = time.perf_counter()
+            features = build()
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                self._stats["rebuilds"] += 1
+                self._stats["rebuild_seconds_total"] += elapsed
+                self._stats["rebuild_seconds_last"] = elapsed
+                self._stats["rebuild_seconds_max"] = max(
+                    self._stats["rebuild_seconds_max"], elapsed
+                )
+                # A write that happened during the build makes the result stale already
+                if self._generation(company_id, branch_id) == generation:
+                    self._entries[key] = (time.monotonic(), data_version, features)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self._stats["evictions"] += 1
+            return features
+
+    def _generation(self, company_id: int, branch_id: int) -> Tuple[int, int]:
+        return self._epoch, self._generations.get((company_id, branch_id), 0)
+
+    def _lookup(
+        self, key: CacheKey, data_version: Optional[int], count: bool = True
+    ) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                entry = None
+            elif entry is not None and entry[1] != data_version:
+                # Written by another worker, the caller rebuilds the entry
+                del self._entries[key]
+                self._stats["invalidations"] += 1
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self._stats["hits"] += 1
+            return entry[2]
+
+    def upsert(
+        self,
+        company_id: int,
+        branch_id: int,
+        car: Any,
+        data_version: Optional[int] = None,
+    ) -> None:
+        self._apply(
+            company_id, branch_id, data_version, lambda features: features.upserted(car)
+        )
+
+    def remove(
+        self,
+        company_id: int,
+        branch_id: int,
+        car_id: int,
+        data_version: Optional[int] = None,
+    ) -> None:
+        self._apply(
+            company_id,
+            branch_id,
+            data_version,
+            lambda features: features.removed(car_id),
+        )
+
+    def _apply(
+        self,
+        company_id: int,
+        branch_id: int,
+        data_version: Optional[int],
+        change: Callable[[Any], Any],
+    ) -> None:
+        with self._lock:
+            branch_key = (company_id, branch_id)
+            self._generations[branch_key] = self._generations.get(branch_key, 0) + 1
+            for key in [key for key in self._entries if key[:2] == branch_key]:
+                created, label, features = self._entries[key]
+                if (
+                    getattr(features, "incremental", False)
+                    and data_version is not None
+                    and label is not None
+                    and label == data_version - 1
+                ):
+                    self._entries[key] = (created, data_version, change(features))
+                    self._stats["incremental_updates"] += 1
+                else:
+                    del self._entries[key]
+                    self._stats["invalidations"] += 1
+
+    def invalidate(self, company_id: int, branch_id: int) -> None:
+        with self._lock:
+            branch_key = (company_id, branch_id)
+            self._generations[branch_key] = self._generations.get(branch_key, 0) + 1
+            for key in [key for key in self._entries if key[:2] == branch_key]:
+                del self._entries[key]
+                self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {
+                "hits": 0,
+                "misses": 0,
+                "rebuilds": 0,
+                "invalidations": 0,
+                "incremental_updates": 0,
+                "expirations": 0,
+                "evictions": 0,
+                "rebuild_seconds_total": 0.0,
+                "rebuild_seconds_last": 0.0,
+                "rebuild_seconds_max": 0.0,
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+feature_cache = FeatureCache(
+    max_entries=settings.SIMILARITY_CACHE_MAX_ENTRIES,
+    ttl=settings.SIMILARITY_CACHE_TTL_SECONDS,
+)
@@ -1,26 +1,535 @@
-from typing import List
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Type, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import linear_kernel
 
-from app.models.car import Car
+from app.core.ann_index import LSHIndex
+from app.core.config import settings
+from app.models.car import Car, FuelType, Transmission
+
+NUMERIC_COLUMNS = ("price", "year", "kilometers", "seats")
+CATEGORICAL_COLUMNS = ("fuel_type", "transmission", "make", "color")
+
+
+def car_to_text(car: Any) -> str:
+    # Convert car features into a text description
+    return f"{car.make} {car.price} {car.year} {car.kilometers} {car.fuel_type} {car.transmission} {car.color} {car.seats}"
 
 
 def content_filtering(target_car: Car, all_cars: List[Car]) -> List[Car]:
     # Convert target car features into a text description
-    target_car_text = f"{target_car.make} {target_car.price} {target_car.year} {target_car.kilometers} {target_car.fuel_type} {target_car.transmission} {target_car.color} {target_car.seats}"
+    target_car_text = car_to_text(target_car)
 
     # Create a list of text features for all cars
-    all_car_texts = [f"{car.make} {car.price} {car.year} {car.kilometers} {car.fuel_type} {car.transmission} {car.color} {car.seats}" for car in all_cars]
+    all_car_texts = [car_to_text(car) for car in all_cars]
 
     # Use TF-IDF vectorization to convert the text features into numerical representations
     vectorizer = TfidfVectorizer()
     tfidf_matrix = vectorizer.fit_transform([target_car_text] + all_car_texts)
 
     # Compute the cosine similarity between the target car and all other cars
-    cosine_similarities = linear_kernel(tfidf_matrix[0:1], tfidf_matrix).flatten()
+    cosine_similarities = linear_kernel(tfidf_matrix[0:1], tfidf_matrix[1:]).flatten()
 
     # Sort the cars based on their similarity score in descending order
-    similar_car_indices = cosine_similarities.argsort()[::-1][1:]  # Exclude the target car itself
-    similar_cars = [all_cars[index] for index in similar_car_indices]
+    similar_car_indices = cosine_similarities.argsort()[::-1]
+    similar_cars = [
+        all_cars[index] for index in similar_car_indices
+        if all_cars[index].id != target_car.id  # Exclude the target car itself
+    ]
+
+    return similar_cars
+
+
+class TfidfFeatures:
+    """
+    TF-IDF representation of a branch inventory.
+
+    The vectorizer is fitted once over all cars of the branch so that later
+    requests only have to score the target car against the stored matrix.
+    """
+
+    engine = "tfidf"
+    # The vocabulary changes with the inventory, so writes require a refit
+    incremental = False
+
+    def __init__(self, car_ids: np.ndarray, vectorizer: Optional[TfidfVectorizer], matrix: Any):
+        self.car_ids = car_ids
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.row_by_id: Dict[int, int] = {
+            car_id: row for row, car_id in enumerate(car_ids.tolist())
+        }
+
+    @classmethod
+    def fit(cls, cars: Sequence[Any]) -> "TfidfFeatures":
+        car_ids = np.array([car.id for car in cars], dtype=np.int64)
+        if not cars:
+            return cls(car_ids, None, None)
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform([car_to_text(car) for car in cars])
+        return cls(car_ids, vectorizer, matrix)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """
+        Split the features into arrays and JSON serializable metadata,
+        the inverse of `from_arrays`.
+        """
+        if self.vectorizer is None:
+            return {"car_ids": self.car_ids}, {}
+        arrays = {
+            "car_ids": self.car_ids,
+            "idf": self.vectorizer.idf_,
+            "data": self.matrix.data,
+            "indices": self.matrix.indices,
+            "indptr": self.matrix.indptr,
+        }
+        vocabulary = {term: int(column) for term, column in self.vectorizer.vocabulary_.items()}
+        return arrays, {"vocabulary": vocabulary, "shape": list(self.matrix.shape)}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "TfidfFeatures":
+        if "vocabulary" not in meta:
+            return cls(arrays["car_ids"], None, None)
+        vectorizer = TfidfVectorizer(vocabulary=meta["vocabulary"])
+        vectorizer.idf_ = arrays["idf"]
+        # The sparse matrix keeps referencing the provided arrays without copying them
+        matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"]))
+        return cls(arrays["car_ids"], vectorizer, matrix)
+
+    def __len__(self) -> int:
+        return len(self.car_ids)
+
+    def encode(self, cars: Sequence[Any]) -> Any:
+        if self.vectorizer is None:
+            # A branch without cars has no vocabulary to encode with
+            return csr_matrix((len(cars), 0))
+        return self.vectorizer.transform([car_to_text(car) for car in cars])
+
+    def vectorize(self, car: Any) -> Any:
+        # Reuse the stored row when the car is part of the fitted inventory
+        row = self.row_by_id.get(getattr(car, "id", -1))
+        if row is not None:
+            return self.matrix[row]
+        return self.encode([car])
+
+    def scores(self, vectors: Any, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return linear_kernel(vectors, matrix)
+
+
+class SortedRows(Mapping[int, int]):
+    """
+    Rows of the ids of a sorted id array, found with a binary search so no
+    dictionary has to be built for every version of the features.
+    """
+
+    def __init__(self, car_ids: np.ndarray):
+        self.car_ids = car_ids
+
+    def __getitem__(self, car_id: Any) -> int:
+        if car_id is not None:
+            row = int(np.searchsorted(self.car_ids, car_id))
+            if row < len(self.car_ids) and self.car_ids[row] == car_id:
+                return row
+        raise KeyError(car_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.car_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.car_ids)
+
+
+class RowBuffer:
+    """
+    Car ids and rows with spare capacity, shared by successive versions of `NumericFeatures`.
+
+    Every version sees a prefix of the rows, only the version holding all
+    `size` rows may append, other versions copy the buffer first.
+    """
+
+    def __init__(self, car_ids: np.ndarray, matrix: np.ndarray, capacity: int):
+        self.size = len(car_ids)
+        self.car_ids = np.empty(capacity, dtype=np.int64)
+        self.car_ids[:self.size] = car_ids
+        self.matrix = np.empty((capacity, matrix.shape[1]), dtype=matrix.dtype)
+        self.matrix[:self.size] = matrix
+
+    def __len__(self) -> int:
+        return len(self.car_ids)
+
+
+class NumericFeatures:
+    """
+    Dense representation of a branch inventory.
+
+    Numeric columns are standardized with the branch mean and deviation and
+    categorical columns are one-hot encoded. Rows are L2 normalized, so a single
+    matrix-vector product yields the cosine similarity to every car.
+    """
+
+    engine = "numeric"
+    incremental = True
+
+    def __init__(
+        self,
+        car_ids: np.ndarray,
+        matrix: np.ndarray,
+        mean: np.ndarray,
+        scale: np.ndarray,
+        categories: Tuple[Tuple[str, ...], ...],
+    ):
+        self.car_ids = car_ids
+        self.matrix = matrix
+        self.mean = mean
+        self.scale = scale
+        self.categories = categories
+        self.row_by_id = SortedRows(car_ids)
+        # Buffer the ids and matrix are views of, set once the features were written to
+        self._buffer: Optional[RowBuffer] = None
+
+    @classmethod
+    def fit(cls, cars: Sequence[Any]) -> "NumericFeatures":
+        # Rows are kept sorted by car id so ids can be mapped to rows with a binary search
+        cars = sorted(cars, key=lambda car: car.id)
+        car_ids = np.array([car.id for car in cars], dtype=np.int64)
+        numeric = _numeric_values(cars)
+        mean = numeric.mean(axis=0) if len(cars) else np.zeros(len(NUMERIC_COLUMNS))
+        scale = numeric.std(axis=0) if len(cars) else np.ones(len(NUMERIC_COLUMNS))
+        scale[scale == 0] = 1.0
+        categories = (
+            tuple(fuel_type.value for fuel_type in FuelType),
+            tuple(transmission.value for transmission in Transmission),
+            tuple(sorted({category_value(car.make) for car in cars})),
+            tuple(sorted({category_value(car.color) for car in cars})),
+        )
+        features = cls(car_ids, np.zeros((0, 0), dtype=np.float32), mean, scale, categories)
+        features.matrix = features.encode(cars)
+        return features
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays = {"car_ids": self.car_ids, "matrix": self.matrix, "mean": self.mean, "scale": self.scale}
+        return arrays, {"categories": [list(categories) for categories in self.categories]}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "NumericFeatures":
+        categories = tuple(tuple(categories) for categories in meta["categories"])
+        return cls(arrays["car_ids"], arrays["matrix"], arrays["mean"], arrays["scale"], categories)
+
+    def __len__(self) -> int:
+        return len(self.car_ids)
+
+    def encode(self, cars: Sequence[Any]) -> np.ndarray:
+        blocks = [(_numeric_values(cars) - self.mean) / self.scale]
+        for column, categories in zip(CATEGORICAL_COLUMNS, self.categories):
+            index = {value: position for position, value in enumerate(categories)}
+            one_hot = np.zeros((len(cars), len(categories)))
+            for row, car in enumerate(cars):
+                position = index.get(category_value(getattr(car, column)))
+                if position is not None:
+                    one_hot[row, position] = 1.0
+            blocks.append(one_hot)
+        return _normalize_rows(np.hstack(blocks)).astype(np.float32)
+
+    def encode_profile(
+        self, numeric_mean: np.ndarray, category_weights: Sequence[Dict[str, float]]
+    ) -> np.ndarray:
+        """
+        Encode an average of several cars, given as the mean of the numeric
+        columns and the share of every categorical value.
+        """
+        blocks = [((numeric_mean - self.mean) / self.scale).reshape(1, -1)]
+        for categories, weights in zip(self.categories, category_weights):
+            blocks.append(np.array([[weights.get(value, 0.0) for value in categories]]))
+        return _normalize_rows(np.hstack(blocks)).astype(np.float32)
+
+    def vectorize(self, car: Any) -> np.ndarray:
+        # Reuse the stored row when the car is part of the fitted inventory
+        row = self.row_by_id.get(getattr(car, "id", -1))
+        if row is not None:
+            return self.matrix[row:row + 1]
+        return self.encode([car])
+
+    def scores(self, vectors: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return vectors @ matrix.T
+
+    def upserted(self, car: Any) -> "NumericFeatures":
+        """
+        Return features including the current state of `car`.
+
+        The car is encoded with the fitted scaling and categories, values unseen
+        at fit time only contribute through the numeric columns until the next refit.
+        New cars have the highest id of the branch and are appended into spare
+        rows, which are doubled when full, and updated cars are overwritten in
+        place. Both are also seen by the previous version, which stays
+        consistent otherwise as it never reads past its own rows. Only the
+        first write to fitted or loaded features copies the matrix, as do
+        writes to a version that is not the newest one and inserts of older
+        ids. The feature stores only apply writes to the branches they hold,
+        cold branches are fitted on their next lookup instead.
+        """
+        vector = self.encode([car])[0]
+        size = len(self)
+        row = self.row_by_id.get(car.id)
+        if row is not None:
+            if np.array_equal(self.matrix[row], vector):
+                # Writes to columns outside the features keep the matrix
+                return self
+            buffer = self._writable_buffer(size)
+            buffer.matrix[row] = vector
+            return self._view(buffer)
+        if size and car.id < self.car_ids[-1]:
+            row = int(np.searchsorted(self.car_ids, car.id))
+            return NumericFeatures(
+                np.insert(self.car_ids, row, car.id), np.insert(self.matrix, row, vector, axis=0),
+                self.mean, self.scale, self.categories,
+            )
+        buffer = self._writable_buffer(size + 1)
+        buffer.car_ids[size] = car.id
+        buffer.matrix[size] = vector
+        buffer.size = size + 1
+        return self._view(buffer)
+
+    def _writable_buffer(self, size: int) -> RowBuffer:
+        buffer = self._buffer
+        if buffer is None or buffer.size != len(self) or size > len(buffer):
+            buffer = RowBuffer(self.car_ids, self.matrix, capacity=max(2 * size, 16))
+        return buffer
+
+    def _view(self, buffer: RowBuffer) -> "NumericFeatures":
+        features = NumericFeatures(
+            buffer.car_ids[:buffer.size], buffer.matrix[:buffer.size], self.mean, self.scale, self.categories)
+        features._buffer = buffer
+        return features
+
+    def rows_of(self, car_ids: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.car_ids, car_ids)
+
+    def removed(self, car_id: int) -> "NumericFeatures":
+        row = self.row_by_id.get(car_id)
+        if row is None:
+            return self
+        return NumericFeatures(
+            np.delete(self.car_ids, row), np.delete(self.matrix, row, axis=0),
+            self.mean, self.scale, self.categories,
+        )
+
+
+class AnnFeatures:
+    """
+    Numeric features with an LSH index on top.
+
+    Queries only rescore the cars sharing a bucket with the target, which trades
+    a little recall for latency on large branches. Passing `exact=True` to
+    `rank_similar` bypasses the index.
+    """
+
+    engine = "ann"
+    incremental = True
+
+    def __init__(self, numeric: NumericFeatures, index: LSHIndex):
+        self.numeric = numeric
+        self.index = index
+        self.car_ids = numeric.car_ids
+        self.row_by_id = numeric.row_by_id
+
+    @classmethod
+    def fit(cls, cars: Sequence[Any]) -> "AnnFeatures":
+        numeric = NumericFeatures.fit(cars)
+        index = LSHIndex.build(
+            numeric.car_ids, numeric.matrix,
+            n_tables=settings.SIMILARITY_ANN_TABLES,
+            n_bits=settings.SIMILARITY_ANN_BITS,
+            probe_radius=settings.SIMILARITY_ANN_PROBE_RADIUS,
+        )
+        return cls(numeric, index)
+
+    def to_arrays(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays, meta = self.numeric.to_arrays()
+        index_arrays, index_meta = self.index.to_arrays()
+        arrays.update({f"index_{name}": array for name, array in index_arrays.items()})
+        meta.update({f"index_{name}": value for name, value in index_meta.items()})
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "AnnFeatures":
+        index = LSHIndex.from_arrays(
+            {name[len("index_"):]: array for name, array in arrays.items() if name.startswith("index_")},
+            {name[len("index_"):]: value for name, value in meta.items() if name.startswith("index_")},
+        )
+        return cls(NumericFeatures.from_arrays(arrays, meta), index)
+
+    def __len__(self) -> int:
+        return len(self.numeric)
+
+    def encode(self, cars: Sequence[Any]) -> np.ndarray:
+        return self.numeric.encode(cars)
+
+    def vectorize(self, car: Any) -> np.ndarray:
+        return self.numeric.vectorize(car)
+
+    def scores(self, vectors: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        return self.numeric.scores(vectors, rows)
+
+    def candidates(self, vector: np.ndarray, k: int) -> Optional[np.ndarray]:
+        """
+        Return rows sharing a bucket with `vector`, or None when the probed buckets
+        hold fewer than `k` cars and an exact scan is needed to fill the page.
+        """
+        car_ids = self.index.query(vector)
+        if len(car_ids) < k:
+            return None
+        return self.numeric.rows_of(car_ids)
+
+    def upserted(self, car: Any) -> "AnnFeatures":
+        numeric = self.numeric.upserted(car)
+        return AnnFeatures(numeric, self.index.inserted(car.id, numeric.vectorize(car)[0]))
+
+    def removed(self, car_id: int) -> "AnnFeatures":
+        return AnnFeatures(self.numeric.removed(car_id), self.index.removed(car_id))
+
+
+SimilarityFeatures = Union[TfidfFeatures, NumericFeatures, AnnFeatures]
+
+SIMILARITY_ENGINES: Dict[str, Type[Any]] = {
+    TfidfFeatures.engine: TfidfFeatures,
+    NumericFeatures.engine: NumericFeatures,
+    AnnFeatures.engine: AnnFeatures,
+}
+
+# Ranks by a distance computed in PostgreSQL instead of fitted features
+SQL_ENGINE = "sql"
+
+
+def category_value(value: Any) -> str:
+    # Enum columns are compared by their value
+    return str(getattr(value, "value", value))
+
+
+def _numeric_values(cars: Sequence[Any]) -> np.ndarray:
+    return np.array(
+        [[getattr(car, column) for column in NUMERIC_COLUMNS] for car in cars],
+        dtype=np.float64,
+    ).reshape(len(cars), len(NUMERIC_COLUMNS))
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return indices of the `k` highest scores, best first, without sorting all of them.
+    """
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def rank_similar(
+    features: SimilarityFeatures, target_car: Any, *, limit: int, skip: int = 0, exact: bool = False
+) -> List[int]:
+    """
+    Return ids of the cars most similar to `target_car`, best match first.
+    The target car itself is never part of the result.
+
+    Features backed by an approximate index only score its candidates unless
+    `exact` is set.
+    """
+    scored = score_similar(features, target_car, limit=skip + limit, exact=exact)
+    return [car_id for car_id, _ in scored[skip:]]
+
+
+def score_similar(
+    features: SimilarityFeatures,
+    target_car: Any,
+    *,
+    limit: int,
+    exact: bool = False,
+    candidate_ids: Optional[Sequence[int]] = None,
+) -> List[Tuple[int, float]]:
+    """
+    Return the `limit` most similar cars with their scores, best match first.
+    Only `candidate_ids` are scored when provided, ids missing from the features are skipped.
+    """
+    if not len(features):
+        return []
+    vector = features.vectorize(target_car)
+    rows = None
+    if candidate_ids is not None:
+        rows = np.array(
+            [features.row_by_id[car_id] for car_id in candidate_ids if car_id in features.row_by_id], dtype=np.int64
+        )
+        if not len(rows):
+            return []
+    elif not exact and hasattr(features, "candidates"):
+        # One extra candidate makes up for the target car being dropped
+        rows = features.candidates(vector, limit + 1)
+    scores = np.asarray(features.scores(vector, rows), dtype=np.float64).ravel()
+    car_ids = features.car_ids if rows is None else features.car_ids[rows]
+    scores[car_ids == target_car.id] = -np.inf
+    ranked = top_k_indices(scores, limit)
+    ranked = ranked[car_ids[ranked] != target_car.id]
+    return list(zip(car_ids[ranked].tolist(), scores[ranked].tolist()))
+
+
+def score_encoded(
+    features: SimilarityFeatures, target_car: Any, cars: Sequence[Any], *, limit: int
+) -> List[Tuple[int, float]]:
+    """
+    Return the `limit` cars of `cars` most similar to `target_car` with their scores, best match first.
+
+    The cars are not part of `features`, they are encoded with its fitted
+    vocabulary or scaling, so their scores compare to those of `score_similar`.
+    """
+    if not len(features) or not cars:
+        return []
+    vectors = features.encode(cars)
+    scores = np.asarray(linear_kernel(features.vectorize(target_car), vectors), dtype=np.float64).ravel()
+    car_ids = np.array([car.id for car in cars], dtype=np.int64)
+    ranked = top_k_indices(scores, limit)
+    return list(zip(car_ids[ranked].tolist(), scores[ranked].tolist()))
+
+
+def rank_similar_many(
+    features: SimilarityFeatures, target_cars: Sequence[Any], *, limit: int, chunk_size: int = 256
+) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Return the `limit` most similar cars with their scores for every target car.
 
-    return similar_cars
\ No newline at end of file
+    Targets are scored in chunks with one matrix-matrix product each, the
+    approximate index of the "ann" engine is not used.
+    """
+    neighbours: Dict[int, List[Tuple[int, float]]] = {car.id: [] for car in target_cars}
+    if not len(features) or not target_cars:
+        return neighbours
+    # One extra neighbour makes up for the target car being dropped
+    k = min(limit + 1, len(features))
+    for start in range(0, len(target_cars), chunk_size):
+        chunk = target_cars[start:start + chunk_size]
+        scores = np.asarray(features.scores(features.encode(chunk)), dtype=np.float64)
+        target_ids = np.array([car.id for car in chunk], dtype=np.int64)
+        scores[features.car_ids[np.newaxis, :] == target_ids[:, np.newaxis]] = -np.inf
+        if k < len(features):
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(features)), (len(chunk), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        for car_id, rows, row_scores in zip(target_ids.tolist(), top, top_scores):
+            keep = np.isfinite(row_scores)
+            neighbours[car_id] = list(zip(
+                features.car_ids[rows[keep]][:limit].tolist(), row_scores[keep][:limit].tolist()
+            ))
+    return neighbours
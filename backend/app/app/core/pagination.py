@@ -0,0 +1,98 @@
+import base64
+import binascii
+import json
+from typing import Any, List, Optional, Sequence
+
+from fastapi import Response
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+# Response header holding the cursor of the next page, absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Response headers holding the number of matching items when asked for,
+# and whether it is exact
+TOTAL_COUNT_HEADER = "X-Total-Count"
+TOTAL_COUNT_EXACT_HEADER = "X-Total-Count-Exact"
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised for cursors that do not point to a row of the listing, the API answers 400.
+    """
+
+
+def decode_cursor(cursor: str, key_columns: Sequence[Any]) -> List[Any]:
+    """
+    Key values of the row a cursor points to, one per key column and of its type.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(key_columns):
+        raise InvalidCursor(cursor)
+    if not all(
+        is_key_value(value, column) for value, column in zip(values, key_columns)
+    ):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def is_key_value(value: Any, column: Any) -> bool:
+    # Compared to the column in SQL,
+    # so a value of another type fails in PostgreSQL instead
+    column = getattr(column, "expression", column)
+    if value is None:
+        return bool(column.nullable)
+    if isinstance(value, bool):
+        return False
+    python_type = column.type.python_type
+    if python_type is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, python_type)
+
+
+def seek(
+    query: Query,
+    key_columns: Sequence[Any],
+    cursor: Optional[str] = None,
+    descending: bool = False,
+) -> Query:
+    """
+    Order `query` by `key_columns` and continue after the row the cursor points to.
+
+    The last key column has to be unique (usually the id) so every row has a
+    distinct position. Rows are located with a row-value comparison, which an
+    index on the key columns serves directly no matter how deep the page is.
+    Descending pages reverse every key column, so the same index is scanned backwards.
+    """
+    if cursor is not None:
+        values = decode_cursor(cursor, key_columns)
+        position = tuple_(*key_columns)
+        query = query.filter(
+            position < tuple_(*values) if descending else position > tuple_(*values)
+        )
+    if descending:
+        return query.order_by(*[column.desc() for column in key_columns])
+    return query.order_by(*key_columns)
+
+
+def set_next_cursor(
+    response: Response, items: Sequence[Any], limit: int, key_columns: Sequence[Any]
+) -> None:
+    """
+    Point the next page cursor of the response at the last item of a full page.
+    """
+    if items and len(items) >= limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            [getattr(items[-1], column.key) for column in key_columns]
+        )
+
+
+def set_total_count(response: Response, count: int, exact: bool) -> None:
+    response.headers[TOTAL_COUNT_HEADER] = str(count)
+    response.headers[TOTAL_COUNT_EXACT_HEADER] = "true" if exact else "false"
@@ -0,0 +1,131 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from typing import Any, Callable, List, Optional, Set
+
+from app.core.config import settings
+
+
+def _warm_up() -> None:
+    # Importing the task module loads numpy, scikit-learn and the database engine
+    import app.scoring_worker  # noqa: F401
+
+
+class ScoringOverloaded(Exception):
+    """
+    Raised when the queue of the pool is full, the API answers 503.
+    """
+
+
+class ScoringTimeout(Exception):
+    """
+    Raised when a result is not ready within the timeout of the pool,
+    the API answers 504.
+    """
+
+
+class ScoringPool:
+    """
+    Process pool running CPU-bound similarity scoring outside the request threads.
+
+    Scoring holds the GIL for the whole matrix product, so running it in the
+    threads serving requests stalls cheap endpoints. Worker processes are
+    long-lived and keep their own feature cache between tasks.
+
+    At most `queue_size` tasks are pending or running, further requests are
+    rejected with `ScoringOverloaded` instead of piling up. A request waits at
+    most `timeout` seconds for its results and fails with `ScoringTimeout`
+    afterwards. Its tasks that have not started yet are cancelled and free
+    their slots, a process cannot be interrupted, so tasks already running
+    complete and keep their slots until then.
+    """
+
+    def __init__(self, *, workers: int, queue_size: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._futures: Set[Future] = set()
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process running threads may copy held locks,
+                # so workers are spawned
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_up,
+                )
+            return self._executor
+
+    def warm_up(self) -> None:
+        """
+        Start all workers ahead of the first request.
+        """
+        executor = self._get_executor()
+        for future in [executor.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise ScoringOverloaded()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+    def result(self, future: Future) -> Any:
+        return self.results([future])[0]
+
+    def results(self, futures: List[Future]) -> List[Any]:
+        """
+        Wait for the results of tasks submitted together, within one timeout.
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            return [
+                future.result(timeout=max(deadline - time.monotonic(), 0))
+                for future in futures
+            ]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise ScoringTimeout()
+
+    def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return self.result(self.submit(fn, *args))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pending, self._futures = list(self._futures), set()
+        # `cancel_futures` of `shutdown` needs Python 3.9,
+        # tasks not started yet are cancelled one by one
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+scoring_pool = (
+    ScoringPool(
+        workers=settings.SIMILARITY_PROCESS_WORKERS,
+        queue_size=settings.SIMILARITY_PROCESS_QUEUE_SIZE,
+        timeout=settings.SIMILARITY_PROCESS_TIMEOUT_SECONDS,
+    )
+    if settings.SIMILARITY_PROCESS_WORKERS
+    else None
+)
@@ -0,0 +1,98 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Dict, Hashable, List, Mapping, Optional, Tuple
+
+from app.core.config import settings
+
+Rows = Tuple[Mapping[str, Any], ...]
+
+
+def rows_size(rows: Rows) -> int:
+    # Rough footprint of the cached rows, the values are small scalars and strings
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+        for row in rows
+    )
+
+
+class SearchCache:
+    """
+    Process-local cache of car listing and search pages.
+
+    Keys carry the data version of the branch, which every car write bumps,
+    so a write makes the older pages of its branch unreachable without
+    scanning for them. They leave the cache through the LRU eviction, which
+    keeps the estimated size of the rows under `max_bytes`, or expire after
+    `ttl` seconds. Cached rows are read-only, callers build their own
+    objects from them.
+    """
+
+    def __init__(self, *, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Rows]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {}
+        self.reset_stats()
+
+    def get(self, key: Hashable) -> Optional[Rows]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self._drop(key)
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[2]
+
+    def put(self, key: Hashable, rows: List[Dict[str, Any]]) -> None:
+        cached = tuple(MappingProxyType(dict(row)) for row in rows)
+        size = rows_size(cached)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), size, cached)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _drop(self, key: Hashable) -> None:
+        self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+search_cache = (
+    SearchCache(
+        max_bytes=settings.SEARCH_CACHE_MAX_BYTES, ttl=settings.SEARCH_CACHE_TTL_SECONDS
+    )
+    if settings.SEARCH_CACHE_MAX_BYTES > 0
+    else None
+)
@@ -0,0 +1,216 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from app.core.config import settings
+from app.core.feature_artifacts import read_features, write_features
+from app.core.filtering_utils import SIMILARITY_ENGINES
+
+CURRENT = "CURRENT"
+
+
+class SharedFeatureStore:
+    """
+    Fitted similarity features shared by all workers of a node through
+    memory-mapped files.
+
+    Every branch and engine has a directory holding immutable versions, each
+    one an `.npy` file per array plus a `meta.json`, and a `CURRENT` file naming
+    the version in use. Workers map the arrays read-only, so the page cache
+    holds a single copy of every matrix no matter how many workers use it.
+
+    A new version is written next to the old one and published by atomically
+    replacing `CURRENT`. Readers check `CURRENT` on every lookup and remap when
+    it changed. Builds and writes of a branch are serialized by a file lock, so
+    only one worker of the node fits a branch at a time.
+
+    Versions are labelled with the data version of their branch. A lookup
+    passing the current data version refits the branch when the published
+    version is older, so writes handled on other nodes are never missed. A
+    write is applied in place only when the published version is the one
+    right before it, otherwise the branch is dropped and refitted on demand.
+    """
+
+    def __init__(self, directory: str, *, keep_versions: int = 2):
+        self.directory = directory
+        self.keep_versions = keep_versions
+        self._mapped: Dict[Tuple[int, int, str], Tuple[str, Optional[int], Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        company_id: int,
+        branch_id: int,
+        engine: str,
+        build: Callable[[], Any],
+        data_version: Optional[int] = None,
+    ) -> Any:
+        """
+        Features of a branch, built and published when missing or older than
+        `data_version`.
+        """
+        path = self._path(company_id, branch_id, engine)
+        loaded = self._load_current(company_id, branch_id, engine)
+        if loaded is not None and self._is_current(loaded[0], data_version):
+            return loaded[1]
+
+        with self._file_lock(company_id, branch_id):
+            # Another worker may have published the branch while this one waited
+            loaded = self._load_current(company_id, branch_id, engine)
+            if loaded is None or not self._is_current(loaded[0], data_version):
+                features = build()
+                version = self._publish(path, features, data_version)
+                # Served from the mapped files, unless a newer version replaced them
+                loaded = self._load(company_id, branch_id, engine, version)
+                if loaded is None:
+                    return features
+            return loaded[1]
+
+    def upsert(
+        self,
+        company_id: int,
+        branch_id: int,
+        car: Any,
+        data_version: Optional[int] = None,
+    ) -> None:
+        self._apply(
+            company_id, branch_id, data_version, lambda features: features.upserted(car)
+        )
+
+    def remove(
+        self,
+        company_id: int,
+        branch_id: int,
+        car_id: int,
+        data_version: Optional[int] = None,
+    ) -> None:
+        self._apply(
+            company_id,
+            branch_id,
+            data_version,
+            lambda features: features.removed(car_id),
+        )
+
+    def _apply(
+        self,
+        company_id: int,
+        branch_id: int,
+        data_version: Optional[int],
+        change: Callable[[Any], Any],
+    ) -> None:
+        with self._file_lock(company_id, branch_id):
+            for engine, features_cls in SIMILARITY_ENGINES.items():
+                path = self._path(company_id, branch_id, engine)
+                loaded = self._load_current(company_id, branch_id, engine)
+                if loaded is None:
+                    continue
+                label, features = loaded
+                if (
+                    data_version is not None
+                    and label is not None
+                    and label >= data_version
+                ):
+                    # Refitted by another worker after the write
+                    continue
+                if features_cls.incremental and (
+                    data_version is None or label == data_version - 1
+                ):
+                    self._publish(path, change(features), data_version)
+                else:
+                    # Missed a write of another node, the next lookup refits the branch
+                    os.remove(os.path.join(path, CURRENT))
+
+    def invalidate(self, company_id: int, branch_id: int) -> None:
+        with self._file_lock(company_id, branch_id):
+            for engine in SIMILARITY_ENGINES:
+                try:
+                    os.remove(
+                        os.path.join(self._path(company_id, branch_id, engine), CURRENT)
+                    )
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, company_id: int, branch_id: int, engine: str) -> str:
+        return os.path.join(self.directory, f"{company_id}-{branch_id}", engine)
+
+    @contextmanager
+    def _file_lock(self, company_id: int, branch_id: int) -> Iterator[None]:
+        path = os.path.join(self.directory, f"{company_id}-{branch_id}")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _current_version(self, path: str) -> Optional[str]:
+        try:
+            with open(os.path.join(path, CURRENT)) as current:
+                return current.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _is_current(label: Optional[int], data_version: Optional[int]) -> bool:
+        # A version refitted after a newer write than the caller saw is current as well
+        return data_version is None or (label is not None and label >= data_version)
+
+    def _load_current(
+        self, company_id: int, branch_id: int, engine: str
+    ) -> Optional[Tuple[Optional[int], Any]]:
+        version = self._current_version(self._path(company_id, branch_id, engine))
+        if version is None:
+            return None
+        return self._load(company_id, branch_id, engine, version)
+
+    def _load(
+        self, company_id: int, branch_id: int, engine: str, version: str
+    ) -> Optional[Tuple[Optional[int], Any]]:
+        """
+        Data version label and features of a published version.
+        """
+        key = (company_id, branch_id, engine)
+        with self._lock:
+            mapped = self._mapped.get(key)
+        if mapped is not None and mapped[0] == version:
+            return mapped[1:]
+
+        try:
+            features, meta = read_features(
+                os.path.join(self._path(company_id, branch_id, engine), version)
+            )
+        except FileNotFoundError:
+            # The version was superseded and cleaned up in the meantime
+            return None
+        with self._lock:
+            self._mapped[key] = (version, meta.get("data_version"), features)
+        return meta.get("data_version"), features
+
+    def _publish(self, path: str, features: Any, data_version: Optional[int]) -> str:
+        version = f"{time.time_ns():020d}-{os.getpid()}"
+        write_features(os.path.join(path, version), features, data_version=data_version)
+
+        current_tmp = os.path.join(path, f"{CURRENT}.{os.getpid()}")
+        with open(current_tmp, "w") as current:
+            current.write(version)
+        os.replace(current_tmp, os.path.join(path, CURRENT))
+
+        # Workers still mapping a removed version keep reading it until they remap
+        versions = sorted(
+            name for name in os.listdir(path) if not name.startswith(CURRENT)
+        )
+        for old_version in versions[: -self.keep_versions]:
+            shutil.rmtree(os.path.join(path, old_version), ignore_errors=True)
+        return version
+
+
+shared_feature_store = (
+    SharedFeatureStore(settings.SIMILARITY_SHARED_DIR)
+    if settings.SIMILARITY_SHARED_DIR
+    else None
+)
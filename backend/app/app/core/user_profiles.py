@@ -0,0 +1,97 @@
+from collections import Counter, defaultdict
+from typing import Any, DefaultDict, Dict, Optional, Tuple
+
+import numpy as np
+
+from app.core.collaborative import INTERACTION_WEIGHTS, InteractionModel
+from app.core.config import settings
+from app.core.filtering_utils import (
+    CATEGORICAL_COLUMNS,
+    NUMERIC_COLUMNS,
+    NumericFeatures,
+    category_value,
+)
+from app.models.user_interaction import InteractionType
+
+
+class UserProfile:
+    """
+    Interaction-weighted sums of the attributes of the cars a user interacted with.
+
+    The profile is kept in raw attribute space, so it stays valid when the
+    branch features are refitted with a different scaling or vocabulary.
+    """
+
+    def __init__(self) -> None:
+        self.weight = 0.0
+        self.numeric_sum = np.zeros(len(NUMERIC_COLUMNS))
+        self.category_weights: Tuple[DefaultDict[str, float], ...] = tuple(
+            defaultdict(float) for _ in CATEGORICAL_COLUMNS
+        )
+        self.car_ids: Counter = Counter()
+
+    def vectorize(self, features: NumericFeatures) -> np.ndarray:
+        """
+        Encode the profile into the feature space of a branch.
+        """
+        return features.encode_profile(
+            self.numeric_sum / self.weight,
+            [
+                {value: weight / self.weight for value, weight in weights.items()}
+                for weights in self.category_weights
+            ],
+        )
+
+
+class UserProfileModel(InteractionModel):
+    """
+    Preference profiles of all users, updated with every recorded interaction.
+
+    Interactions have to carry the car they refer to as `car`, or the car
+    attributes themselves. A car updated after an interaction was recorded is
+    subtracted with its new attributes, the drift is dropped on the next rebuild.
+    """
+
+    def __init__(
+        self,
+        *,
+        weights: Dict[InteractionType, float],
+        rebuild_seconds: int,
+        lookback: int = 100
+    ):
+        self.weights = weights
+        super().__init__(rebuild_seconds=rebuild_seconds, lookback=lookback)
+
+    def _new_state(self) -> Dict[int, UserProfile]:
+        return {}
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        with self._lock:
+            return self._state.get(user_id)
+
+    def _apply(
+        self, state: Dict[int, UserProfile], interaction: Any, delta: int
+    ) -> None:
+        car = getattr(interaction, "car", interaction)
+        weight = delta * self.weights[InteractionType(interaction.interaction_type)]
+        profile = state.setdefault(interaction.user_id, UserProfile())
+        profile.weight += weight
+        profile.numeric_sum += weight * np.array(
+            [getattr(car, column) for column in NUMERIC_COLUMNS], dtype=np.float64
+        )
+        for weights, column in zip(profile.category_weights, CATEGORICAL_COLUMNS):
+            value = category_value(getattr(car, column))
+            weights[value] += weight
+            if weights[value] <= 1e-9:
+                del weights[value]
+        profile.car_ids[interaction.car_id] += delta
+        if profile.car_ids[interaction.car_id] <= 0:
+            del profile.car_ids[interaction.car_id]
+        if profile.weight <= 1e-9:
+            del state[interaction.user_id]
+
+
+user_profiles = UserProfileModel(
+    weights=INTERACTION_WEIGHTS,
+    rebuild_seconds=settings.COLLABORATIVE_REBUILD_SECONDS,
+)
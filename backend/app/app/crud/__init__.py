@@ -3,3 +3,4 @@ from .crud_company import company
 from .crud_branch import branch
 from .crud_car import car
 from .crud_user_interaction import user_interaction
+from .crud_car_similarity import car_similarity
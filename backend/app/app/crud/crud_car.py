@@ -1,37 +1,279 @@
+import difflib
+import heapq
+import logging
 import random
-from typing import List, Optional, Type, TypeVar
-from app.core.filtering_utils import content_filtering
+import re
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union
+from app.core.celery_app import celery_app
+from app.core.columnar_search import COLUMNS, BranchColumns, columnar_search
+from app.core.feature_artifacts import feature_artifacts
+from app.core.feature_cache import feature_cache
+from app.core.pagination import decode_cursor, seek
+from app.core.scoring_pool import scoring_pool
+from app.core.search_cache import search_cache
+from app.core.shared_features import shared_feature_store
+from app.core.config import settings
+from app.core.filtering_utils import (
+    CATEGORICAL_COLUMNS,
+    NUMERIC_COLUMNS,
+    SIMILARITY_ENGINES,
+    SQL_ENGINE,
+    SimilarityFeatures,
+    rank_similar_many,
+    score_encoded,
+    score_similar,
+)
 
+import numpy as np
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy import and_, case, func, or_, select, tuple_
 
+from app import scoring_worker
 from app.crud.base import CRUDBase
-from app.models.car import Car, FuelType, Transmission
-from app.schemas.car  import CarCreate, CarUpdate
+from app.crud.crud_car_similarity import car_similarity
+from app.models.branch import Branch
+from app.models.car import Car, search_document, search_text
+from app.schemas.car  import CarCreate, CarFilters, CarUpdate
+
+logger = logging.getLogger(__name__)
+# Fitted features live in memory-mapped files shared by the workers of the node
+# when configured
+feature_store = shared_feature_store or feature_cache
 
 # Define a type variable for the column type
 ColumnT = TypeVar('ColumnT')
 
+# Words of every searched branch with the branch data version they were read at
+search_vocabularies: Dict[int, Tuple[Optional[int], List[str]]] = {}
+
+# Branch shards of a company are scored in parallel,
+# NumPy releases the GIL while scoring
+shard_executor = ThreadPoolExecutor(max_workers=settings.SIMILARITY_SHARD_WORKERS)
+
+
+class Explain(Executable, ClauseElement):
+    # Plan of a statement, its bound parameters keep the types of the columns
+    # they compare to
+    def __init__(self, statement: Any):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler: Any, **kw: Any) -> str:
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def canonical_filters(filters: CarFilters) -> Tuple[Tuple[str, Any], ...]:
+    """
+    Hashable form of a filter set, equal for searches matching the same cars.
+
+    Falsy filters are ignored, enums compare by value and the values of a
+    list filter are deduplicated and sorted, a single value stands alone.
+    """
+    def canonical(value: Any) -> Any:
+        if not isinstance(value, (list, tuple)):
+            return value.value if isinstance(value, Enum) else value
+        values = sorted({canonical(item) for item in value})
+        return values[0] if len(values) == 1 else tuple(values)
+
+    return tuple(
+        sorted(
+            (name, canonical(value)) for name, value in filters.dict().items() if value
+        )
+    )
+
+
+def similarity_target(car: Any) -> SimpleNamespace:
+    # Only the columns used by the similarity features are sent to the scoring workers
+    return SimpleNamespace(
+        id=car.id,
+        **{
+            column: getattr(car, column)
+            for column in NUMERIC_COLUMNS + CATEGORICAL_COLUMNS
+        },
+    )
+
+
 class CRUDCar(CRUDBase[Car, CarCreate, CarUpdate]):
+    # Whether the migrations created the trigram index,
+    # looked up on the first text search
+    trigram_search: Optional[bool] = None
+    # Orders of the listing and search,
+    # each served by a (company_id, branch_id, column, id) index
+    sort_options = ("price", "-price", "year", "-year", "kilometers", "-kilometers")
+    # Exact counts or estimates from the query plan of the search
+    count_modes = ("exact", "estimated")
+    # Columns whose values are counted for the search facets
+    facet_columns = ("make", "color", "seats", "fuel_type", "transmission")
+    # Columns whose value distributions are counted for the range filters
+    histogram_columns = ("price", "year", "kilometers")
+
     def create(self, db: Session, *, obj_in: CarCreate, company_id: int, branch_id: int) -> Car:
         obj_in_data = jsonable_encoder(obj_in)
         db_obj = self.model(**obj_in_data, company_id=company_id, branch_id=branch_id)
         db.add(db_obj)
+        # Full neighbour lists of the branch are checked against the new car
+        # by the refresh task
+        car_similarity.mark_incomplete_stale(
+            db, branch_id=branch_id, top_n=settings.SIMILARITY_PRECOMPUTE_TOP_N
+        )
+        data_version = self.bump_data_version(db, branch_id=branch_id)
         db.commit()
         db.refresh(db_obj)
+        feature_store.upsert(company_id, branch_id, db_obj, data_version)
+        if columnar_search is not None:
+            columnar_search.upsert(company_id, branch_id, db_obj, data_version)
+        self.enqueue_similarity_refresh(
+            company_id=company_id, branch_id=branch_id, car_id=db_obj.id
+        )
+        return db_obj
+
+    def update(
+        self,
+        db: Session,
+        *,
+        db_obj: Car,
+        obj_in: Union[CarUpdate, Dict[str, Any]]
+    ) -> Car:
+        car_similarity.mark_stale(db, car_id=db_obj.id)
+        data_version = self.bump_data_version(db, branch_id=db_obj.branch_id)
+        db_obj = super().update(db, db_obj=db_obj, obj_in=obj_in)
+        feature_store.upsert(db_obj.company_id, db_obj.branch_id, db_obj, data_version)
+        if columnar_search is not None:
+            columnar_search.upsert(
+                db_obj.company_id, db_obj.branch_id, db_obj, data_version
+            )
+        self.enqueue_similarity_refresh(
+            company_id=db_obj.company_id, branch_id=db_obj.branch_id, car_id=db_obj.id
+        )
+        return db_obj
+
+    def remove(self, db: Session, *, id: int) -> Car:
+        # Neighbour lists pointing to the car are flagged before the rows are
+        # deleted with it
+        car_similarity.mark_stale(db, car_id=id)
+        branch_id = db.query(self.model.branch_id).filter(self.model.id == id).scalar()
+        data_version = self.bump_data_version(db, branch_id=branch_id)
+        db_obj = super().remove(db, id=id)
+        feature_store.remove(db_obj.company_id, db_obj.branch_id, id, data_version)
+        if columnar_search is not None:
+            columnar_search.remove(
+                db_obj.company_id, db_obj.branch_id, id, data_version
+            )
+        self.enqueue_similarity_refresh(
+            company_id=db_obj.company_id, branch_id=db_obj.branch_id, car_id=id
+        )
         return db_obj
 
+    def enqueue_similarity_refresh(
+        self, *, company_id: int, branch_id: int, car_id: int
+    ) -> None:
+        if not settings.SIMILARITY_PRECOMPUTE_ENABLED:
+            return
+        # The write is already committed, a broker outage only delays the recomputation
+        try:
+            celery_app.send_task(
+                "app.worker.refresh_car_similarities",
+                args=[company_id, branch_id, car_id],
+            )
+        except Exception as e:
+            logger.error(e)
+
     def get_all(
-        self, db: Session, *, company_id: int, branch_id: int, skip: int = 0, limit: int = 100
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        skip: int = 0,
+        limit: Optional[int] = 100,
+        cursor: Optional[str] = None,
+        sort: Optional[str] = None,
     ) -> List[Car]:
-        return db.query(self.model).filter(
+        query = db.query(self.model).filter(
             self.model.company_id == company_id,
-            self.model.branch_id == branch_id).offset(skip).limit(limit).all()
-    
+            self.model.branch_id == branch_id)
+        key_columns, descending = self.get_sort_keys(sort)
+        return self.get_cached_page(
+            db,
+            company_id=company_id,
+            branch_id=branch_id,
+            key=("all", skip, limit, cursor, sort),
+            limit=limit,
+            load=lambda: seek(query, key_columns, cursor, descending)
+            .offset(skip)
+            .limit(limit)
+            .all(),
+        )
+
+    def get_cached_page(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        key: Tuple[Any, ...],
+        limit: Optional[int],
+        load: Callable[[], List[Car]],
+    ) -> List[Car]:
+        """
+        Page of cars from the search cache, loaded and cached on a miss.
+
+        The cache key includes the data version of the branch, so pages read
+        before a car write are never returned after it. Every hit returns new
+        detached cars, so callers never share instances. Unbounded pages are
+        not cached, they would push everything else out.
+        """
+        if search_cache is None or limit is None:
+            return load()
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        cache_key = (company_id, branch_id, data_version) + key
+        rows = search_cache.get(cache_key)
+        if rows is None:
+            cars = load()
+            search_cache.put(
+                cache_key,
+                [{column: getattr(car, column) for column in COLUMNS} for car in cars],
+            )
+            return cars
+        return [
+            self.model(**row, company_id=company_id, branch_id=branch_id)
+            for row in rows
+        ]
+
+    def get_sort_keys(self, sort: Optional[str] = None) -> Tuple[List[Any], bool]:
+        """
+        Key columns and direction of a sort option, ties and the default order go by id.
+        """
+        if not sort:
+            return [self.model.id], False
+        column = getattr(self.model, sort.lstrip("-"))
+        return [column, self.model.id], sort.startswith("-")
+
     def get_random_records(
-        self, db: Session, *, company_id: int, branch_id: int, skip: int = 0, limit: int = 100
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        cursor: Optional[str] = None,
     ) -> List[Car]:
+        if cursor is not None:
+            # The next pages continue after the last car of the randomly placed
+            # first page
+            query = db.query(self.model).filter(
+                self.model.company_id == company_id,
+                self.model.branch_id == branch_id)
+            return seek(query, [self.model.id], cursor).offset(skip).limit(limit).all()
+
         # Get the total count of rows in the table
         total_rows = db.query(self.model).filter(
             self.model.company_id == company_id,
@@ -41,10 +283,17 @@ class CRUDCar(CRUDBase[Car, CarCreate, CarUpdate]):
         random_offset = random.randint(0, max(0, total_rows - 1 - skip))
 
         # Use the random_offset to skip random rows in the result
-        return db.query(self.model).filter(
-            self.model.company_id == company_id,
-            self.model.branch_id == branch_id).offset(random_offset + skip).limit(limit).all()
-    
+        return (
+            db.query(self.model)
+            .filter(
+                self.model.company_id == company_id, self.model.branch_id == branch_id
+            )
+            .order_by(self.model.id)
+            .offset(random_offset + skip)
+            .limit(limit)
+            .all()
+        )
+
     def get_makes(self, db: Session, company_id: int, branch_id: int) -> List[str]:
         return car.get_distinct_values_from_column(Car.make, db, company_id=company_id, branch_id=branch_id)
 
@@ -60,67 +309,474 @@ class CRUDCar(CRUDBase[Car, CarCreate, CarUpdate]):
         db: Session,
         company_id: int,
         branch_id: int,
-        make: Optional[str] = None,
-        model: Optional[str] = None,
-        year_min: Optional[int] = None,
-        year_max: Optional[int] = None,
-        price_min: Optional[float] = None,
-        price_max: Optional[float] = None,
-        fuel_type: Optional[FuelType] = None,
-        transmission: Optional[Transmission] = None,
-        color: Optional[str] = None,
-        seats_min: Optional[int] = None,
-        seats_max: Optional[int] = None,
+        filters: Optional[CarFilters] = None,
+        q: Optional[str] = None,
         skip: int = 0, 
-        limit: int = 100
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        sort: Optional[str] = None
     ) -> List[Car]:
+        filters = filters or CarFilters()
+        q = " ".join(q.split()) if q else None
+        return self.get_cached_page(
+            db,
+            company_id=company_id,
+            branch_id=branch_id,
+            key=("search", canonical_filters(filters), q, skip, limit, cursor, sort),
+            limit=limit,
+            load=lambda: self.query_by_filters(
+                db,
+                company_id,
+                branch_id,
+                filters=filters,
+                q=q,
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+                sort=sort,
+            ),
+        )
+
+    def query_by_filters(
+        self,
+        db: Session,
+        company_id: int,
+        branch_id: int,
+        filters: Optional[CarFilters] = None,
+        q: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        sort: Optional[str] = None
+    ) -> List[Car]:
+        filters = filters or CarFilters()
+        # Text search is left to PostgreSQL, plain filters are served from memory
+        # when the branch is loaded
+        columns = (
+            self.get_search_columns(db, company_id=company_id, branch_id=branch_id)
+            if not q
+            else None
+        )
+        if columns is not None:
+            after = None
+            if cursor is not None:
+                # Checked like the cursors of the SQL path,
+                # so both reject the same inputs
+                after = decode_cursor(cursor, self.get_sort_keys(sort)[0])
+            rows = columns.search(
+                filters, sort=sort, after=after, skip=skip, limit=limit
+            )
+            # Detached cars, never added to the session
+            return [
+                self.model(**row, company_id=company_id, branch_id=branch_id)
+                for row in rows
+            ]
+
         query = db.query(self.model).filter(
             self.model.company_id == company_id,
             self.model.branch_id == branch_id
         )
 
+        filter_conditions = self.get_filter_conditions(filters)
+
+        # Combine all filter conditions using and_
+        if filter_conditions:
+            query = query.filter(and_(*filter_conditions))
+
+        text_search = (
+            self.get_text_search(db, company_id=company_id, branch_id=branch_id, q=q)
+            if q
+            else None
+        )
+        if text_search is not None:
+            match, rank = text_search
+            query = query.filter(match)
+            if not sort:
+                # Ranked by relevance, so the pages are selected with skip
+                return (
+                    query.order_by(rank.desc(), self.model.id)
+                    .offset(skip)
+                    .limit(limit)
+                    .all()
+                )
+
+        key_columns, descending = self.get_sort_keys(sort)
+        return (
+            seek(query, key_columns, cursor, descending).offset(skip).limit(limit).all()
+        )
+
+    def count_by_filters(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        q: Optional[str] = None,
+        filters: Optional[CarFilters] = None,
+        estimated: bool = False
+    ) -> Tuple[int, bool]:
+        """
+        Count the cars matching a search, returns the count and whether it is exact.
+
+        A branch loaded for the columnar search is always counted exactly from
+        its bitmaps. Otherwise estimated counts take the row estimate of the
+        query plan and only fall back to count(*) below
+        SEARCH_COUNT_EXACT_BELOW rows, where the estimate is the least accurate
+        and counting is cheap. Counts are cached per branch data version like the pages.
+        """
+        filters = filters or CarFilters()
+        q = " ".join(q.split()) if q else None
+        cache_key = None
+        if search_cache is not None:
+            cache_key = (
+                company_id,
+                branch_id,
+                self.get_data_version(db, branch_id=branch_id),
+                "count",
+                canonical_filters(filters),
+                q,
+                estimated,
+            )
+            cached = search_cache.get(cache_key)
+            if cached is not None:
+                return cached[0]["count"], cached[0]["exact"]
+
+        columns = (
+            self.get_search_columns(db, company_id=company_id, branch_id=branch_id)
+            if not q
+            else None
+        )
+        if columns is not None:
+            count, exact = columns.count(filters), True
+        else:
+            conditions = [
+                self.model.company_id == company_id,
+                self.model.branch_id == branch_id,
+                *self.get_filter_conditions(filters)
+            ]
+            text_search = (
+                self.get_text_search(
+                    db, company_id=company_id, branch_id=branch_id, q=q
+                )
+                if q
+                else None
+            )
+            if text_search is not None:
+                conditions.append(text_search[0])
+            estimate = None
+            if estimated:
+                plan = db.execute(
+                    Explain(db.query(self.model.id).filter(*conditions).statement)
+                ).scalar()
+                estimate = int(plan[0]["Plan"]["Plan Rows"])
+            if estimate is not None and estimate >= settings.SEARCH_COUNT_EXACT_BELOW:
+                count, exact = estimate, False
+            else:
+                count = db.query(func.count(self.model.id)).filter(*conditions).scalar()
+                exact = True
+
+        if search_cache is not None and cache_key is not None:
+            search_cache.put(cache_key, [{"count": count, "exact": exact}])
+        return count, exact
+
+    def get_facets(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        q: Optional[str] = None,
+        filters: Optional[CarFilters] = None
+    ) -> Dict[str, List[Tuple[Any, int]]]:
+        """
+        Count the cars per value of every facet column among the cars matching a search.
+
+        All facets are counted by a single query with a grouping set per facet
+        column. Every result row counts a value of one facet and leaves the other
+        facet columns null, which tells the facets apart as the columns are not
+        nullable. Values are ordered by count, most frequent first.
+        """
+        columns = [getattr(self.model, name) for name in self.facet_columns]
+        query = db.query(*columns, func.count()).filter(
+            self.model.company_id == company_id,
+            self.model.branch_id == branch_id,
+            *self.get_filter_conditions(filters)
+        )
+        text_search = (
+            self.get_text_search(db, company_id=company_id, branch_id=branch_id, q=q)
+            if q
+            else None
+        )
+        if text_search is not None:
+            query = query.filter(text_search[0])
+
+        facets: Dict[str, List[Tuple[Any, int]]] = {
+            name: [] for name in self.facet_columns
+        }
+        for *values, count in query.group_by(func.grouping_sets(*columns)).all():
+            name, value = next(
+                (name, value)
+                for name, value in zip(self.facet_columns, values)
+                if value is not None
+            )
+            facets[name].append((value, count))
+        for counts in facets.values():
+            counts.sort(key=lambda value_count: (-value_count[1], str(value_count[0])))
+        return facets
+
+    def get_histograms(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        buckets: int = 10,
+        q: Optional[str] = None,
+        filters: Optional[CarFilters] = None
+    ) -> Dict[str, List[Tuple[float, float, int]]]:
+        """
+        Count the cars matching a search in equal width buckets of every histogram
+        column.
+
+        The buckets split the range of the column over the whole branch, so
+        they stay in place while the filters change. The minimum and maximum
+        are read from the sort indexes and the cars are counted with
+        width_bucket in one query, with a grouping set per column. The empty
+        grouping set returns the bounds even when no car matches.
+        """
+        in_branch = [
+            self.model.company_id == company_id,
+            self.model.branch_id == branch_id,
+        ]
+        bounds, bucket_columns = [], []
+        for name in self.histogram_columns:
+            column = getattr(self.model, name)
+            lower = db.query(func.min(column)).filter(*in_branch).as_scalar()
+            upper = db.query(func.max(column)).filter(*in_branch).as_scalar()
+            bounds += [lower, upper]
+            # width_bucket rejects equal bounds and puts the maximum into a bucket
+            # of its own
+            upper = case([(upper > lower, upper)], else_=lower + 1)
+            bucket_columns.append(
+                func.least(func.width_bucket(column, lower, upper, buckets), buckets)
+            )
+
+        query = db.query(*bucket_columns, func.count(), *bounds).filter(
+            *in_branch,
+            *self.get_filter_conditions(filters)
+        )
+        text_search = (
+            self.get_text_search(db, company_id=company_id, branch_id=branch_id, q=q)
+            if q
+            else None
+        )
+        if text_search is not None:
+            query = query.filter(text_search[0])
+        rows = query.group_by(
+            func.grouping_sets(*[tuple_(column) for column in bucket_columns], tuple_())
+        ).all()
+
+        # Rows hold a bucket of one column or none, then the count and the bounds
+        # of every column
+        columns = len(self.histogram_columns)
+        counts: Dict[str, Dict[int, int]] = {
+            name: {} for name in self.histogram_columns
+        }
+        for row in rows:
+            for name, bucket in zip(self.histogram_columns, row[:columns]):
+                if bucket is not None:
+                    counts[name][bucket] = row[columns]
+        row_bounds = rows[0][columns + 1:]
+
+        histograms: Dict[str, List[Tuple[float, float, int]]] = {
+            name: [] for name in self.histogram_columns
+        }
+        for name, lower, upper in zip(
+            self.histogram_columns, row_bounds[::2], row_bounds[1::2]
+        ):
+            if lower is None:
+                # The branch has no cars
+                continue
+            width = ((upper if upper > lower else lower + 1) - lower) / buckets
+            histograms[name] = [
+                (
+                    lower + bucket * width,
+                    lower + (bucket + 1) * width,
+                    counts[name].get(bucket + 1, 0),
+                )
+                for bucket in range(buckets)
+            ]
+        return histograms
+
+    def get_text_search(
+        self, db: Session, *, company_id: int, branch_id: int, q: str
+    ) -> Optional[Tuple[Any, Any]]:
+        """
+        Condition and relevance of the cars matching a free-text query on make,
+        model and color.
+
+        Every word of the query has to match a word of the car as a prefix,
+        which the full-text index serves. Where pg_trgm is installed, cars
+        whose words are similar to the query match as well, so misspelled
+        queries still find them. Otherwise misspelled words are replaced by the
+        closest word of the branch first. Returns None for a query without words.
+        """
+        words = re.findall(r"\w+", q.lower())
+        if not words:
+            return None
+
+        if self.has_trigram_search(db):
+            text = " ".join(words)
+            tsquery = func.to_tsquery(
+                "simple", " & ".join(f"{word}:*" for word in words)
+            )
+            # Lasts until the end of the transaction,
+            # the threshold applies to the indexed %> operator
+            db.execute(
+                select(
+                    [
+                        func.set_config(
+                            "pg_trgm.word_similarity_threshold",
+                            str(settings.SEARCH_TRIGRAM_THRESHOLD),
+                            True,
+                        )
+                    ]
+                )
+            )
+            return (
+                or_(search_document.op("@@")(tsquery), search_text.op("%>")(text)),
+                func.greatest(
+                    func.ts_rank(search_document, tsquery),
+                    func.word_similarity(text, search_text),
+                ),
+            )
+
+        vocabulary = self.get_search_vocabulary(
+            db, company_id=company_id, branch_id=branch_id
+        )
+        for index, word in enumerate(words):
+            if not any(known.startswith(word) for known in vocabulary):
+                words[index] = next(
+                    iter(difflib.get_close_matches(word, vocabulary, n=1)), word
+                )
+        tsquery = func.to_tsquery("simple", " & ".join(f"{word}:*" for word in words))
+        return search_document.op("@@")(tsquery), func.ts_rank(search_document, tsquery)
+
+    def get_search_vocabulary(
+        self, db: Session, *, company_id: int, branch_id: int
+    ) -> List[str]:
+        """
+        Words of the makes, models and colors of a branch, cached until the next
+        car write.
+        """
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        cached = search_vocabularies.get(branch_id)
+        if cached is not None and cached[0] == data_version:
+            return cached[1]
+
+        # Distinct makes and models are read from the make/model index,
+        # there are few colors
+        values = [
+            make + " " + model
+            for make, model in db.query(self.model.make, self.model.model)
+            .filter(
+                self.model.company_id == company_id, self.model.branch_id == branch_id
+            )
+            .distinct()
+            .all()
+        ] + self.get_colors(db, company_id=company_id, branch_id=branch_id)
+        vocabulary = sorted(
+            {word for value in values for word in re.findall(r"\w+", value.lower())}
+        )
+        search_vocabularies[branch_id] = (data_version, vocabulary)
+        return vocabulary
+
+    def has_trigram_search(self, db: Session) -> bool:
+        if self.trigram_search is None:
+            self.trigram_search = db.execute(
+                select([func.to_regclass("ix_cars_search_text_trgm").isnot(None)])
+            ).scalar()
+        return self.trigram_search
+
+    def get_filter_conditions(self, filters: Optional[CarFilters] = None) -> List[Any]:
         # Define a list to store the filter conditions
-        filter_conditions = []
+        filter_conditions: List[Any] = []
+        if filters is None:
+            return filter_conditions
 
-        if make:
-            filter_conditions.append(self.model.make == make)
+        if filters.make:
+            filter_conditions.append(self.match_values(self.model.make, filters.make))
 
-        if model:
-            filter_conditions.append(self.model.model == model)
+        if filters.model:
+            filter_conditions.append(self.model.model == filters.model)
 
-        if year_min:
-            filter_conditions.append(self.model.year >= year_min)
+        if filters.year_min:
+            filter_conditions.append(self.model.year >= filters.year_min)
 
-        if year_max:
-            filter_conditions.append(self.model.year <= year_max)
+        if filters.year_max:
+            filter_conditions.append(self.model.year <= filters.year_max)
 
-        if price_min:
-            filter_conditions.append(self.model.price >= price_min)
+        if filters.price_min:
+            filter_conditions.append(self.model.price >= filters.price_min)
 
-        if price_max:
-            filter_conditions.append(self.model.price <= price_max)
+        if filters.price_max:
+            filter_conditions.append(self.model.price <= filters.price_max)
 
-        if fuel_type:
-            filter_conditions.append(self.model.fuel_type == fuel_type.value)
+        if filters.fuel_type:
+            filter_conditions.append(
+                self.match_values(self.model.fuel_type, filters.fuel_type)
+            )
 
-        if transmission:
-            filter_conditions.append(self.model.transmission == transmission.value)
+        if filters.transmission:
+            filter_conditions.append(
+                self.match_values(self.model.transmission, filters.transmission)
+            )
 
-        if color:
-            filter_conditions.append(self.model.color == color)
+        if filters.color:
+            filter_conditions.append(self.match_values(self.model.color, filters.color))
 
-        if seats_min:
-            filter_conditions.append(self.model.seats >= seats_min)
+        if filters.seats_min:
+            filter_conditions.append(self.model.seats >= filters.seats_min)
 
-        if seats_max:
-            filter_conditions.append(self.model.seats <= seats_max)
+        if filters.seats_max:
+            filter_conditions.append(self.model.seats <= filters.seats_max)
 
-        # Combine all filter conditions using and_
-        if filter_conditions:
-            query = query.filter(and_(*filter_conditions))
+        # Excluded values, any number of them
+        if filters.make_not:
+            filter_conditions.append(
+                self.match_values(self.model.make, filters.make_not, negate=True)
+            )
+
+        if filters.color_not:
+            filter_conditions.append(
+                self.match_values(self.model.color, filters.color_not, negate=True)
+            )
+
+        if filters.fuel_type_not:
+            filter_conditions.append(
+                self.match_values(
+                    self.model.fuel_type, filters.fuel_type_not, negate=True
+                )
+            )
+
+        if filters.transmission_not:
+            filter_conditions.append(
+                self.match_values(
+                    self.model.transmission, filters.transmission_not, negate=True
+                )
+            )
+
+        return filter_conditions
+
+    def match_values(self, column: Any, values: List[Any], negate: bool = False) -> Any:
+        """
+        Condition matching any of a list of values, IN (...) or NOT IN (...)
+        for several.
+        """
+        if len(values) == 1:
+            return column != values[0] if negate else column == values[0]
+        return column.notin_(values) if negate else column.in_(values)
 
-        return query.offset(skip).limit(limit).all()
-    
     def get_distinct_values_from_column(
         self,
         column: Type[ColumnT],
@@ -142,15 +798,565 @@ class CRUDCar(CRUDBase[Car, CarCreate, CarUpdate]):
         company_id: int,
         branch_id: int,
         skip: int = 0, 
-        limit: int = 100
+        limit: int = 100,
+        engine: Optional[str] = None,
+        exact: bool = False,
+        filters: Optional[CarFilters] = None
     ) -> List[Car]:
+        filter_conditions = self.get_filter_conditions(filters)
+
+        if engine == SQL_ENGINE or (engine is None and settings.SIMILARITY_IN_DATABASE):
+            target_car = db.query(self.model).filter(self.model.id == id).first()
+            return self.get_similar_cars_in_db(
+                db, target_car=target_car, company_id=company_id, branch_id=branch_id,
+                skip=skip, limit=limit, filter_conditions=filter_conditions)
+
+        # Precomputed neighbours are only kept up to date while precomputation
+        # is enabled, and only valid for the configured engine
+        if (
+            settings.SIMILARITY_PRECOMPUTE_ENABLED
+            and engine in (None, settings.SIMILARITY_ENGINE)
+            and not exact
+            and not filter_conditions
+            and skip + limit <= settings.SIMILARITY_PRECOMPUTE_TOP_N
+        ):
+            similar_cars = car_similarity.get_similar_cars(
+                db,
+                car_id=id,
+                company_id=company_id,
+                branch_id=branch_id,
+                engine=settings.SIMILARITY_ENGINE,
+                skip=skip,
+                limit=limit,
+            )
+            if similar_cars is not None:
+                return similar_cars
+
+        # Filters are applied in SQL, so only the matching cars are scored
+        candidate_ids = None
+        if filter_conditions:
+            candidate_ids = [result[0] for result in db.query(self.model.id).filter(
+                self.model.company_id == company_id,
+                self.model.branch_id == branch_id,
+                *filter_conditions
+            ).all()]
+
         target_car = db.query(self.model).filter(self.model.id == id).first()
-        all_cars = db.query(self.model).filter(
+        scored = self.score_similar_cars(
+            db, company_id=company_id, branch_id=branch_id, target_car=target_car,
+            limit=skip + limit, engine=engine, exact=exact, candidate_ids=candidate_ids)
+
+        return self.get_multi_by_ids(db, ids=[car_id for car_id, _ in scored[skip:]])
+
+    def get_similar_cars_in_db(
+        self,
+        db: Session,
+        *,
+        target_car: Car,
+        company_id: int,
+        branch_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        filter_conditions: Optional[List[Any]] = None
+    ) -> List[Car]:
+        """
+        Rank the cars of a branch by a weighted distance computed in PostgreSQL.
+
+        Numeric differences are divided by the standard deviation of the column
+        within the branch and every categorical mismatch adds its weight. The
+        database sorts by the distance and returns only the requested page, so
+        the branch is never loaded into the application.
+        """
+        weights = settings.SIMILARITY_SQL_WEIGHTS
+        in_branch = [
             self.model.company_id == company_id,
-            self.model.branch_id == branch_id).offset(skip)
-        
-        similar_cars = content_filtering(target_car, all_cars)
+            self.model.branch_id == branch_id,
+        ]
+        distance = 0
+        for name in NUMERIC_COLUMNS:
+            column = getattr(self.model, name)
+            # Evaluated once per query, a constant column falls back to a unit scale
+            scale = (
+                db.query(func.coalesce(func.nullif(func.stddev_pop(column), 0), 1))
+                .filter(*in_branch)
+                .as_scalar()
+            )
+            distance = (
+                distance
+                + weights.get(name, 0.0)
+                * func.abs(column - getattr(target_car, name))
+                / scale
+            )
+        for name in CATEGORICAL_COLUMNS:
+            column = getattr(self.model, name)
+            distance = distance + case(
+                [(column == getattr(target_car, name), 0.0)],
+                else_=weights.get(name, 0.0),
+            )
+
+        return db.query(self.model).filter(
+            *in_branch,
+            self.model.id != target_car.id,
+            *(filter_conditions or [])
+        ).order_by(distance, self.model.id).offset(skip).limit(limit).all()
+
+    def get_similar_cars_by_example(
+        self,
+        db: Session,
+        *,
+        obj_in: CarCreate,
+        company_id: int,
+        branch_id: int,
+        limit: int = 100,
+        engine: Optional[str] = None
+    ) -> List[Car]:
+        """
+        Find the cars of a branch closest to a car that is not stored.
+        The example is encoded with the cached features, nothing is written or refitted.
+        """
+        target_car = SimpleNamespace(id=None, **obj_in.dict())
+        scored = self.score_similar_cars(
+            db,
+            company_id=company_id,
+            branch_id=branch_id,
+            target_car=target_car,
+            limit=limit,
+            engine=engine,
+        )
+        return self.get_multi_by_ids(db, ids=[car_id for car_id, _ in scored])
+
+    def score_similar_cars(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        target_car: Any,
+        limit: int,
+        engine: Optional[str] = None,
+        exact: bool = False,
+        candidate_ids: Optional[List[int]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Score the cars of a branch against `target_car`, in the scoring pool when one
+        is configured.
+        Only `candidate_ids` are scored when provided.
+        """
+        if scoring_pool is None:
+            features = self.get_similarity_features(
+                db, company_id=company_id, branch_id=branch_id, engine=engine
+            )
+            return score_similar(
+                features,
+                target_car,
+                limit=limit,
+                exact=exact,
+                candidate_ids=candidate_ids,
+            )
+        return scoring_pool.run(
+            scoring_worker.score_similar_cars,
+            company_id,
+            branch_id,
+            engine or settings.SIMILARITY_ENGINE,
+            self.get_data_version(db, branch_id=branch_id),
+            similarity_target(target_car),
+            limit,
+            exact,
+            candidate_ids,
+        )
+
+    def get_similar_cars_many(
+        self,
+        db: Session,
+        ids: List[int],
+        company_id: int,
+        branch_id: int,
+        limit: int = 100,
+        engine: Optional[str] = None
+    ) -> Dict[int, List[Car]]:
+        """
+        Find similar cars for several cars of a branch at once.
+
+        All targets are scored against the same cached features with one
+        matrix-matrix product and the neighbours are loaded with one query.
+        Ids not belonging to the branch are left out of the result.
+        """
+        target_cars = self.get_feature_rows(
+            db, company_id=company_id, branch_id=branch_id, ids=ids
+        )
+        if scoring_pool is None:
+            features = self.get_similarity_features(
+                db, company_id=company_id, branch_id=branch_id, engine=engine
+            )
+            neighbours = rank_similar_many(features, target_cars, limit=limit)
+        else:
+            neighbours = scoring_pool.run(
+                scoring_worker.score_similar_cars_many,
+                company_id,
+                branch_id,
+                engine or settings.SIMILARITY_ENGINE,
+                self.get_data_version(db, branch_id=branch_id),
+                [similarity_target(car) for car in target_cars],
+                limit,
+            )
+
+        similar_car_ids = {
+            car_id for scored in neighbours.values() for car_id, _ in scored
+        }
+        cars_by_id = {
+            car.id: car for car in self.get_multi_by_ids(db, ids=list(similar_car_ids))
+        }
+        return {
+            car_id: [
+                cars_by_id[similar_car_id]
+                for similar_car_id, _ in scored
+                if similar_car_id in cars_by_id
+            ]
+            for car_id, scored in neighbours.items()
+        }
+
+    def get_similar_cars_in_company(
+        self,
+        db: Session,
+        id: int,
+        company_id: int,
+        skip: int = 0,
+        limit: int = 100,
+        engine: Optional[str] = None,
+        exact: bool = False
+    ) -> List[Car]:
+        """
+        Find similar cars across all branches of a company.
+
+        Every branch is a shard. The branch of the target car is scored with its
+        cached features and the cars of the other branches are encoded with the
+        same fitted vocabulary or scaling, so all scores share one feature space
+        and can be merged. Only the local top results of every shard are kept.
+        Cars of other companies have no similar cars.
+        """
+        target_car = (
+            db.query(self.model)
+            .filter(self.model.id == id, self.model.company_id == company_id)
+            .first()
+        )
+        if target_car is None:
+            return []
+        engine = engine or settings.SIMILARITY_ENGINE
+        branch_id = target_car.branch_id
+        other_branch_ids = [result[0] for result in db.query(Branch.id).filter(
+            Branch.company_id == company_id,
+            Branch.id != branch_id
+        ).order_by(Branch.id).all()]
+
+        if scoring_pool is None:
+            features = self.get_similarity_features(
+                db, company_id=company_id, branch_id=branch_id, engine=engine
+            )
+            # Rows are loaded sequentially because the session is not thread-safe,
+            # scoring overlaps the next load
+            futures = [
+                shard_executor.submit(
+                    score_similar, features, target_car, limit=skip + limit, exact=exact
+                )
+            ]
+            for other_branch_id in other_branch_ids:
+                cars = self.get_feature_rows(
+                    db, company_id=company_id, branch_id=other_branch_id
+                )
+                futures.append(
+                    shard_executor.submit(
+                        score_encoded, features, target_car, cars, limit=skip + limit
+                    )
+                )
+            shard_results = [future.result() for future in futures]
+        else:
+            # All shards are submitted before waiting so they are scored in parallel
+            data_version = self.get_data_version(db, branch_id=branch_id)
+            target = similarity_target(target_car)
+            futures = [
+                scoring_pool.submit(
+                    scoring_worker.score_similar_cars,
+                    company_id,
+                    branch_id,
+                    engine,
+                    data_version,
+                    target,
+                    skip + limit,
+                    exact,
+                )
+            ]
+            for other_branch_id in other_branch_ids:
+                cars = self.get_feature_rows(
+                    db, company_id=company_id, branch_id=other_branch_id
+                )
+                futures.append(
+                    scoring_pool.submit(
+                        scoring_worker.score_encoded_cars,
+                        company_id,
+                        branch_id,
+                        engine,
+                        data_version,
+                        target,
+                        [similarity_target(car) for car in cars],
+                        skip + limit,
+                    )
+                )
+            shard_results = scoring_pool.results(futures)
+
+        merged = heapq.nlargest(
+            skip + limit,
+            (scored for results in shard_results for scored in results),
+            key=lambda scored: scored[1]
+        )
+        return self.get_multi_by_ids(db, ids=[car_id for car_id, _ in merged[skip:]])
+
+    def precompute_similar_cars(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        car_ids: Optional[List[int]] = None,
+    ) -> int:
+        """
+        Store the top neighbours of the given cars, or of the whole branch, and
+        return the number of cars whose neighbours were computed.
+        """
+        features = self.get_similarity_features(
+            db, company_id=company_id, branch_id=branch_id
+        )
+        target_cars = self.get_feature_rows(
+            db, company_id=company_id, branch_id=branch_id, ids=car_ids
+        )
+        neighbours = rank_similar_many(
+            features, target_cars, limit=settings.SIMILARITY_PRECOMPUTE_TOP_N
+        )
+        return car_similarity.replace(
+            db, engine=settings.SIMILARITY_ENGINE, neighbours=neighbours
+        )
+
+    def refresh_similar_cars(
+        self, db: Session, *, company_id: int, branch_id: int, car_id: int
+    ) -> int:
+        """
+        Recompute only the neighbourhoods affected by a write to `car_id`.
+
+        These are the car itself, cars flagged as stale and cars for which the
+        written car now scores above their weakest stored neighbour.
+        """
+        # The write may have happened in another process,
+        # the features notice it through the data version
+        written_car = self.get(db, id=car_id)
+        features = self.get_similarity_features(
+            db, company_id=company_id, branch_id=branch_id
+        )
+
+        branch_car_ids = features.car_ids.tolist()
+        affected = set(car_similarity.get_stale_car_ids(db, car_ids=branch_car_ids))
+        if written_car:
+            affected.add(car_id)
+            scores = np.asarray(
+                features.scores(features.encode([written_car])), dtype=np.float64
+            ).ravel()
+            bounds = car_similarity.get_neighbour_bounds(db, car_ids=branch_car_ids)
+            for other_car_id, score in zip(branch_car_ids, scores.tolist()):
+                min_score, count = bounds.get(other_car_id, (0.0, 0))
+                if other_car_id != car_id and count and (
+                    count < settings.SIMILARITY_PRECOMPUTE_TOP_N or score > min_score
+                ):
+                    affected.add(other_car_id)
+
+        if not affected:
+            return 0
+        return self.precompute_similar_cars(
+            db, company_id=company_id, branch_id=branch_id, car_ids=sorted(affected)
+        )
+
+    def get_similarity_features(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        engine: Optional[str] = None,
+    ) -> SimilarityFeatures:
+        # Fitted features are shared by all requests until a car of the branch changes,
+        # they are checked against the data version of the branch so writes of other
+        # workers are noticed
+        engine = engine or settings.SIMILARITY_ENGINE
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        return feature_store.get(
+            company_id,
+            branch_id,
+            engine,
+            lambda: self.load_similarity_features(
+                db, company_id=company_id, branch_id=branch_id, engine=engine
+            ),
+            data_version,
+        )
+
+    def load_similarity_features(
+        self, db: Session, *, company_id: int, branch_id: int, engine: str
+    ) -> SimilarityFeatures:
+        """
+        Load the persisted features of a branch when they match its data version.
+
+        Older persisted features are returned as they are while the branch is
+        refitted in the background, branches never persisted are fitted right away.
+        """
+        # The version is read before the cars, so a concurrent write can only make
+        # the label older than the data
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        if feature_artifacts is not None and data_version is not None:
+            features = feature_artifacts.load(
+                company_id, branch_id, engine, data_version
+            )
+            if features is not None:
+                return features
+            features = feature_artifacts.load_latest(company_id, branch_id, engine)
+            if features is not None:
+                def refit(session: Session) -> None:
+                    self.refit_similarity_features(
+                        session,
+                        company_id=company_id,
+                        branch_id=branch_id,
+                        engine=engine,
+                    )
+                    # The older features were served and cached meanwhile,
+                    # the next lookup loads the new ones
+                    feature_store.invalidate(company_id, branch_id)
+
+                feature_artifacts.refit(company_id, branch_id, engine, refit)
+                return features
+        return self.refit_similarity_features(
+            db, company_id=company_id, branch_id=branch_id, engine=engine
+        )
+
+    def refit_similarity_features(
+        self, db: Session, *, company_id: int, branch_id: int, engine: str
+    ) -> SimilarityFeatures:
+        """
+        Fit the features of a branch and persist them labelled with its data version.
+        """
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        features = SIMILARITY_ENGINES[engine].fit(
+            self.get_feature_rows(db, company_id=company_id, branch_id=branch_id)
+        )
+        if feature_artifacts is not None and data_version is not None:
+            feature_artifacts.save(
+                company_id, branch_id, engine, data_version, features
+            )
+        return features
+
+    def warm_up_similarity_features(
+        self, db: Session, *, engine: Optional[str] = None
+    ) -> int:
+        """
+        Load the features of every branch into the feature store. Branches whose
+        persisted features are out of date are refitted in the background.
+        """
+        branches = db.query(Branch.company_id, Branch.id).order_by(Branch.id).all()
+        for company_id, branch_id in branches:
+            self.get_similarity_features(
+                db, company_id=company_id, branch_id=branch_id, engine=engine
+            )
+        return len(branches)
+
+    def get_data_version(self, db: Session, *, branch_id: int) -> Optional[int]:
+        return db.query(Branch.data_version).filter(Branch.id == branch_id).scalar()
+
+    def bump_data_version(self, db: Session, *, branch_id: int) -> Optional[int]:
+        # Committed with the caller's transaction, persisted features of the branch
+        # become stale
+        return db.execute(
+            Branch.__table__.update()
+            .where(Branch.id == branch_id)
+            .values(data_version=Branch.data_version + 1)
+            .returning(Branch.data_version)
+        ).scalar()
+
+    def get_search_columns(
+        self, db: Session, *, company_id: int, branch_id: int
+    ) -> Optional[BranchColumns]:
+        """
+        In-memory columns of the branch matching its current data version.
+
+        None when the columnar search is disabled or the branch is not loaded
+        yet, a missing or stale branch is then loaded in the background.
+        """
+        if columnar_search is None:
+            return None
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        columns = columnar_search.get(company_id, branch_id, data_version)
+        if columns is None:
+            columnar_search.warm(
+                company_id,
+                branch_id,
+                lambda session: self.load_search_columns(
+                    session, company_id=company_id, branch_id=branch_id
+                ),
+            )
+        return columns
+
+    def load_search_columns(
+        self, db: Session, *, company_id: int, branch_id: int
+    ) -> BranchColumns:
+        # The version is read first, a write landing in between only makes
+        # the columns look stale
+        data_version = self.get_data_version(db, branch_id=branch_id)
+        rows = (
+            db.query(
+                self.model.id,
+                self.model.make,
+                self.model.model,
+                self.model.price,
+                self.model.year,
+                self.model.kilometers,
+                self.model.fuel_type,
+                self.model.transmission,
+                self.model.color,
+                self.model.seats,
+            )
+            .filter(
+                self.model.company_id == company_id, self.model.branch_id == branch_id
+            )
+            .order_by(self.model.id)
+            .all()
+        )
+        return BranchColumns.build(data_version, rows)
+
+    def get_feature_rows(
+        self,
+        db: Session,
+        *,
+        company_id: int,
+        branch_id: int,
+        ids: Optional[List[int]] = None,
+    ) -> List[Any]:
+        # Only the columns used by the similarity features are loaded
+        query = db.query(
+            self.model.id,
+            self.model.make,
+            self.model.price,
+            self.model.year,
+            self.model.kilometers,
+            self.model.fuel_type,
+            self.model.transmission,
+            self.model.color,
+            self.model.seats,
+        ).filter(self.model.company_id == company_id, self.model.branch_id == branch_id)
+        if ids is not None:
+            query = query.filter(self.model.id.in_(ids))
+        return query.order_by(self.model.id).all()
 
-        return similar_cars[:limit]
+    def get_multi_by_ids(self, db: Session, *, ids: List[int]) -> List[Car]:
+        # Keep the order of the provided ids
+        if not ids:
+            return []
+        cars_by_id = {
+            car.id: car
+            for car in db.query(self.model).filter(self.model.id.in_(ids)).all()
+        }
+        return [cars_by_id[car_id] for car_id in ids if car_id in cars_by_id]
     
 car = CRUDCar(Car)
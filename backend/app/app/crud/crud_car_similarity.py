@@ -0,0 +1,160 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.car import Car
+from app.models.car_similarity import CarSimilarity
+from app.schemas.car_similarity import CarSimilarityCreate, CarSimilarityUpdate
+
+
+class CRUDCarSimilarity(
+    CRUDBase[CarSimilarity, CarSimilarityCreate, CarSimilarityUpdate]
+):
+    def get_similar_cars(
+        self,
+        db: Session,
+        *,
+        car_id: int,
+        company_id: int,
+        branch_id: int,
+        engine: str,
+        skip: int = 0,
+        limit: int = 100
+    ) -> Optional[List[Car]]:
+        """
+        Read precomputed neighbours of a car in rank order.
+
+        Returns None when the neighbours are missing, stale, were computed by
+        another engine or belong to another branch, so the caller has to
+        compute them live.
+        """
+        rows = (
+            db.query(Car, self.model.stale, self.model.engine)
+            .join(self.model, self.model.similar_car_id == Car.id)
+            .filter(self.model.car_id == car_id, self.model.rank < skip + limit)
+            .order_by(self.model.rank)
+            .all()
+        )
+
+        if not rows or any(
+            stale
+            or row_engine != engine
+            or (similar_car.company_id, similar_car.branch_id)
+            != (company_id, branch_id)
+            for similar_car, stale, row_engine in rows
+        ):
+            return None
+        return [similar_car for similar_car, _, _ in rows[skip:]]
+
+    def get_neighbour_bounds(
+        self, db: Session, *, car_ids: List[int]
+    ) -> Dict[int, Tuple[float, int]]:
+        """
+        Return the lowest stored score and the number of stored neighbours per car.
+        """
+        if not car_ids:
+            return {}
+        results = (
+            db.query(
+                self.model.car_id,
+                func.min(self.model.score),
+                func.count(self.model.rank),
+            )
+            .filter(self.model.car_id.in_(car_ids))
+            .group_by(self.model.car_id)
+            .all()
+        )
+        return {car_id: (min_score, count) for car_id, min_score, count in results}
+
+    def get_stale_car_ids(self, db: Session, *, car_ids: List[int]) -> List[int]:
+        if not car_ids:
+            return []
+        results = (
+            db.query(self.model.car_id)
+            .filter(self.model.car_id.in_(car_ids), self.model.stale.is_(True))
+            .distinct()
+            .all()
+        )
+        return [result[0] for result in results]
+
+    def get_reverse_car_ids(self, db: Session, *, car_id: int) -> List[int]:
+        # Cars listing `car_id` among their neighbours
+        results = (
+            db.query(self.model.car_id)
+            .filter(self.model.similar_car_id == car_id)
+            .distinct()
+            .all()
+        )
+        return [result[0] for result in results]
+
+    def mark_stale(self, db: Session, *, car_id: int) -> None:
+        """
+        Flag the neighbours of `car_id` and of every car listing it as stale.
+        The change is committed together with the caller's transaction.
+        """
+        reverse_car_ids = select([self.model.car_id]).where(
+            self.model.similar_car_id == car_id
+        )
+        db.query(self.model).filter(
+            or_(self.model.car_id == car_id, self.model.car_id.in_(reverse_car_ids))
+        ).update({self.model.stale: True}, synchronize_session=False)
+
+    def mark_incomplete_stale(self, db: Session, *, branch_id: int, top_n: int) -> None:
+        """
+        Flag the neighbour lists of a branch holding fewer than `top_n` cars,
+        which a car added to the branch joins for sure. The change is
+        committed together with the caller's transaction.
+        """
+        incomplete_car_ids = (
+            select([self.model.car_id])
+            .select_from(
+                self.model.__table__.join(Car.__table__, Car.id == self.model.car_id)
+            )
+            .where(Car.branch_id == branch_id)
+            .group_by(self.model.car_id)
+            .having(func.count() < top_n)
+        )
+        db.query(self.model).filter(self.model.car_id.in_(incomplete_car_ids)).update(
+            {self.model.stale: True}, synchronize_session=False
+        )
+
+    def replace(
+        self,
+        db: Session,
+        *,
+        engine: str,
+        neighbours: Dict[int, List[Tuple[int, float]]]
+    ) -> int:
+        """
+        Store freshly computed neighbours, replacing the previous rows of each car.
+        """
+        if not neighbours:
+            return 0
+        computed_at = datetime.utcnow()
+        db.query(self.model).filter(self.model.car_id.in_(list(neighbours))).delete(
+            synchronize_session=False
+        )
+        db.bulk_insert_mappings(
+            self.model,
+            [
+                {
+                    "car_id": car_id,
+                    "rank": rank,
+                    "similar_car_id": similar_car_id,
+                    "score": score,
+                    "engine": engine,
+                    "stale": False,
+                    "computed_at": computed_at,
+                }
+                for car_id, similar_cars in neighbours.items()
+                for rank, (similar_car_id, score) in enumerate(similar_cars)
+            ],
+        )
+        db.commit()
+        return len(neighbours)
+
+
+car_similarity = CRUDCarSimilarity(CarSimilarity)
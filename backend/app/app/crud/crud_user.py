@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Optional, Union
 
 from sqlalchemy.orm import Session
 
+from app.core.pagination import seek
 from app.core.security import get_password_hash, verify_password
 from app.crud.base import CRUDBase
 from app.models.user import User
@@ -15,11 +16,12 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
     def get_by_company_id_and_branch_id(self, db: Session, *, company_id: int, branch_id:int) -> Optional[User]:
         return db.query(User).filter(User.company_id == company_id, User.branch_id == branch_id).first()
     
-    def get_multi_by_company_id_and_branch_id(self, db: Session, *, company_id: int, branch_id:int, skip: int = 0, limit: int = 100) -> List[User]:
-        return db.query(User).filter(User.company_id == company_id, User.branch_id == branch_id).offset(skip).limit(limit).all()
+    def get_multi_by_company_id_and_branch_id(self, db: Session, *, company_id: int, branch_id:int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None) -> List[User]:
+        query = db.query(User).filter(User.company_id == company_id, User.branch_id == branch_id)
+        return seek(query, [User.id], cursor).offset(skip).limit(limit).all()
     
-    def get_multi_by_company_id(self, db: Session, *, company_id: int, skip: int = 0, limit: int = 100) -> List[User]:
-        return db.query(User).filter(User.company_id == company_id).offset(skip).limit(limit).all()
+    def get_multi_by_company_id(self, db: Session, *, company_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None) -> List[User]:
+        return seek(db.query(User).filter(User.company_id == company_id), [User.id], cursor).offset(skip).limit(limit).all()
     
     def create(self, db: Session, *, obj_in: UserCreate) -> User:
         db_obj = User(
@@ -1,15 +1,91 @@
 import random
-from typing import List, Optional, Type, TypeVar
-from app.core.filtering_utils import content_filtering
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Type, TypeVar, Union, cast
+from app.core.collaborative import co_occurrence
+from app.core.filtering_utils import NumericFeatures, content_filtering, top_k_indices
+from app.core.user_profiles import user_profiles
 
+import numpy as np
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
 
 from app.crud.base import CRUDBase
+from app.crud.crud_car import car as crud_car
+from app.models.car import Car
 from app.models.user_interaction import UserInteraction, InteractionType
 from app.schemas.user_interaction import UserInteractionCreate, UserInteractionUpdate
 
 class CRUDUserInteraction(CRUDBase[UserInteraction, UserInteractionCreate, UserInteractionUpdate]):  
+    def create(self, db: Session, *, obj_in: UserInteractionCreate) -> UserInteraction:
+        db_obj = super().create(db, obj_in=obj_in)
+        co_occurrence.add(db_obj)
+        user_profiles.add(db_obj)
+        return db_obj
+
+    def update(
+        self,
+        db: Session,
+        *,
+        db_obj: UserInteraction,
+        obj_in: Union[UserInteractionUpdate, Dict[str, Any]]
+    ) -> UserInteraction:
+        # The previous state has to be read before the object is updated in place
+        previous = SimpleNamespace(
+            id=db_obj.id, company_id=db_obj.company_id, branch_id=db_obj.branch_id, user_id=db_obj.user_id,
+            car_id=db_obj.car_id, interaction_type=db_obj.interaction_type, car=db_obj.car)
+        db_obj = super().update(db, db_obj=db_obj, obj_in=obj_in)
+        co_occurrence.replace(previous, db_obj)
+        user_profiles.replace(previous, db_obj)
+        return db_obj
+
+    def remove(self, db: Session, *, id: int) -> UserInteraction:
+        # The car has to be loaded while the interaction is still attached
+        interaction = self.get(db, id=id)
+        car = interaction.car if interaction is not None else None
+        db_obj = super().remove(db, id=id)
+        co_occurrence.remove(db_obj)
+        user_profiles.remove(SimpleNamespace(
+            id=db_obj.id, user_id=db_obj.user_id, car_id=db_obj.car_id,
+            interaction_type=db_obj.interaction_type, car=car))
+        return db_obj
+
+    def get_co_occurring_car_ids(
+        self, db: Session, *, company_id: int, branch_id: int, car_id: int, limit: int = 100
+    ) -> List[int]:
+        # Only interactions recorded since the last call are loaded
+        co_occurrence.refresh(lambda since_id: db.query(
+            self.model.id, self.model.company_id, self.model.branch_id, self.model.user_id, self.model.car_id,
+            self.model.interaction_type
+        ).filter(self.model.id > since_id).order_by(self.model.id).yield_per(10000))
+        return [
+            other_car_id for other_car_id, _ in co_occurrence.top_k(company_id, branch_id, car_id, limit)
+        ]
+
+    def get_recommended_car_ids(
+        self, db: Session, *, user_id: int, company_id: int, branch_id: int, limit: int = 10
+    ) -> List[int]:
+        """
+        Rank the cars of a branch against the preference profile of a user.
+        Cars the user already interacted with are left out.
+        """
+        user_profiles.refresh(lambda since_id: db.query(
+            self.model.id, self.model.user_id, self.model.car_id, self.model.interaction_type,
+            Car.make, Car.price, Car.year, Car.kilometers, Car.fuel_type, Car.transmission, Car.color, Car.seats
+        ).join(Car, Car.id == self.model.car_id).filter(
+            self.model.id > since_id).order_by(self.model.id).yield_per(10000))
+        profile = user_profiles.get(user_id)
+        if profile is None:
+            return []
+
+        features = cast(NumericFeatures, crud_car.get_similarity_features(
+            db, company_id=company_id, branch_id=branch_id, engine="numeric"))
+        if not len(features.car_ids):
+            return []
+        scores = features.scores(profile.vectorize(features))[0]
+        unseen = ~np.isin(features.car_ids, list(profile.car_ids))
+        rows = np.flatnonzero(unseen)
+        return [int(features.car_ids[rows[index]]) for index in top_k_indices(scores[rows], limit)]
+
     def get_multi_by_company_and_branch(
             self, db: Session, *, company_id: int, branch_id: int, skip: int = 0, limit: int = 100
     ) -> List[UserInteraction]:
@@ -6,3 +6,4 @@ from app.models.company import Company  # noqa
 from app.models.branch import Branch # noqa
 from app.models.car import Car # noqa
 from app.models.user_interaction import UserInteraction # noqa
+from app.models.car_similarity import CarSimilarity # noqa
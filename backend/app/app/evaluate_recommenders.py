@@ -0,0 +1,265 @@
+"""
+Offline evaluation of the car recommenders.
+
+Recorded user interactions are replayed as ground truth. Interactions before
+a timestamp cutoff train the collaborative model, and each user's last car
+before the cutoff is the query. The cars the user interacted with after the
+cutoff are the relevant results. Every recommender is scored with
+precision@k and recall@k, together with the p50/p99 latency of a query and
+the peak memory allocated while fitting and querying.
+
+Usage:
+    python -m app.evaluate_recommenders --k 10 --output report.json
+"""
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core.collaborative import INTERACTION_WEIGHTS, CoOccurrenceModel
+from app.core.filtering_utils import (
+    SIMILARITY_ENGINES,
+    SQL_ENGINE,
+    content_filtering,
+    score_similar,
+)
+from app.db.session import SessionLocal
+from app.models.car import Car
+from app.models.user_interaction import UserInteraction
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# (company id, branch id, query car id, relevant car ids) of every evaluated user
+Query = Tuple[int, int, int, Set[int]]
+# Builds a recommender for the queries,
+# the recommender returns up to k car ids for a query
+RecommenderFactory = Callable[
+    [Session, Sequence[Any], Sequence[Query]], Callable[[Query, int], List[int]]
+]
+
+
+def split_interactions(
+    interactions: Sequence[Any], train_fraction: float
+) -> Tuple[List[Any], List[Query]]:
+    """
+    Split interactions ordered by timestamp at the `train_fraction` quantile.
+    """
+    if not interactions:
+        return [], []
+    cutoff = interactions[
+        min(int(len(interactions) * train_fraction), len(interactions) - 1)
+    ].timestamp
+    train = [
+        interaction for interaction in interactions if interaction.timestamp < cutoff
+    ]
+
+    last_train: Dict[int, Any] = {}
+    for interaction in train:
+        last_train[interaction.user_id] = interaction
+    relevant: Dict[int, Set[int]] = {}
+    for interaction in interactions:
+        if interaction.timestamp >= cutoff and interaction.user_id in last_train:
+            relevant.setdefault(interaction.user_id, set()).add(interaction.car_id)
+
+    queries = []
+    for user_id, car_ids in relevant.items():
+        seed = last_train[user_id]
+        car_ids = car_ids - {seed.car_id}
+        if car_ids:
+            queries.append((seed.company_id, seed.branch_id, seed.car_id, car_ids))
+    return train, queries
+
+
+def feature_recommender(engine: str) -> RecommenderFactory:
+    def build(
+        db: Session, train: Sequence[Any], queries: Sequence[Query]
+    ) -> Callable[[Query, int], List[int]]:
+        features = {
+            (company_id, branch_id): SIMILARITY_ENGINES[engine].fit(
+                crud.car.get_feature_rows(
+                    db, company_id=company_id, branch_id=branch_id
+                )
+            )
+            for company_id, branch_id in {query[:2] for query in queries}
+        }
+        targets = {
+            car.id: car
+            for car in db.query(Car)
+            .filter(Car.id.in_({query[2] for query in queries}))
+            .all()
+        }
+
+        def recommend(query: Query, k: int) -> List[int]:
+            scored = score_similar(features[query[:2]], targets[query[2]], limit=k)
+            return [car_id for car_id, _ in scored]
+
+        return recommend
+
+    return build
+
+
+def content_filtering_recommender(
+    db: Session, train: Sequence[Any], queries: Sequence[Query]
+) -> Callable[[Query, int], List[int]]:
+    # The original request path, which loads the branch and fits TF-IDF on every call
+    def recommend(query: Query, k: int) -> List[int]:
+        company_id, branch_id, car_id, _ = query
+        target_car = crud.car.get(db, id=car_id)
+        if target_car is None:
+            return []
+        all_cars = crud.car.get_all(
+            db, company_id=company_id, branch_id=branch_id, limit=None
+        )
+        return [car.id for car in content_filtering(target_car, all_cars)[:k]]
+
+    return recommend
+
+
+def sql_recommender(
+    db: Session, train: Sequence[Any], queries: Sequence[Query]
+) -> Callable[[Query, int], List[int]]:
+    def recommend(query: Query, k: int) -> List[int]:
+        company_id, branch_id, car_id, _ = query
+        target_car = crud.car.get(db, id=car_id)
+        if target_car is None:
+            return []
+        similar_cars = crud.car.get_similar_cars_in_db(
+            db,
+            target_car=target_car,
+            company_id=company_id,
+            branch_id=branch_id,
+            limit=k,
+        )
+        return [car.id for car in similar_cars]
+
+    return recommend
+
+
+def collaborative_recommender(
+    db: Session, train: Sequence[Any], queries: Sequence[Query]
+) -> Callable[[Query, int], List[int]]:
+    # Trained on the interactions before the cutoff only
+    model = CoOccurrenceModel(
+        weights=INTERACTION_WEIGHTS, rebuild_seconds=365 * 24 * 3600
+    )
+    model.refresh(
+        lambda since_id: sorted(train, key=lambda interaction: interaction.id)
+    )
+
+    def recommend(query: Query, k: int) -> List[int]:
+        return [car_id for car_id, _ in model.top_k(query[0], query[1], query[2], k)]
+
+    return recommend
+
+
+RECOMMENDERS: Dict[str, RecommenderFactory] = {
+    "content_filtering": content_filtering_recommender,
+    **{engine: feature_recommender(engine) for engine in SIMILARITY_ENGINES},
+    SQL_ENGINE: sql_recommender,
+    "collaborative": collaborative_recommender,
+}
+
+
+def evaluate(
+    db: Session,
+    factory: RecommenderFactory,
+    train: Sequence[Any],
+    queries: Sequence[Query],
+    k: int,
+) -> Dict[str, Any]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    recommend = factory(db, train, queries)
+    fit_seconds = time.perf_counter() - started
+
+    precision, recall, latencies = [], [], []
+    for query in queries:
+        started = time.perf_counter()
+        recommended = recommend(query, k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits = len(set(recommended[:k]) & query[3])
+        precision.append(hits / k)
+        recall.append(hits / len(query[3]))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "precision_at_k": float(np.mean(precision)) if queries else None,
+        "recall_at_k": float(np.mean(recall)) if queries else None,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if queries else None,
+            "p99": float(np.percentile(latencies, 99)) if queries else None,
+        },
+        "fit_seconds": fit_seconds,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+def run(
+    db: Session,
+    *,
+    k: int,
+    train_fraction: float,
+    engines: Optional[Sequence[str]] = None
+) -> Dict[str, Any]:
+    interactions = (
+        db.query(UserInteraction)
+        .order_by(UserInteraction.timestamp, UserInteraction.id)
+        .all()
+    )
+    train, queries = split_interactions(interactions, train_fraction)
+    logger.info(
+        "Evaluating %s queries from %s interactions", len(queries), len(interactions)
+    )
+
+    report: Dict[str, Any] = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "k": k,
+        "train_fraction": train_fraction,
+        "interactions": len(interactions),
+        "queries": len(queries),
+        "engines": {},
+    }
+    for name in engines or RECOMMENDERS:
+        logger.info("Evaluating %s", name)
+        report["engines"][name] = evaluate(db, RECOMMENDERS[name], train, queries, k)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--train-fraction", type=float, default=0.8)
+    parser.add_argument(
+        "--engine", action="append", choices=list(RECOMMENDERS), dest="engines"
+    )
+    parser.add_argument("--output", help="Report file, printed when omitted")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        report = run(
+            db, k=args.k, train_fraction=args.train_fraction, engines=args.engines
+        )
+    finally:
+        db.close()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
-from fastapi import FastAPI
+import logging
+import threading
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 
 from app.api.api_v1.api import api_router
+from app import crud
 from app.core.config import settings
+from app.core.pagination import NEXT_CURSOR_HEADER, TOTAL_COUNT_EXACT_HEADER, TOTAL_COUNT_HEADER, InvalidCursor
+from app.core.scoring_pool import ScoringOverloaded, ScoringTimeout, scoring_pool
+from app.db.session import SessionLocal
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json"
@@ -16,6 +26,54 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=[NEXT_CURSOR_HEADER, TOTAL_COUNT_HEADER, TOTAL_COUNT_EXACT_HEADER],
     )
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
+
+
+# Errors raised below the endpoints, mapped to their HTTP responses
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor_handler(request: Request, exc: InvalidCursor) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"detail": "Invalid cursor"})
+
+
+@app.exception_handler(ScoringOverloaded)
+async def scoring_overloaded_handler(request: Request, exc: ScoringOverloaded) -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": "Similarity scoring is overloaded, try again later"})
+
+
+@app.exception_handler(ScoringTimeout)
+async def scoring_timeout_handler(request: Request, exc: ScoringTimeout) -> JSONResponse:
+    return JSONResponse(status_code=504, content={"detail": "Similarity scoring timed out"})
+
+
+@app.on_event("startup")
+def start_scoring_pool() -> None:
+    # Workers load their libraries before the first request instead of during it
+    if scoring_pool is not None:
+        scoring_pool.warm_up()
+
+
+@app.on_event("shutdown")
+def stop_scoring_pool() -> None:
+    if scoring_pool is not None:
+        scoring_pool.shutdown()
+
+
+def warm_up_similarity_features() -> None:
+    db = SessionLocal()
+    try:
+        branches = crud.car.warm_up_similarity_features(db)
+        logger.info("Loaded similarity features of %s branches", branches)
+    except Exception:
+        logger.exception("Warming up similarity features failed")
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+def load_similarity_features() -> None:
+    # Persisted features are loaded and stale ones refitted without delaying the startup
+    if settings.SIMILARITY_ARTIFACT_DIR:
+        threading.Thread(target=warm_up_similarity_features, daemon=True).start()
@@ -3,3 +3,4 @@ from .branch import Branch
 from .company import Company
 from .car import Car
 from .user_interaction import UserInteraction
+from .car_similarity import CarSimilarity
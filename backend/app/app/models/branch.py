@@ -16,6 +16,8 @@ class Branch(Base):
     company_id = Column(Integer, ForeignKey("companies.id"), nullable=False)
     branch_name = Column(String, nullable=False)
     location = Column(String, nullable=False)
+    # Bumped by every write to the cars of the branch, labels persisted similarity features
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")
     # Relationships
     company = relationship("Company", back_populates="branches")
     cars = relationship("Car", back_populates="branch")
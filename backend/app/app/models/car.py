@@ -2,7 +2,7 @@ from typing import TYPE_CHECKING
 
 from enum import Enum
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, Enum as EnumSA
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Float, Enum as EnumSA, func
 from sqlalchemy.orm import relationship
 
 from app.db.base_class import Base
@@ -24,23 +24,41 @@ class Transmission(str, Enum):
 
 class Car(Base):
     __tablename__ = "cars"
-    id = Column(Integer, primary_key=True, index=True)
+    # Every query is scoped to a branch, so the indexes lead with the tenant columns.
+    # The remaining columns serve make/model lookups, the price and year ranges
+    # and listing in id order or sorted by price, year or kilometers with id breaking ties.
+    __table_args__ = (
+        Index("ix_cars_company_id_branch_id_id", "company_id", "branch_id", "id"),
+        Index("ix_cars_company_id_branch_id_make_model", "company_id", "branch_id", "make", "model"),
+        Index("ix_cars_company_id_branch_id_price_id", "company_id", "branch_id", "price", "id"),
+        Index("ix_cars_company_id_branch_id_year_id", "company_id", "branch_id", "year", "id"),
+        Index("ix_cars_company_id_branch_id_kilometers_id", "company_id", "branch_id", "kilometers", "id"),
+    )
+    id = Column(Integer, primary_key=True)
     company_id = Column(Integer, ForeignKey("companies.id"), nullable=False)
     branch_id = Column(Integer, ForeignKey("branches.id"), nullable=False)
-    make = Column(String, index=True, nullable=False)
-    model = Column(String, index=True, nullable=False)
-    price = Column(Float, index=True, nullable=False)
-    year = Column(Integer, index=True, nullable=False)
-    kilometers = Column(Integer, index=True, nullable=False)
+    make = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    price = Column(Float, nullable=False)
+    year = Column(Integer, nullable=False)
+    kilometers = Column(Integer, nullable=False)
 
     # Use EnumSA to define fuel_type and transmission as enums
-    fuel_type = Column(EnumSA(FuelType), index=True, nullable=False)
-    transmission = Column(EnumSA(Transmission), index=True, nullable=False)
+    fuel_type = Column(EnumSA(FuelType), nullable=False)
+    transmission = Column(EnumSA(Transmission), nullable=False)
 
-    color = Column(String, index=True, nullable=False)
-    seats = Column(Integer, index=True, nullable=False)
+    color = Column(String, nullable=False)
+    seats = Column(Integer, nullable=False)
 
     # Relationships
     branch = relationship("Branch", back_populates="cars")
     companies = relationship("Company", back_populates="cars")
-    interactions = relationship("UserInteraction", back_populates="car")
\ No newline at end of file
+    interactions = relationship("UserInteraction", back_populates="car")
+
+
+# Make, model and color matched by the free-text car search
+search_text = Car.make + " " + Car.model + " " + Car.color
+search_document = func.to_tsvector("simple", search_text)
+Index("ix_cars_search_document", search_document, postgresql_using="gin")
+# The trigram index ix_cars_search_text_trgm on search_text only exists where pg_trgm is
+# installed, it is created by its migration and left out of autogenerate in alembic/env.py
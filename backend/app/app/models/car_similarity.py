@@ -0,0 +1,25 @@
+from typing import TYPE_CHECKING
+
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, String
+
+from app.db.base_class import Base
+
+if TYPE_CHECKING:
+    from .car import Car  # noqa: F401
+
+
+class CarSimilarity(Base):
+    __tablename__ = "car_similarities"
+    # Neighbours of a car are read in rank order through the primary key
+    car_id = Column(
+        Integer, ForeignKey("cars.id", ondelete="CASCADE"), primary_key=True
+    )
+    rank = Column(Integer, primary_key=True)
+    similar_car_id = Column(
+        Integer, ForeignKey("cars.id", ondelete="CASCADE"), index=True, nullable=False
+    )
+    score = Column(Float, nullable=False)
+    engine = Column(String, nullable=False)
+    # Set when one of the cars changed and the neighbours wait to be recomputed
+    stale = Column(Boolean(), default=False, nullable=False)
+    computed_at = Column(DateTime, nullable=False)
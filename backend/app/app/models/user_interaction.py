@@ -2,7 +2,7 @@ from typing import TYPE_CHECKING
 
 from enum import Enum
 
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, Enum as EnumSA
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Index, Enum as EnumSA
 from sqlalchemy.orm import relationship
 
 from app.db.base_class import Base
@@ -20,15 +20,19 @@ if TYPE_CHECKING:
 
 class UserInteraction(Base):
     __tablename__ = "user_interactions"
-    id = Column(Integer, primary_key=True, index=True)
+    # Interactions are listed per branch, per car and per user
+    __table_args__ = (
+        Index("ix_user_interactions_company_id_branch_id_id", "company_id", "branch_id", "id"),
+    )
+    id = Column(Integer, primary_key=True)
     # Relationships with Company and Branch
     # for now company_id and branch_id can be null
-    car_id = Column(Integer, ForeignKey("cars.id"), nullable=False)
-    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    car_id = Column(Integer, ForeignKey("cars.id"), index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id"), index=True, nullable=False)
     company_id = Column(Integer, ForeignKey("companies.id"), nullable=False)
     branch_id = Column(Integer, ForeignKey("branches.id"), nullable=False)
 
-    interaction_type = Column(EnumSA(InteractionType), index=True, nullable=False)
+    interaction_type = Column(EnumSA(InteractionType), nullable=False)
     timestamp = Column(DateTime, nullable=False)
 
     car = relationship("Car", back_populates="interactions")
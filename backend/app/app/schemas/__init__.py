@@ -3,5 +3,6 @@ from .token import Token, TokenPayload
 from .user import User, UserCreate, UserInDB, UserUpdate
 from .company import Company, CompanyCreate, CompanyInDB, CompanyInDBBase, CompanyUpdate
 from .branch import Branch, BranchCreate, BranchInDB, BranchInDBBase, BranchUpdate
-from .car import Car, CarCreate, CarInDB, CarInDBBase, CarUpdate
+from .car import Car, CarCount, CarCreate, CarFacets, CarFilters, CarHistograms, CarInDB, CarInDBBase, CarUpdate, FacetCount, HistogramBucket
 from .user_interaction import UserInteraction, UserInteractionCreate, UserInteractionInDB, UserInteractionInDBBase, UserInteractionUpdate
+from .car_similarity import CarSimilarity, CarSimilarityCreate, CarSimilarityInDB, CarSimilarityInDBBase, CarSimilarityUpdate
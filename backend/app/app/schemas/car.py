@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import List, Optional, Union
 from app.models.car import FuelType, Transmission
 
-from pydantic import BaseModel
+from pydantic import BaseModel, StrictInt
 
 
 # Shared properties
@@ -60,3 +60,57 @@ class Car(CarInDBBase):
 # Properties properties stored in DB
 class CarInDB(CarInDBBase):
     pass
+
+
+# Filters of a car search, the list filters match any of their values
+class CarFilters(BaseModel):
+    make: Optional[List[str]] = None
+    model: Optional[str] = None
+    year_min: Optional[int] = None
+    year_max: Optional[int] = None
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
+    fuel_type: Optional[List[FuelType]] = None
+    transmission: Optional[List[Transmission]] = None
+    color: Optional[List[str]] = None
+    seats_min: Optional[int] = None
+    seats_max: Optional[int] = None
+    make_not: Optional[List[str]] = None
+    color_not: Optional[List[str]] = None
+    fuel_type_not: Optional[List[FuelType]] = None
+    transmission_not: Optional[List[Transmission]] = None
+
+
+# Number of cars with a value of a facet
+class FacetCount(BaseModel):
+    value: Union[StrictInt, str]
+    count: int
+
+
+# Facet counts of the cars matching a search
+class CarFacets(BaseModel):
+    make: List[FacetCount]
+    color: List[FacetCount]
+    seats: List[FacetCount]
+    fuel_type: List[FacetCount]
+    transmission: List[FacetCount]
+
+
+# Number of cars matching a search, estimated from the query plan when not exact
+class CarCount(BaseModel):
+    count: int
+    exact: bool
+
+
+# Number of cars with a value from lower up to upper
+class HistogramBucket(BaseModel):
+    lower: float
+    upper: float
+    count: int
+
+
+# Value distributions of the cars matching a search
+class CarHistograms(BaseModel):
+    price: List[HistogramBucket]
+    year: List[HistogramBucket]
+    kilometers: List[HistogramBucket]
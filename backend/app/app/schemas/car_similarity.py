@@ -0,0 +1,41 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+# Shared properties
+class CarSimilarityBase(BaseModel):
+    car_id: int
+    rank: int
+    similar_car_id: int
+    score: float
+    engine: str
+    stale: Optional[bool] = False
+    computed_at: datetime
+
+
+# Properties to receive on creation
+class CarSimilarityCreate(CarSimilarityBase):
+    pass
+
+
+# Properties to receive on update
+class CarSimilarityUpdate(CarSimilarityBase):
+    pass
+
+
+# Properties shared by models stored in DB
+class CarSimilarityInDBBase(CarSimilarityBase):
+    class Config:
+        orm_mode = True
+
+
+# Properties to return to client
+class CarSimilarity(CarSimilarityInDBBase):
+    pass
+
+
+# Properties properties stored in DB
+class CarSimilarityInDB(CarSimilarityInDBBase):
+    pass
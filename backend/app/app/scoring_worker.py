@@ -0,0 +1,71 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app import crud
+from app.core.feature_cache import feature_cache
+from app.core.filtering_utils import (
+    SimilarityFeatures,
+    rank_similar_many,
+    score_encoded,
+    score_similar,
+)
+from app.db.session import SessionLocal
+
+# Last data version seen per branch. Writes are handled by the web processes, never by a
+# worker, so cached features are dropped when the version sent with a task changes
+_data_versions: Dict[Tuple[int, int], Optional[int]] = {}
+
+
+def _get_features(
+    company_id: int, branch_id: int, engine: str, data_version: Optional[int]
+) -> SimilarityFeatures:
+    if _data_versions.get((company_id, branch_id)) != data_version:
+        feature_cache.invalidate(company_id, branch_id)
+        _data_versions[(company_id, branch_id)] = data_version
+    db = SessionLocal()
+    try:
+        return crud.car.get_similarity_features(
+            db, company_id=company_id, branch_id=branch_id, engine=engine
+        )
+    finally:
+        db.close()
+
+
+def score_similar_cars(
+    company_id: int,
+    branch_id: int,
+    engine: str,
+    data_version: Optional[int],
+    target_car: Any,
+    limit: int,
+    exact: bool,
+    candidate_ids: Optional[List[int]] = None,
+) -> List[Tuple[int, float]]:
+    features = _get_features(company_id, branch_id, engine, data_version)
+    return score_similar(
+        features, target_car, limit=limit, exact=exact, candidate_ids=candidate_ids
+    )
+
+
+def score_similar_cars_many(
+    company_id: int,
+    branch_id: int,
+    engine: str,
+    data_version: Optional[int],
+    target_cars: Sequence[Any],
+    limit: int,
+) -> Dict[int, List[Tuple[int, float]]]:
+    features = _get_features(company_id, branch_id, engine, data_version)
+    return rank_similar_many(features, target_cars, limit=limit)
+
+
+def score_encoded_cars(
+    company_id: int,
+    branch_id: int,
+    engine: str,
+    data_version: Optional[int],
+    target_car: Any,
+    cars: Sequence[Any],
+    limit: int,
+) -> List[Tuple[int, float]]:
+    features = _get_features(company_id, branch_id, engine, data_version)
+    return score_encoded(features, target_car, cars, limit=limit)
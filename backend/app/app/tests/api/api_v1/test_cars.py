@@ -1,10 +1,16 @@
+import time
 from typing import Any, Dict, List
 from app.tests.utils.car import create_test_cars
 from app.models.car import FuelType, Transmission
+import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 from app import crud
 from app.core.config import settings
+from app.core.columnar_search import ColumnarSearch
+from app.core.pagination import encode_cursor
+from app.core.scoring_pool import ScoringPool, ScoringTimeout
+from app.crud import crud_car
 from app.schemas.car import CarCreate, CarUpdate
 from app.schemas.company import CompanyCreate
 from app.schemas.branch import BranchCreate
@@ -168,6 +174,1732 @@ def test_read_transmissions(client: TestClient) -> None:
     assert "transmissions" in data
     assert len(data["transmissions"]) > 0
 
+def test_get_cars_similar_uses_feature_cache(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 1",
+            year=2022,
+            price=20000.00,
+            kilometers=125000,
+            fuel_type=FuelType.DIESEL,
+            transmission=Transmission.AUTOMATIC,
+            color="Red",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 2",
+            year=2021,
+            price=18000.00,
+            kilometers=12000,
+            fuel_type=FuelType.DIESEL,
+            transmission=Transmission.AUTOMATIC,
+            color="Red",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 3",
+            model="Test Model 3",
+            year=2010,
+            price=5000.00,
+            kilometers=215000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="Black",
+            seats=2,
+        ),
+    ]
+    created_cars = create_test_cars(
+        db=db, car_data=car_data, company_id=company_id, branch_id=branch_id
+    )
+    target_id = created_cars[0].id
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{target_id}/similar/"
+    )
+
+    # The first request builds the branch features, the second one reuses them
+    r = client.get(similar_url)
+    assert r.status_code == 200
+    similar_ids = [car["id"] for car in r.json()]
+    assert similar_ids[0] == created_cars[1].id
+    assert target_id not in similar_ids
+    assert len(similar_ids) == 2
+
+    stats_before = client.get(
+        f"{settings.API_V1_STR}/utils/similarity-cache-stats/",
+        headers=superuser_token_headers,
+    ).json()
+    r = client.get(similar_url)
+    assert [car["id"] for car in r.json()] == similar_ids
+    stats_after = client.get(
+        f"{settings.API_V1_STR}/utils/similarity-cache-stats/",
+        headers=superuser_token_headers,
+    ).json()
+    assert stats_after["hits"] == stats_before["hits"] + 1
+    assert stats_after["rebuilds"] == stats_before["rebuilds"]
+
+    # Adding a car to the branch invalidates the cached features
+    new_car = make_create_car_request(
+        client,
+        superuser_token_headers,
+        {
+            "make": "Test Make 1",
+            "model": "Test Model 4",
+            "price": 19000.00,
+            "year": 2022,
+            "kilometers": 100000,
+            "fuel_type": "Diesel",
+            "transmission": "Automatic",
+            "color": "Red",
+            "seats": 5,
+        },
+        company_id,
+        branch_id,
+    )
+    r = client.get(similar_url)
+    assert new_car["id"] in [car["id"] for car in r.json()]
+
+    # Writes of other workers are noticed through the data version of the branch
+    db.execute(
+        crud.car.model.__table__.delete().where(crud.car.model.id == new_car["id"])
+    )
+    crud.car.bump_data_version(db, branch_id=branch_id)
+    db.commit()
+    r = client.get(similar_url)
+    assert new_car["id"] not in [car["id"] for car in r.json()]
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_numeric_engine(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 1",
+            year=2020,
+            price=500000.00,
+            kilometers=40000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 2",
+            model="Test Model 2",
+            year=2008,
+            price=90000.00,
+            kilometers=190000,
+            fuel_type=FuelType.DIESEL,
+            transmission=Transmission.AUTOMATIC,
+            color="Black",
+            seats=7,
+        ),
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 3",
+            year=2019,
+            price=480000.00,
+            kilometers=45000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+    ]
+    created_cars = create_test_cars(
+        db=db, car_data=car_data, company_id=company_id, branch_id=branch_id
+    )
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{created_cars[0].id}/similar/"
+    )
+
+    # Only the closest car is returned when limit is 1
+    r = client.get(similar_url, params={"engine": "numeric", "limit": 1})
+    assert r.status_code == 200
+    assert [car["id"] for car in r.json()] == [created_cars[2].id]
+
+    r = client.get(similar_url, params={"engine": "unknown"})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_ann_engine_incremental(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 1",
+            year=2020,
+            price=500000.00,
+            kilometers=40000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 2",
+            model="Test Model 2",
+            year=2008,
+            price=90000.00,
+            kilometers=190000,
+            fuel_type=FuelType.DIESEL,
+            transmission=Transmission.AUTOMATIC,
+            color="Black",
+            seats=7,
+        ),
+    ]
+    created_cars = create_test_cars(
+        db=db, car_data=car_data, company_id=company_id, branch_id=branch_id
+    )
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{created_cars[0].id}/similar/"
+    )
+
+    r = client.get(similar_url, params={"engine": "ann"})
+    assert [car["id"] for car in r.json()] == [created_cars[1].id]
+
+    # New cars are inserted into the cached index instead of rebuilding it
+    stats_before = client.get(
+        f"{settings.API_V1_STR}/utils/similarity-cache-stats/",
+        headers=superuser_token_headers,
+    ).json()
+    new_car = make_create_car_request(
+        client,
+        superuser_token_headers,
+        {
+            "make": "Test Make 1",
+            "model": "Test Model 3",
+            "price": 490000.00,
+            "year": 2020,
+            "kilometers": 42000,
+            "fuel_type": "Petrol",
+            "transmission": "Manual",
+            "color": "White",
+            "seats": 5,
+        },
+        company_id,
+        branch_id,
+    )
+    r = client.get(similar_url, params={"engine": "ann", "limit": 1})
+    assert [car["id"] for car in r.json()] == [new_car["id"]]
+    r = client.get(similar_url, params={"engine": "ann", "limit": 1, "exact": True})
+    assert [car["id"] for car in r.json()] == [new_car["id"]]
+    stats_after = client.get(
+        f"{settings.API_V1_STR}/utils/similarity-cache-stats/",
+        headers=superuser_token_headers,
+    ).json()
+    assert stats_after["rebuilds"] == stats_before["rebuilds"]
+    assert stats_after["incremental_updates"] > stats_before["incremental_updates"]
+
+    # Deleted cars disappear from the index
+    r = client.delete(f"{settings.API_V1_STR}/cars/{new_car['id']}")
+    assert r.status_code == 200
+    r = client.get(similar_url, params={"engine": "ann"})
+    assert [car["id"] for car in r.json()] == [created_cars[1].id]
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_precomputed(
+    client: TestClient,
+    superuser_token_headers: Dict[str, str],
+    db: Session,
+    monkeypatch: Any,
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 1",
+            year=2020,
+            price=500000.00,
+            kilometers=40000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 1",
+            model="Test Model 2",
+            year=2019,
+            price=480000.00,
+            kilometers=45000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+        CarCreate(
+            make="Test Make 2",
+            model="Test Model 3",
+            year=2008,
+            price=90000.00,
+            kilometers=190000,
+            fuel_type=FuelType.DIESEL,
+            transmission=Transmission.AUTOMATIC,
+            color="Black",
+            seats=7,
+        ),
+    ]
+    created_cars = create_test_cars(
+        db=db, car_data=car_data, company_id=company_id, branch_id=branch_id
+    )
+    target_id = created_cars[0].id
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{target_id}/similar/"
+    )
+
+    # Stored neighbours are ignored and cannot be scheduled while precomputation
+    # is disabled
+    crud.car_similarity.replace(
+        db,
+        engine=settings.SIMILARITY_ENGINE,
+        neighbours={target_id: [(created_cars[2].id, 1.0)]},
+    )
+    r = client.get(similar_url)
+    assert [car["id"] for car in r.json()] == [created_cars[1].id, created_cars[2].id]
+    r = client.post(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}"
+        "/cars/similar/precompute/",
+        headers=superuser_token_headers,
+    )
+    assert r.status_code == 400
+    monkeypatch.setattr(settings, "SIMILARITY_PRECOMPUTE_ENABLED", True)
+    # The refresh tasks are run by hand below
+    monkeypatch.setattr(crud.car, "enqueue_similarity_refresh", lambda **kwargs: None)
+    r = client.get(similar_url)
+    assert [car["id"] for car in r.json()] == [created_cars[2].id]
+
+    # Precomputed neighbours are served from the car_similarities table
+    assert crud.car.precompute_similar_cars(
+        db, company_id=company_id, branch_id=branch_id
+    ) == len(created_cars)
+    precomputed = crud.car_similarity.get_similar_cars(
+        db,
+        car_id=target_id,
+        company_id=company_id,
+        branch_id=branch_id,
+        engine=settings.SIMILARITY_ENGINE,
+    )
+    assert [car.id for car in precomputed] == [created_cars[1].id, created_cars[2].id]
+    r = client.get(similar_url)
+    assert [car["id"] for car in r.json()] == [created_cars[1].id, created_cars[2].id]
+
+    # Updating a neighbour flags the rows as stale until they are refreshed
+    crud.car.update(
+        db, db_obj=created_cars[1], obj_in={"price": 95000.00, "year": 2008}
+    )
+    assert (
+        crud.car_similarity.get_similar_cars(
+            db,
+            car_id=target_id,
+            company_id=company_id,
+            branch_id=branch_id,
+            engine=settings.SIMILARITY_ENGINE,
+        )
+        is None
+    )
+    assert (
+        crud.car.refresh_similar_cars(
+            db, company_id=company_id, branch_id=branch_id, car_id=created_cars[1].id
+        )
+        > 0
+    )
+    refreshed = crud.car_similarity.get_similar_cars(
+        db,
+        car_id=target_id,
+        company_id=company_id,
+        branch_id=branch_id,
+        engine=settings.SIMILARITY_ENGINE,
+    )
+    assert refreshed is not None
+
+    # Neighbours are only served for the branch they were computed in
+    other_branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 2", location="Test location")], company_id
+    )[0].id
+    assert (
+        crud.car_similarity.get_similar_cars(
+            db,
+            car_id=target_id,
+            company_id=company_id,
+            branch_id=other_branch_id,
+            engine=settings.SIMILARITY_ENGINE,
+        )
+        is None
+    )
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{other_branch_id}"
+        f"/cars/{target_id}/similar/"
+    )
+    assert r.json() == []
+
+    # A new car joins the neighbours of every car listing fewer than the top N
+    created_cars += create_test_cars(
+        db=db, car_data=car_data[:1], company_id=company_id, branch_id=branch_id
+    )
+    assert (
+        crud.car_similarity.get_similar_cars(
+            db,
+            car_id=target_id,
+            company_id=company_id,
+            branch_id=branch_id,
+            engine=settings.SIMILARITY_ENGINE,
+        )
+        is None
+    )
+    r = client.get(similar_url)
+    assert r.json()[0]["id"] == created_cars[3].id
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=other_branch_id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_in_company(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company with two branches
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+        BranchCreate(branch_name="Branch 2", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+
+    first_branch_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=created_branches[0].id,
+    )
+    second_branch_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 3",
+                year=2020,
+                price=490000.00,
+                kilometers=41000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 4",
+                year=2018,
+                price=450000.00,
+                kilometers=60000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=created_branches[1].id,
+    )
+
+    # The best matches are found in the sister branch, its cars are scored in the
+    # space of the target branch
+    for engine in ["numeric", "ann"]:
+        r = client.get(
+            f"{settings.API_V1_STR}/company/{company_id}"
+            f"/cars/{first_branch_cars[0].id}/similar/",
+            params={"engine": engine},
+        )
+        assert r.status_code == 200
+        assert [car["id"] for car in r.json()] == [
+            second_branch_cars[0].id, second_branch_cars[1].id, first_branch_cars[1].id
+        ]
+
+    # Cars of another company are not found
+    other_company = create_test_companies(db, [CompanyCreate(name="Company 2")])[0]
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{other_company.id}"
+        f"/cars/{first_branch_cars[0].id}/similar/"
+    )
+    assert r.status_code == 404
+    assert (
+        crud.car.get_similar_cars_in_company(
+            db, id=first_branch_cars[0].id, company_id=other_company.id
+        )
+        == []
+    )
+
+    # Cleanup the test records
+    for car in first_branch_cars + second_branch_cars:
+        crud.car.remove(db, id=car.id)
+    for branch in created_branches:
+        crud.branch.remove(db, id=branch.id)
+    crud.company.remove(db=db, id=company_id)
+    crud.company.remove(db=db, id=other_company.id)
+
+def test_get_cars_similar_many(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 2",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 3",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    car_ids = [car.id for car in created_cars]
+
+    # Every requested car gets the same neighbours as from the single car endpoint
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/similar/",
+        params={"ids": car_ids[:2], "engine": "numeric", "limit": 1}
+    )
+    assert r.status_code == 200
+    assert {
+        car_id: [car["id"] for car in cars] for car_id, cars in r.json().items()
+    } == {
+        str(car_ids[0]): [car_ids[1]],
+        str(car_ids[1]): [car_ids[0]],
+    }
+
+    # Cars of other branches are not found
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/similar/",
+        params={"ids": [car_ids[0], -1]}
+    )
+    assert r.status_code == 404
+
+    # Cleanup the test records
+    for car_id in car_ids:
+        crud.car.remove(db, id=car_id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_get_cars_similar_scoring_pool(
+    client: TestClient,
+    superuser_token_headers: Dict[str, str],
+    db: Session,
+    monkeypatch: Any,
+) -> None:
+    # Create test company and branch
+    company_data = [CompanyCreate(name="Company 1")]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 3",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{created_cars[0].id}/similar/"
+    )
+    expected = client.get(similar_url, params={"engine": "numeric"}).json()
+
+    pool = ScoringPool(workers=1, queue_size=1, timeout=60)
+    monkeypatch.setattr(crud_car, "scoring_pool", pool)
+    try:
+        # Worker processes score the same neighbours as the request thread
+        r = client.get(similar_url, params={"engine": "numeric"})
+        assert r.status_code == 200
+        assert r.json() == expected
+
+        # A full queue rejects requests instead of queueing them
+        busy = pool.submit(time.sleep, 2)
+        r = client.get(similar_url, params={"engine": "numeric"})
+        assert r.status_code == 503
+        busy.result()
+
+        # Writes of the web process reach the workers through the data version
+        # of the branch
+        crud.car.update(
+            db,
+            db_obj=created_cars[1],
+            obj_in={
+                "make": "Test Make 1",
+                "year": 2020,
+                "price": 500000.00,
+                "kilometers": 40000,
+                "fuel_type": FuelType.PETROL,
+                "transmission": Transmission.MANUAL,
+                "color": "White",
+                "seats": 5,
+            },
+        )
+        r = client.get(similar_url, params={"engine": "numeric"})
+        assert [car["id"] for car in r.json()] == [
+            created_cars[1].id,
+            created_cars[2].id,
+        ]
+    finally:
+        pool.shutdown()
+
+    # Tasks waited for together share the timeout, those not started yet are cancelled
+    pool = ScoringPool(workers=1, queue_size=3, timeout=0.5)
+    try:
+        futures = [pool.submit(time.sleep, 1) for _ in range(3)]
+        with pytest.raises(ScoringTimeout):
+            pool.results(futures)
+        assert futures[-1].cancelled()
+    finally:
+        pool.shutdown()
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_get_cars_similar_with_filters(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 2",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 3",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 4",
+                year=2010,
+                price=120000.00,
+                kilometers=150000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{created_cars[0].id}/similar/"
+    )
+
+    for engine in ["tfidf", "numeric", "ann"]:
+        # Only cars matching the filters are ranked
+        r = client.get(
+            similar_url,
+            params={"engine": engine, "price_max": 200000, "transmission": "Automatic"},
+        )
+        assert r.status_code == 200
+        assert sorted(car["id"] for car in r.json()) == [
+            created_cars[2].id,
+            created_cars[3].id,
+        ]
+
+        r = client.get(similar_url, params={"engine": engine, "fuel_type": "Petrol"})
+        assert [car["id"] for car in r.json()] == [created_cars[1].id]
+
+    r = client.get(similar_url, params={"fuel_type": "Steam"})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_to_example(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    example = {
+        "make": "Test Make 2",
+        "model": "Test Model 5",
+        "year": 2009,
+        "price": 95000.00,
+        "kilometers": 180000,
+        "fuel_type": "Diesel",
+        "transmission": "Automatic",
+        "color": "Black",
+        "seats": 7,
+    }
+    example_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/similar"
+        "/example/"
+    )
+
+    for engine in ["tfidf", "numeric", "ann"]:
+        r = client.post(example_url, params={"engine": engine}, json=example)
+        assert r.status_code == 200
+        assert [car["id"] for car in r.json()] == [
+            created_cars[1].id,
+            created_cars[0].id,
+        ]
+
+    # The example is not stored
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/"
+    )
+    assert len(r.json()) == 2
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_get_cars_similar_sql_engine(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 3",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 4",
+                year=2012,
+                price=150000.00,
+                kilometers=120000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.AUTOMATIC,
+                color="White",
+                seats=5,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    similar_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars"
+        f"/{created_cars[0].id}/similar/"
+    )
+
+    # The database ranks by distance and agrees with the in-process numeric engine
+    r = client.get(similar_url, params={"engine": "sql"})
+    assert r.status_code == 200
+    expected = [created_cars[2].id, created_cars[3].id, created_cars[1].id]
+    assert [car["id"] for car in r.json()] == expected
+    r = client.get(similar_url, params={"engine": "numeric"})
+    assert [car["id"] for car in r.json()] == expected
+
+    r = client.get(
+        similar_url, params={"engine": "sql", "transmission": "Automatic", "limit": 1}
+    )
+    assert [car["id"] for car in r.json()] == [created_cars[3].id]
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_read_cars_cursor(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model=f"Test Model {index}",
+                year=2010 + index,
+                price=100000.00 + index,
+                kilometers=10000 * index,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            )
+            for index in range(5)
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    car_ids = sorted(car.id for car in created_cars)
+
+    for path in ["cars/", "cars/search/"]:
+        url = f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/{path}"
+        # Pages follow each other through the cursor header until the last, partial page
+        seen: List[int] = []
+        params: Dict[str, Any] = {"limit": 2, "make": "Test Make 1"}
+        while True:
+            r = client.get(url, params=params)
+            assert r.status_code == 200
+            seen.extend(car["id"] for car in r.json())
+            if "X-Next-Cursor" not in r.headers:
+                break
+            params["cursor"] = r.headers["X-Next-Cursor"]
+        assert seen == car_ids
+
+        # Skip keeps working for existing clients
+        r = client.get(url, params={"skip": 3, "limit": 2})
+        assert [car["id"] for car in r.json()] == car_ids[3:]
+
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/",
+        params={"cursor": "?"},
+    )
+    assert r.status_code == 400
+    # Cursors holding values of another type are rejected before they reach the database
+    for values in (["abc", 1], [1.5, 1], [None, 1], [True, 1], [1]):
+        r = client.get(
+            f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/",
+            params={"sort": "year", "cursor": encode_cursor(values)})
+        assert r.status_code == 400
+        assert r.json() == {"detail": "Invalid cursor"}
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_read_cars_sorted(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    # Prices repeat, so ties are broken by id
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model=f"Test Model {index}",
+                year=2020 - index,
+                price=100000.00 * (index % 3),
+                kilometers=(index * 7919) % 50000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            )
+            for index in range(7)
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+
+    for path in ["cars/", "cars/search/"]:
+        url = f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/{path}"
+        for sort in crud.car.sort_options:
+            column = sort.lstrip("-")
+            expected = [
+                car.id
+                for car in sorted(
+                    created_cars,
+                    key=lambda car: (getattr(car, column), car.id),
+                    reverse=sort.startswith("-"),
+                )
+            ]
+            seen: List[int] = []
+            params: Dict[str, Any] = {"limit": 3, "sort": sort}
+            while True:
+                r = client.get(url, params=params)
+                assert r.status_code == 200
+                seen.extend(car["id"] for car in r.json())
+                if "X-Next-Cursor" not in r.headers:
+                    break
+                params["cursor"] = r.headers["X-Next-Cursor"]
+            assert seen == expected
+
+    r = client.get(
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/",
+        params={"sort": "color"},
+    )
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_search_cars_text(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Maruti Suzuki",
+                model="Swift Dzire VDI",
+                year=2015,
+                price=450000.00,
+                kilometers=60000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Maruti Suzuki",
+                model="Swift VXI",
+                year=2017,
+                price=500000.00,
+                kilometers=30000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="Red",
+                seats=5,
+            ),
+            CarCreate(
+                make="Hyundai",
+                model="i20 Asta",
+                year=2018,
+                price=650000.00,
+                kilometers=25000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.AUTOMATIC,
+                color="White",
+                seats=5,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    search_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/search/"
+    )
+
+    # Every word has to match, words may be typed partially
+    r = client.get(search_url, params={"q": "swift dzire"})
+    assert r.status_code == 200
+    assert [car["id"] for car in r.json()] == [created_cars[0].id]
+    r = client.get(search_url, params={"q": "maruti swi"})
+    assert {car["id"] for car in r.json()} == {created_cars[0].id, created_cars[1].id}
+
+    # Misspelled words still find the car
+    r = client.get(search_url, params={"q": "hyundia"})
+    assert [car["id"] for car in r.json()] == [created_cars[2].id]
+
+    # The text search combines with the filters
+    r = client.get(search_url, params={"q": "white", "transmission": "Manual"})
+    assert [car["id"] for car in r.json()] == [created_cars[0].id]
+
+    r = client.get(search_url, params={"q": "swift", "cursor": "W10="})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_read_car_facets(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 2",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 3",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    facets_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/facets/"
+    )
+
+    r = client.get(facets_url)
+    assert r.status_code == 200
+    assert r.json() == {
+        "make": [
+            {"value": "Test Make 1", "count": 2},
+            {"value": "Test Make 2", "count": 1},
+        ],
+        "color": [{"value": "White", "count": 2}, {"value": "Black", "count": 1}],
+        "seats": [{"value": 5, "count": 2}, {"value": 7, "count": 1}],
+        "fuel_type": [{"value": "Diesel", "count": 2}, {"value": "Petrol", "count": 1}],
+        "transmission": [
+            {"value": "Manual", "count": 2},
+            {"value": "Automatic", "count": 1},
+        ],
+    }
+
+    # The counts respect the search filters
+    r = client.get(facets_url, params={"fuel_type": "Diesel", "price_min": 100000})
+    assert r.json()["make"] == [{"value": "Test Make 1", "count": 1}]
+    assert r.json()["seats"] == [{"value": 5, "count": 1}]
+
+    r = client.get(facets_url, params={"fuel_type": "Steam"})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_read_car_histograms(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2010,
+                price=100000.00,
+                kilometers=90000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 2",
+                year=2012,
+                price=150000.00,
+                kilometers=50000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 3",
+                year=2020,
+                price=500000.00,
+                kilometers=10000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    histograms_url = (
+        f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}"
+        "/cars/histograms/"
+    )
+
+    r = client.get(histograms_url, params={"buckets": 4})
+    assert r.status_code == 200
+    histograms = r.json()
+    assert histograms["price"] == [
+        {"lower": 100000.0, "upper": 200000.0, "count": 2},
+        {"lower": 200000.0, "upper": 300000.0, "count": 0},
+        {"lower": 300000.0, "upper": 400000.0, "count": 0},
+        {"lower": 400000.0, "upper": 500000.0, "count": 1},
+    ]
+    assert [bucket["count"] for bucket in histograms["year"]] == [2, 0, 0, 1]
+    assert [bucket["count"] for bucket in histograms["kilometers"]] == [1, 0, 1, 1]
+
+    # The buckets span the branch while the counts respect the filters
+    r = client.get(histograms_url, params={"buckets": 4, "fuel_type": "Diesel"})
+    assert [bucket["count"] for bucket in r.json()["price"]] == [1, 0, 0, 1]
+    assert r.json()["price"][0]["lower"] == 100000.0
+    r = client.get(histograms_url, params={"buckets": 4, "make": "Unknown"})
+    assert [bucket["count"] for bucket in r.json()["year"]] == [0, 0, 0, 0]
+
+    # The response is revalidated until a car of the branch changes
+    r = client.get(histograms_url, params={"buckets": 4})
+    etag = r.headers["ETag"]
+    r = client.get(
+        histograms_url, params={"buckets": 4}, headers={"If-None-Match": etag}
+    )
+    assert r.status_code == 304
+    crud.car.update(db, db_obj=created_cars[0], obj_in=CarUpdate(price=120000.00))
+    r = client.get(
+        histograms_url, params={"buckets": 4}, headers={"If-None-Match": etag}
+    )
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_search_cars_columnar(
+    client: TestClient,
+    superuser_token_headers: Dict[str, str],
+    db: Session,
+    monkeypatch: Any,
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make=f"Test Make {index % 2}",
+                model=f"Test Model {index}",
+                year=2010 + index,
+                price=100000.00 * (index % 3),
+                kilometers=(index * 7919) % 50000,
+                fuel_type=FuelType.PETROL if index % 2 else FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="White" if index < 4 else "Black",
+                seats=4 + index % 3,
+            )
+            for index in range(7)
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    url = f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/search/"
+    searches: List[Dict[str, Any]] = [
+        {},
+        {"make": "Test Make 1"},
+        {"make": "Test Make 0", "color": "White", "sort": "-price"},
+        {"fuel_type": "Diesel", "seats_min": 5, "price_max": 150000},
+        {"model": "Test Model 3", "year_min": 2011},
+        {"seats_max": 5, "sort": "kilometers", "skip": 1, "limit": 2},
+        {"make": "Unknown Make"},
+        {
+            "make": ["Test Make 0", "Test Make 1"],
+            "color_not": "White",
+            "fuel_type_not": "Petrol",
+        },
+        {
+            "seats_min": 5,
+            "make_not": "Test Make 0,Unknown Make",
+            "transmission": "Manual,Automatic",
+        },
+    ]
+    expected = [client.get(url, params=params).json() for params in searches]
+
+    search = ColumnarSearch(max_branches=1)
+    monkeypatch.setattr(crud_car, "columnar_search", search)
+    monkeypatch.setattr(crud_car, "search_cache", None)
+    # A cold branch is searched in PostgreSQL while its columns are built
+    r = client.get(url, params=searches[1])
+    assert r.json() == expected[1]
+    search.warm(
+        company_id,
+        branch_id,
+        lambda session: crud.car.load_search_columns(
+            session, company_id=company_id, branch_id=branch_id
+        ),
+    ).result()
+    builds = search.stats()["builds"]
+
+    for params, cars in zip(searches, expected):
+        r = client.get(url, params=params)
+        assert r.status_code == 200
+        assert r.json() == cars
+    assert search.stats()["hits"] == len(searches)
+
+    # Cursor pages continue through the in-memory columns
+    seen: List[int] = []
+    params: Dict[str, Any] = {"limit": 3, "sort": "price"}
+    while True:
+        r = client.get(url, params=params)
+        seen.extend(car["id"] for car in r.json())
+        if "X-Next-Cursor" not in r.headers:
+            break
+        params["cursor"] = r.headers["X-Next-Cursor"]
+    assert seen == [
+        car.id for car in sorted(created_cars, key=lambda car: (car.price, car.id))
+    ]
+    # and reject the cursors PostgreSQL would reject
+    r = client.get(url, params={"sort": "year", "cursor": encode_cursor([2010.5, 1])})
+    assert r.status_code == 400
+
+    # Writes of the process are applied to the columns in place
+    crud.car.update(db, db_obj=created_cars[0], obj_in={"make": "Test Make 1"})
+    r = client.get(url, params={"make": "Test Make 1"})
+    assert r.json()[0]["id"] == created_cars[0].id
+    assert search.stats()["updates"] == 1
+    assert search.stats()["builds"] == builds
+
+    # Writes the columns missed leave them stale, the search falls back to PostgreSQL
+    crud.car.bump_data_version(db, branch_id=branch_id)
+    db.commit()
+    hits = search.stats()["hits"]
+    r = client.get(url, params={"make": "Test Make 1"})
+    assert r.json()[0]["id"] == created_cars[0].id
+    assert search.stats()["hits"] == hits
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_count_cars(
+    client: TestClient,
+    superuser_token_headers: Dict[str, str],
+    db: Session,
+    monkeypatch: Any,
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make=f"Test Make {index % 2}",
+                model=f"Test Model {index}",
+                year=2010 + index,
+                price=100000.00 * index,
+                kilometers=40000,
+                fuel_type=FuelType.DIESEL if index < 3 else FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            )
+            for index in range(5)
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    url = f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/"
+
+    r = client.get(url + "count/", params={"fuel_type": "Diesel", "price_max": 150000})
+    assert r.status_code == 200
+    assert r.json() == {"count": 2, "exact": True}
+    r = client.get(url + "count/", params={"make": "Test Make 1", "mode": "estimated"})
+    # Small results are counted exactly even when an estimate was asked for
+    assert r.json() == {"count": 2, "exact": True}
+
+    # The total is independent of the page size
+    r = client.get(url, params={"limit": 2, "count": "exact"})
+    assert len(r.json()) == 2
+    assert r.headers["X-Total-Count"] == "5"
+    assert r.headers["X-Total-Count-Exact"] == "true"
+    r = client.get(
+        url + "search/", params={"fuel_type": "Diesel", "limit": 1, "count": "exact"}
+    )
+    assert r.headers["X-Total-Count"] == "3"
+    r = client.get(url + "search/", params={"fuel_type": "Diesel"})
+    assert "X-Total-Count" not in r.headers
+
+    # Larger results are estimated from the query plan
+    monkeypatch.setattr(settings, "SEARCH_COUNT_EXACT_BELOW", 0)
+    monkeypatch.setattr(crud_car, "search_cache", None)
+    r = client.get(
+        url + "search/", params={"fuel_type": "Diesel", "count": "estimated"}
+    )
+    assert r.headers["X-Total-Count-Exact"] == "false"
+    assert int(r.headers["X-Total-Count"]) >= 0
+
+    r = client.get(url + "count/", params={"mode": "approximate"})
+    assert r.status_code == 400
+    r = client.get(url, params={"count": "approximate"})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+def test_search_cars_multi_value(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    created_cars = create_test_cars(db=db, car_data=[
+        CarCreate(
+            make=make, model="Test Model", year=2015, price=300000.00, kilometers=80000,
+            fuel_type=fuel_type, transmission=Transmission.MANUAL, color=color, seats=5
+        )
+        for make, color, fuel_type in [
+            ("Honda", "White", FuelType.PETROL),
+            ("Honda", "Red", FuelType.DIESEL),
+            ("Toyota", "Black", FuelType.PETROL),
+            ("Toyota", "White", FuelType.UNKNOWN),
+            ("Skoda", "Red", FuelType.PETROL),
+        ]
+    ], company_id=company_id, branch_id=branch_id)
+    url = f"{settings.API_V1_STR}/company/{company_id}/branch/{branch_id}/cars/"
+
+    # "Honda or Toyota, not white" as repeated and as comma separated parameters
+    expected = [created_cars[1].id, created_cars[2].id]
+    r = client.get(
+        url + "search/", params={"make": ["Honda", "Toyota"], "color_not": "White"}
+    )
+    assert r.status_code == 200
+    assert [car["id"] for car in r.json()] == expected
+    r = client.get(
+        url + "search/", params={"make": "Honda,Toyota", "color_not": "White"}
+    )
+    assert [car["id"] for car in r.json()] == expected
+
+    r = client.get(url + "search/", params={"fuel_type_not": ["Petrol", "Unknown"]})
+    assert [car["id"] for car in r.json()] == [created_cars[1].id]
+    r = client.get(
+        url + "search/", params={"color": ["Red", "Black"], "make_not": "Skoda"}
+    )
+    assert [car["id"] for car in r.json()] == expected
+
+    # Facets and counts take the same filters
+    r = client.get(
+        url + "facets/", params={"make": ["Honda", "Toyota"], "color_not": "White"}
+    )
+    assert r.json()["make"] == [
+        {"value": "Honda", "count": 1},
+        {"value": "Toyota", "count": 1},
+    ]
+    r = client.get(url + "count/", params={"make_not": ["Honda", "Toyota"]})
+    assert r.json() == {"count": 1, "exact": True}
+
+    r = client.get(url + "search/", params={"fuel_type_not": ["Petrol", "Electric"]})
+    assert r.status_code == 400
+
+    # Cleanup the test records
+    for car in created_cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
 # TODO: add more tests to have 100% test coverage
 
 
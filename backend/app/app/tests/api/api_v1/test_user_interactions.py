@@ -1,14 +1,19 @@
-from typing import Any, Dict
+from typing import Any, Dict, List
+import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 from app import crud
+from app.core.collaborative import INTERACTION_WEIGHTS, CoOccurrenceModel, InteractionModel
 from app.core.config import settings
+from app.core.user_profiles import UserProfileModel
+from app.crud import crud_user_interaction
 from app.schemas.user_interaction import UserInteractionCreate, UserInteractionUpdate
 from app.schemas.company import CompanyCreate
 from app.schemas.branch import BranchCreate
 from app.schemas.user import UserCreate
 from app.schemas.car import CarCreate
 from app.models.car import FuelType, Transmission
+from app.models.user_interaction import InteractionType
 
 from app.tests.utils.car import create_test_cars
 from app.tests.utils.company import create_test_companies
@@ -194,6 +199,278 @@ def test_read_user_interaction(
     crud.car.remove(db, id=car_id)
     crud.user.remove(db=db, id=user_id)
 
+def test_read_cars_also_viewed(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    # Create test cars
+    car_data = [CarCreate(
+            make=f"Test Make {index}", model=f"Test Model {index}", year=2022, price=20000.00, kilometers=125000,
+            fuel_type=FuelType.DIESEL, transmission=Transmission.AUTOMATIC, color="Red", seats=5
+        ) for index in range(3)]
+    created_cars = create_test_cars(db=db, car_data=car_data, company_id=company_id, branch_id=branch_id)
+    car_ids = [car.id for car in created_cars]
+
+    # create random users
+    user_ids = []
+    for _ in range(2):
+        user_in = UserCreate(email=random_email(), password=random_lower_string(), company_id=company_id, branch_id=branch_id)
+        user_ids.append(crud.user.create_with_company_id_and_branch_id(db, obj_in=user_in).id)
+
+    # The first user likes car 0 and views car 1, the second one views cars 0 and 2
+    interactions = [(user_ids[0], car_ids[0], "Like"), (user_ids[0], car_ids[1], "View"),
+                    (user_ids[1], car_ids[0], "View"), (user_ids[1], car_ids[2], "View")]
+    created_interactions = [
+        make_create_user_interaction_request(client, superuser_token_headers, {
+            "car_id": car_id,
+            "user_id": user_id,
+            "company_id": company_id,
+            "branch_id": branch_id,
+            "interaction_type": interaction_type,
+            "timestamp": str(datetime.now())
+        }) for user_id, car_id, interaction_type in interactions
+    ]
+
+    # Interactions recorded by the same user in another branch, e.g. before moving to it, stay in that branch
+    other_branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 2", location="Test location")], company_id)[0].id
+    other_car_id = create_test_cars(db=db, car_data=car_data[:1], company_id=company_id, branch_id=other_branch_id)[0].id
+    created_interactions.append({"id": crud.user_interaction.create(db, obj_in=UserInteractionCreate(
+        car_id=other_car_id, user_id=user_ids[0], company_id=company_id, branch_id=other_branch_id,
+        interaction_type=InteractionType.LIKE, timestamp=datetime.now()
+    )).id})
+
+    # Cars co-occurring with a like rank above those co-occurring with a view
+    r = client.get(f"{settings.API_V1_STR}/car/{car_ids[0]}/also_viewed/")
+    assert r.status_code == 200
+    assert [car["id"] for car in r.json()] == [car_ids[1], car_ids[2]]
+    r = client.get(f"{settings.API_V1_STR}/car/{other_car_id}/also_viewed/")
+    assert r.json() == []
+
+    # Removed interactions no longer count
+    crud.user_interaction.remove(db, id=created_interactions[1]["id"])
+    r = client.get(f"{settings.API_V1_STR}/car/{car_ids[0]}/also_viewed/")
+    assert [car["id"] for car in r.json()] == [car_ids[2]]
+
+    # Cleanup the test records
+    for interaction in created_interactions[:1] + created_interactions[2:]:
+        crud.user_interaction.remove(db, id=interaction["id"])
+    for car_id in car_ids + [other_car_id]:
+        crud.car.remove(db, id=car_id)
+    for user_id in user_ids:
+        crud.user.remove(db=db, id=user_id)
+
+def test_read_cars_also_viewed_after_restart(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session, monkeypatch: Any
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [CarCreate(
+            make=f"Test Make {index}", model=f"Test Model {index}", year=2022, price=20000.00, kilometers=125000,
+            fuel_type=FuelType.DIESEL, transmission=Transmission.AUTOMATIC, color="Red", seats=5
+        ) for index in range(3)]
+    created_cars = create_test_cars(db=db, car_data=car_data, company_id=company_id, branch_id=branch_id)
+    car_ids = [car.id for car in created_cars]
+    user_in = UserCreate(email=random_email(), password=random_lower_string(), company_id=company_id, branch_id=branch_id)
+    user_id = crud.user.create_with_company_id_and_branch_id(db, obj_in=user_in).id
+
+    def create_interaction(car_id: int) -> Dict[str, Any]:
+        return make_create_user_interaction_request(client, superuser_token_headers, {
+            "car_id": car_id,
+            "user_id": user_id,
+            "company_id": company_id,
+            "branch_id": branch_id,
+            "interaction_type": "View",
+            "timestamp": str(datetime.now())
+        })
+
+    created_interactions = [create_interaction(car_ids[0]), create_interaction(car_ids[1])]
+    # A restarted worker records an interaction before serving its first recommendation
+    monkeypatch.setattr(crud_user_interaction, "co_occurrence", CoOccurrenceModel(
+        weights=INTERACTION_WEIGHTS, rebuild_seconds=3600, lookback=0))
+    created_interactions.append(create_interaction(car_ids[2]))
+
+    # The history recorded before the restart is loaded as well
+    r = client.get(f"{settings.API_V1_STR}/car/{car_ids[0]}/also_viewed/")
+    assert r.status_code == 200
+    assert sorted(car["id"] for car in r.json()) == [car_ids[1], car_ids[2]]
+
+    # Cleanup the test records
+    for interaction in created_interactions:
+        crud.user_interaction.remove(db, id=interaction["id"])
+    for car_id in car_ids:
+        crud.car.remove(db, id=car_id)
+    crud.user.remove(db=db, id=user_id)
+
+def test_interaction_model_rebuilds() -> None:
+    # Subclasses provide the state of the model
+    with pytest.raises(TypeError):
+        InteractionModel(rebuild_seconds=0)  # type: ignore
+
+    loads: List[int] = []
+
+    def load_since(id: int) -> List[Any]:
+        loads.append(id)
+        return []
+
+    # Only the first refresh loads the whole history unless periodic rebuilds are enabled
+    model = CoOccurrenceModel(weights=INTERACTION_WEIGHTS, rebuild_seconds=0)
+    rebuilds: List[int] = []
+    rebuild = model._rebuild
+    model._rebuild = lambda load: rebuilds.append(1) or rebuild(load)  # type: ignore
+    for _ in range(3):
+        model.refresh(load_since)
+    assert len(rebuilds) == 1
+    assert len(loads) == 3
+
+def test_update_old_user_interaction(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session, monkeypatch: Any
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    car_data = [CarCreate(
+            make=f"Test Make {index}", model=f"Test Model {index}", year=2022, price=20000.00, kilometers=125000,
+            fuel_type=FuelType.DIESEL, transmission=Transmission.AUTOMATIC, color="Red", seats=5
+        ) for index in range(3)]
+    created_cars = create_test_cars(db=db, car_data=car_data, company_id=company_id, branch_id=branch_id)
+    car_ids = [car.id for car in created_cars]
+    user_in = UserCreate(email=random_email(), password=random_lower_string(), company_id=company_id, branch_id=branch_id)
+    user_id = crud.user.create_with_company_id_and_branch_id(db, obj_in=user_in).id
+
+    # Without a lookback window every interaction below the newest one counts as old
+    co_occurrence = CoOccurrenceModel(weights=INTERACTION_WEIGHTS, rebuild_seconds=3600, lookback=0)
+    user_profiles = UserProfileModel(weights=INTERACTION_WEIGHTS, rebuild_seconds=3600, lookback=0)
+    monkeypatch.setattr(crud_user_interaction, "co_occurrence", co_occurrence)
+    monkeypatch.setattr(crud_user_interaction, "user_profiles", user_profiles)
+
+    interaction_data = [{
+        "car_id": car_id,
+        "user_id": user_id,
+        "company_id": company_id,
+        "branch_id": branch_id,
+        "interaction_type": "View",
+        "timestamp": str(datetime.now())
+    } for car_id in car_ids]
+    created_interactions = [
+        make_create_user_interaction_request(client, superuser_token_headers, data) for data in interaction_data[:2]]
+    client.get(f"{settings.API_V1_STR}/car/{car_ids[0]}/also_viewed/")
+    client.get(f"{settings.API_V1_STR}/user/{user_id}/recommendations/")
+    created_interactions.append(
+        make_create_user_interaction_request(client, superuser_token_headers, interaction_data[2]))
+
+    # The oldest view becomes a like and is re-weighted instead of dropped
+    make_update_user_interaction_request(
+        client, superuser_token_headers, created_interactions[0]["id"], {**interaction_data[0], "interaction_type": "Like"})
+    view_weight, like_weight = INTERACTION_WEIGHTS[InteractionType.VIEW], INTERACTION_WEIGHTS[InteractionType.LIKE]
+    assert dict(co_occurrence.top_k(company_id, branch_id, car_ids[1], 2)) == {
+        car_ids[0]: like_weight * view_weight, car_ids[2]: view_weight * view_weight}
+    profile = user_profiles.get(user_id)
+    assert set(profile.car_ids) == set(car_ids)
+    assert profile.weight == like_weight + 2 * view_weight
+
+    # Cleanup the test records
+    for interaction in created_interactions:
+        crud.user_interaction.remove(db, id=interaction["id"])
+    for car_id in car_ids:
+        crud.car.remove(db, id=car_id)
+    crud.user.remove(db=db, id=user_id)
+
+def test_read_user_recommendations(
+    client: TestClient, superuser_token_headers: Dict[str, str], db: Session
+) -> None:
+    # Create test company and branch
+    company_data = [
+        CompanyCreate(name="Company 1")
+    ]
+    created_company = create_test_companies(db, company_data)
+    company_id = created_company[0].id
+
+    branch_data = [
+        BranchCreate(branch_name="Branch 1", location="Test location"),
+    ]
+    created_branches = create_test_branches(db, branch_data, company_id)
+    branch_id = created_branches[0].id
+
+    # Create test cars, two cheap diesels and one expensive petrol car
+    car_data = [
+        CarCreate(make="Skoda", model="Octavia", year=2015, price=9000.00, kilometers=150000,
+                  fuel_type=FuelType.DIESEL, transmission=Transmission.MANUAL, color="Red", seats=5),
+        CarCreate(make="Skoda", model="Fabia", year=2016, price=8000.00, kilometers=140000,
+                  fuel_type=FuelType.DIESEL, transmission=Transmission.MANUAL, color="Red", seats=5),
+        CarCreate(make="Porsche", model="911", year=2022, price=150000.00, kilometers=5000,
+                  fuel_type=FuelType.PETROL, transmission=Transmission.AUTOMATIC, color="Black", seats=2),
+    ]
+    created_cars = create_test_cars(db=db, car_data=car_data, company_id=company_id, branch_id=branch_id)
+    car_ids = [car.id for car in created_cars]
+
+    # create random user
+    user_in = UserCreate(email=random_email(), password=random_lower_string(), company_id=company_id, branch_id=branch_id)
+    user_id = crud.user.create_with_company_id_and_branch_id(db, obj_in=user_in).id
+
+    # Without interactions there is nothing to recommend
+    r = client.get(f"{settings.API_V1_STR}/user/{user_id}/recommendations/")
+    assert r.status_code == 200
+    assert r.json() == []
+
+    created_interaction = make_create_user_interaction_request(client, superuser_token_headers, {
+        "car_id": car_ids[0],
+        "user_id": user_id,
+        "company_id": company_id,
+        "branch_id": branch_id,
+        "interaction_type": "Like",
+        "timestamp": str(datetime.now())
+    })
+
+    # The liked car is left out and the similar one ranks first
+    r = client.get(f"{settings.API_V1_STR}/user/{user_id}/recommendations/")
+    assert r.status_code == 200
+    assert [car["id"] for car in r.json()] == [car_ids[1], car_ids[2]]
+
+    r = client.get(f"{settings.API_V1_STR}/user/-1/recommendations/")
+    assert r.status_code == 404
+
+    # Cleanup the test records
+    crud.user_interaction.remove(db, id=created_interaction["id"])
+    r = client.get(f"{settings.API_V1_STR}/user/{user_id}/recommendations/")
+    assert r.json() == []
+    for car_id in car_ids:
+        crud.car.remove(db, id=car_id)
+    crud.user.remove(db=db, id=user_id)
+
 # Add more test cases as needed for other API endpoints
 
 def make_create_user_interaction_request(client: TestClient, superuser_token_headers: Dict[str, str], data: Dict[str, Any]) -> Dict[str, Any]:
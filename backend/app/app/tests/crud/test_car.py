@@ -0,0 +1,420 @@
+import random
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, List
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core.columnar_search import BranchColumns
+from app.core.feature_artifacts import FeatureArtifacts
+from app.core.filtering_utils import SIMILARITY_ENGINES, NumericFeatures, rank_similar
+from app.core.search_cache import SearchCache
+from app.core.shared_features import SharedFeatureStore
+from app.crud import crud_car
+from app.models.car import FuelType, Transmission
+from app.schemas.branch import BranchCreate
+from app.schemas.car import CarCreate, CarFilters, CarUpdate
+from app.schemas.company import CompanyCreate
+from app.tests.utils.branch import create_test_branches
+from app.tests.utils.car import create_test_cars
+from app.tests.utils.company import create_test_companies
+
+
+def test_shared_feature_store(db: Session, tmp_path: Path) -> None:
+    company_id = create_test_companies(db, [CompanyCreate(name="Company 1")])[0].id
+    branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 1", location="Test location")], company_id
+    )[0].id
+    cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 2",
+                year=2019,
+                price=480000.00,
+                kilometers=45000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 3",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+
+    # Two stores on the same directory behave like two workers of a node
+    first_worker = SharedFeatureStore(str(tmp_path))
+    second_worker = SharedFeatureStore(str(tmp_path))
+
+    fitted_engines: List[str] = []
+
+    def build(engine: str) -> Callable[[], Any]:
+        def fit() -> Any:
+            fitted_engines.append(engine)
+            return SIMILARITY_ENGINES[engine].fit(
+                crud.car.get_feature_rows(
+                    db, company_id=company_id, branch_id=branch_id
+                )
+            )
+
+        return fit
+
+    data_version = crud.car.get_data_version(db, branch_id=branch_id)
+    for engine in SIMILARITY_ENGINES:
+        shared = first_worker.get(
+            company_id, branch_id, engine, build(engine), data_version
+        )
+        mapped = second_worker.get(
+            company_id, branch_id, engine, build(engine), data_version
+        )
+        fitted = build(engine)()
+        assert rank_similar(mapped, cars[0], limit=2, exact=True) == rank_similar(
+            fitted, cars[0], limit=2, exact=True
+        )
+        assert rank_similar(shared, cars[0], limit=2) == rank_similar(
+            fitted, cars[0], limit=2
+        )
+    # Only the first worker fitted the branch, the second one mapped its files
+    assert len(fitted_engines) == 2 * len(SIMILARITY_ENGINES)
+    numeric = second_worker.get(company_id, branch_id, "numeric", build("numeric"))
+    assert isinstance(numeric.matrix, np.memmap)
+    assert not numeric.matrix.flags.writeable
+
+    # A write published by one worker is picked up by the other
+    car = crud.car.update(
+        db,
+        db_obj=cars[2],
+        obj_in=CarUpdate(
+            make="Test Make 1",
+            model="Test Model 3",
+            year=2020,
+            price=495000.00,
+            kilometers=41000,
+            fuel_type=FuelType.PETROL,
+            transmission=Transmission.MANUAL,
+            color="White",
+            seats=5,
+        ),
+    )
+    data_version = crud.car.get_data_version(db, branch_id=branch_id)
+    first_worker.upsert(company_id, branch_id, car, data_version)
+    fitted_engines.clear()
+    numeric = second_worker.get(
+        company_id, branch_id, "numeric", build("numeric"), data_version
+    )
+    assert rank_similar(numeric, cars[0], limit=1) == [car.id]
+    assert fitted_engines == []
+    # Features without incremental updates are refitted on the next lookup
+    second_worker.get(company_id, branch_id, "tfidf", build("tfidf"), data_version)
+    assert fitted_engines == ["tfidf"]
+
+    # A write handled on another node is noticed through the data version of the branch
+    crud.car.remove(db, id=car.id)
+    fitted_engines.clear()
+    numeric = first_worker.get(
+        company_id,
+        branch_id,
+        "numeric",
+        build("numeric"),
+        crud.car.get_data_version(db, branch_id=branch_id),
+    )
+    assert fitted_engines == ["numeric"]
+    assert rank_similar(numeric, cars[0], limit=2) == [cars[1].id]
+
+    # Cleanup the test records
+    for car in cars[:2]:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_similarity_feature_artifacts(
+    db: Session, tmp_path: Path, monkeypatch: Any
+) -> None:
+    company_id = create_test_companies(db, [CompanyCreate(name="Company 1")])[0].id
+    branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 1", location="Test location")], company_id
+    )[0].id
+    cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.AUTOMATIC,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    artifacts = FeatureArtifacts(str(tmp_path))
+    monkeypatch.setattr(crud_car, "feature_artifacts", artifacts)
+    artifact_path = tmp_path / f"{company_id}-{branch_id}" / "numeric"
+
+    # The first load fits and persists the features,
+    # the next one maps the persisted files
+    fitted = crud.car.load_similarity_features(
+        db, company_id=company_id, branch_id=branch_id, engine="numeric"
+    )
+    assert not isinstance(fitted.matrix, np.memmap)
+    loaded = crud.car.load_similarity_features(
+        db, company_id=company_id, branch_id=branch_id, engine="numeric"
+    )
+    assert isinstance(loaded.matrix, np.memmap)
+    assert np.array_equal(loaded.matrix, fitted.matrix)
+    versions = [path.name for path in artifact_path.iterdir()]
+    assert len(versions) == 1
+
+    # A car write bumps the branch data version,
+    # the stale artifact is served while it is refitted in the background
+    crud.car.remove(db, id=cars[1].id)
+    stale = crud.car.load_similarity_features(
+        db, company_id=company_id, branch_id=branch_id, engine="numeric"
+    )
+    assert stale.car_ids.tolist() == [car.id for car in cars]
+    artifacts.refit(company_id, branch_id, "numeric", lambda session: None).result()
+    assert [path.name for path in artifact_path.iterdir()] == [
+        str(int(versions[0]) + 1)
+    ]
+    refitted = crud.car.load_similarity_features(
+        db, company_id=company_id, branch_id=branch_id, engine="numeric"
+    )
+    assert isinstance(refitted.matrix, np.memmap)
+    assert refitted.car_ids.tolist() == [cars[0].id]
+
+    # Cleanup the test records
+    crud.car.remove(db, id=cars[0].id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_search_cache(db: Session, monkeypatch: Any) -> None:
+    company_id = create_test_companies(db, [CompanyCreate(name="Company 1")])[0].id
+    branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 1", location="Test location")], company_id
+    )[0].id
+    cars = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+            CarCreate(
+                make="Test Make 2",
+                model="Test Model 2",
+                year=2008,
+                price=90000.00,
+                kilometers=190000,
+                fuel_type=FuelType.DIESEL,
+                transmission=Transmission.MANUAL,
+                color="Black",
+                seats=7,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )
+    cache = SearchCache(max_bytes=1024 * 1024, ttl=60)
+    monkeypatch.setattr(crud_car, "search_cache", cache)
+
+    def search(**filters: Any) -> List[int]:
+        return [
+            car.id
+            for car in crud.car.search_by_filters(
+                db, company_id, branch_id, CarFilters(**filters)
+            )
+        ]
+
+    assert search(
+        fuel_type=[FuelType.DIESEL], transmission=["Manual"], price_max=600000
+    ) == [cars[0].id, cars[1].id]
+    # Enum and string values, ignored empty filters and int prices share the cached page
+    assert search(
+        price_max=600000.0,
+        transmission=[Transmission.MANUAL],
+        fuel_type=["Diesel"],
+        make=[],
+    ) == [cars[0].id, cars[1].id]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+    # A write bumps the branch version, so the cached page is not read again
+    crud.car.update(db, db_obj=cars[1], obj_in={"fuel_type": FuelType.PETROL})
+    assert search(
+        fuel_type=[FuelType.DIESEL], transmission=["Manual"], price_max=600000
+    ) == [cars[0].id]
+    assert cache.stats()["misses"] == 2
+
+    # Cached pages are returned as detached cars with every column
+    listed = crud.car.get_all(db, company_id=company_id, branch_id=branch_id)
+    cached = crud.car.get_all(db, company_id=company_id, branch_id=branch_id)
+    assert [(car.id, car.make, car.fuel_type, car.price) for car in cached] == [
+        (car.id, car.make, car.fuel_type, car.price) for car in listed
+    ]
+    assert cache.stats()["hits"] == 2
+    # Every hit builds new cars, changing one leaves the cached page intact
+    cached[0].price = 1.0
+    assert (
+        crud.car.get_all(db, company_id=company_id, branch_id=branch_id)[0].price
+        == listed[0].price
+    )
+    # Unbounded listings bypass the cache
+    entries = cache.stats()["entries"]
+    assert len(
+        crud.car.get_all(db, company_id=company_id, branch_id=branch_id, limit=None)
+    ) == len(cars)
+    assert cache.stats()["entries"] == entries
+
+    # The least recently used pages are evicted to stay under the memory cap
+    cache.max_bytes = cache.stats()["bytes"]
+    search(make=["Test Make 1"])
+    assert cache.stats()["evictions"] >= 1
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+    # Expired pages are loaded again
+    cache.ttl = -1
+    search(make=["Test Make 1"])
+    assert cache.stats()["expirations"] == 1
+
+    # Cleanup the test records
+    for car in cars:
+        crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_empty_branch_columns(db: Session) -> None:
+    company_id = create_test_companies(db, [CompanyCreate(name="Company 1")])[0].id
+    branch_id = create_test_branches(
+        db, [BranchCreate(branch_name="Branch 1", location="Test location")], company_id
+    )[0].id
+
+    # An empty branch gets the column types of a loaded one, so written cars keep them
+    empty = crud.car.load_search_columns(db, company_id=company_id, branch_id=branch_id)
+    car = create_test_cars(
+        db=db,
+        car_data=[
+            CarCreate(
+                make="Test Make 1",
+                model="Test Model 1",
+                year=2020,
+                price=500000.00,
+                kilometers=40000,
+                fuel_type=FuelType.PETROL,
+                transmission=Transmission.MANUAL,
+                color="White",
+                seats=5,
+            ),
+        ],
+        company_id=company_id,
+        branch_id=branch_id,
+    )[0]
+    loaded = crud.car.load_search_columns(
+        db, company_id=company_id, branch_id=branch_id
+    )
+    written = empty.upserted(car, loaded.data_version)
+    for name, column in loaded.columns.items():
+        assert empty.columns[name].dtype == column.dtype
+        assert written.columns[name].dtype == column.dtype
+    assert written.search(CarFilters()) == loaded.search(CarFilters())
+    assert BranchColumns.build(None, []).columns["id"].dtype == np.int64
+
+    # Cleanup the test records
+    crud.car.remove(db, id=car.id)
+    crud.branch.remove(db, id=branch_id)
+    crud.company.remove(db=db, id=company_id)
+
+
+def test_numeric_features_writes() -> None:
+    rng = random.Random(0)
+
+    def random_car(car_id: int) -> SimpleNamespace:
+        return SimpleNamespace(
+            id=car_id,
+            make=rng.choice(["Skoda", "Audi"]),
+            price=rng.uniform(1000, 50000),
+            year=rng.randint(2000, 2022),
+            kilometers=rng.randint(0, 300000),
+            fuel_type=rng.choice(list(FuelType)),
+            transmission=rng.choice(list(Transmission)),
+            color=rng.choice(["Red", "Black"]),
+            seats=rng.choice([2, 5, 7]),
+        )
+
+    cars = {car_id: random_car(car_id) for car_id in range(1, 50)}
+    fitted = NumericFeatures.fit(list(cars.values()))
+    features = fitted
+    buffers = set()
+    for _ in range(200):
+        car_id = rng.choice([max(cars) + 1, rng.choice(list(cars))])
+        cars[car_id] = random_car(car_id)
+        features = features.upserted(cars[car_id])
+        buffers.add(id(features._buffer))
+    # New and updated cars are written into spare rows, which only grow a few times
+    assert len(buffers) <= 3
+    # A car with an older id is inserted at its position
+    features = features.removed(10)
+    cars[10] = random_car(10)
+    features = features.upserted(cars[10])
+
+    # The written features match the cars encoded from scratch with the same fit,
+    # which is untouched
+    assert features.car_ids.tolist() == sorted(cars)
+    assert np.allclose(
+        features.matrix, features.encode([cars[car_id] for car_id in sorted(cars)])
+    )
+    assert [features.row_by_id[car_id] for car_id in sorted(cars)] == list(
+        range(len(cars))
+    )
+    assert len(fitted) == 49
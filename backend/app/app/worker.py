@@ -1,7 +1,9 @@
 from raven import Client
 
+from app import crud
 from app.core.celery_app import celery_app
 from app.core.config import settings
+from app.db.session import SessionLocal
 
 client_sentry = Client(settings.SENTRY_DSN)
 
@@ -9,3 +11,21 @@ client_sentry = Client(settings.SENTRY_DSN)
 @celery_app.task(acks_late=True)
 def test_celery(word: str) -> str:
     return f"test task return {word}"
+
+
+@celery_app.task(acks_late=True)
+def compute_branch_similarities(company_id: int, branch_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return crud.car.precompute_similar_cars(db, company_id=company_id, branch_id=branch_id)
+    finally:
+        db.close()
+
+
+@celery_app.task(acks_late=True)
+def refresh_car_similarities(company_id: int, branch_id: int, car_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return crud.car.refresh_similar_cars(db, company_id=company_id, branch_id=branch_id, car_id=car_id)
+    finally:
+        db.close()